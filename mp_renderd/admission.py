@@ -0,0 +1,123 @@
+# This file is part of the MapProxy project.
+# Copyright (C) 2013 Omniscale GmbH & Co. KG <http://omniscale.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import threading
+
+class AdmissionControl(object):
+    """
+    Decides if new tasks are accepted, based on the number of waiting
+    tasks and on the estimated wait time.
+
+    :param max_waiting: maximum number of waiting tasks
+    :param max_waiting_per_priority: dict with the maximum number of
+        waiting tasks with this or a lower priority,
+        e.g. ``{10: 5000}``
+    :param max_wait_time: maximum estimated wait time in seconds
+    :param task_time: initial estimate for the render time of a task
+
+    `check()` is called from the HTTP threads. It only reads counters
+    that are updated by the broker thread. Tasks that are merged with
+    a waiting or running task are always accepted, they need no
+    additional render time.
+
+    The limits for the number of waiting tasks apply to all broker
+    shards that share the admission control together. The wait time is
+    estimated for the shard of the task.
+    """
+    # weight of a new render time for the moving average
+    smoothing = 0.1
+
+    def __init__(self, max_waiting=None, max_waiting_per_priority=None,
+        max_wait_time=None, task_time=1.0):
+        self.max_waiting = max_waiting
+        self.max_waiting_per_priority = sorted((max_waiting_per_priority or {}).items())
+        self.max_wait_time = max_wait_time
+        self.task_time = task_time
+        self.rejected = 0
+        self._rejected_lock = threading.Lock()
+
+    def record_task_time(self, duration):
+        """
+        Update the average render time with the `duration` of a task.
+        """
+        self.task_time += self.smoothing * (duration - self.task_time)
+
+    def estimated_wait_time(self, priority, render_queue, incoming=0):
+        """
+        Estimate how long a new task with `priority` waits before it
+        runs. Counts all waiting tasks with the same or a higher
+        priority and the `incoming` tasks that are not queued yet.
+        """
+        waiting = render_queue.waiting_by_priority()
+        ahead = sum(n for p, n in waiting.iteritems() if p >= priority) + incoming
+        processes = render_queue.processes_for_priority(priority)
+        if not processes:
+            return float('inf')
+        return ahead * self.task_time / processes
+
+    def check(self, task, render_queue, incoming=0, shards=None):
+        """
+        Return ``None`` if `task` is accepted or the reason why it
+        is rejected.
+
+        :param shards: list of ``(render_queue, incoming)`` of all
+            shards, defaults to the `render_queue` of the task only
+        """
+        if render_queue.has_key(task.key):
+            return None
+        if shards is None:
+            shards = [(render_queue, incoming)]
+        reason = self._check(task, render_queue, incoming, shards)
+        if reason:
+            with self._rejected_lock:
+                self.rejected += 1
+        return reason
+
+    def _check(self, task, render_queue, incoming, shards):
+        priority = task.priority
+        if priority is None:
+            priority = render_queue.tasks.default_priority
+
+        if self.max_waiting is not None:
+            waiting = sum(q.waiting + n for q, n in shards)
+            if waiting >= self.max_waiting:
+                return 'too many waiting tasks (%d)' % waiting
+
+        if self.max_waiting_per_priority:
+            waiting = {}
+            for q, _ in shards:
+                for p, n in q.waiting_by_priority().iteritems():
+                    waiting[p] = waiting.get(p, 0) + n
+            for max_priority, limit in self.max_waiting_per_priority:
+                if priority > max_priority:
+                    continue
+                num = sum(n for p, n in waiting.iteritems() if p <= max_priority)
+                if num >= limit:
+                    return 'too many waiting tasks with priority <= %s (%d)' % (
+                        max_priority, num)
+
+        max_wait_time = self.max_wait_time
+        if task.deadline is not None:
+            remaining = task.deadline - time.time()
+            if max_wait_time is None or remaining < max_wait_time:
+                max_wait_time = remaining
+        if max_wait_time is not None:
+            wait_time = self.estimated_wait_time(priority, render_queue, incoming)
+            if wait_time > max_wait_time:
+                return 'estimated wait time %.1fs exceeds %.1fs' % (
+                    wait_time, max_wait_time)
+
+        return None
@@ -18,13 +18,22 @@ import os
 import sys
 import atexit
 import optparse
+import functools
+import threading
 import multiprocessing
 
-from mp_renderd.wsgi import RenderdApp, CherryPyWSGIServer
-from mp_renderd.broker import Broker
+from mp_renderd.wsgi import RenderdApp, RenderdWSGIServer
+from mp_renderd.eventserver import EventServer
+from mp_renderd.broker import Broker, ShardedBroker, split_process_priorities
 from mp_renderd.pool import WorkerPool
 from mp_renderd.worker import SeedWorker
 from mp_renderd.queue import RenderQueue
+from mp_renderd.admission import AdmissionControl
+from mp_renderd.journal import TaskJournal
+from mp_renderd.watchdog import TimeBudgets
+from mp_renderd.tilebuffer import TileBuffer
+from mp_renderd.jobs import JobStore
+from mp_renderd.recent import RecentResults
 from mapproxy.config.loader import load_configuration
 
 import logging
@@ -49,6 +58,23 @@ def fatal(msg):
     print >>sys.stderr, msg
     sys.exit(2)
 
+def parse_time_budgets(values, option):
+    budgets = {}
+    for value in values:
+        try:
+            name, seconds = value.rsplit(':', 1)
+            budgets[name] = float(seconds)
+        except ValueError:
+            fatal('invalid %s %r, expected NAME:SECONDS' % (option, value))
+    return budgets
+
+def parse_renderd_address(address):
+    """
+    Return the ``(host, port)`` to bind for the renderd `address` of
+    the MapProxy configuration. Only the port is used, renderd always
+    binds to the loopback interface.
+    """
+    return '127.0.0.1', int(address.rstrip('/').rsplit(':', 1)[1])
 
 def main():
     parser = optparse.OptionParser()
@@ -59,6 +85,70 @@ def main():
         help="Number of render processes.")
     parser.add_option("--max-seed-renderer", default=None, type=int,
         help="Maximum --renderer used for seeding.")
+    parser.add_option("--renderer-threads", default=1, type=int,
+        help="Number of task threads in each render process.")
+    parser.add_option("--fork-server", action="store_true", default=False,
+        help="Fork render processes from a separate fork server process.")
+    parser.add_option("--renderer-max-tasks", default=None, type=int, metavar="N",
+        help="Replace render processes after N tasks.")
+    parser.add_option("--renderer-max-memory", default=None, type=int, metavar="MB",
+        help="Replace render processes that use more memory.")
+    parser.add_option("--batch-size", default=1, type=int,
+        help="Maximum number of tile tasks for one cache in a single render call.")
+    parser.add_option("--priority-aging-interval", default=None, type=float,
+        help="Raise the priority of waiting tasks every N seconds.")
+    parser.add_option("--priority-aging-step", default=10, type=int,
+        help="Priority increase for each --priority-aging-interval.")
+    parser.add_option("--priority-aging-max", default=None, type=int,
+        help="Maximum priority of aged tasks.")
+    parser.add_option("--max-waiting", default=None, type=int,
+        help="Reject new requests if N tasks are waiting.")
+    parser.add_option("--max-waiting-priority", default=[], action="append",
+        metavar="PRIORITY:N",
+        help="Reject requests with PRIORITY or lower if N tasks with "
+            "PRIORITY or lower are waiting. Can be repeated.")
+    parser.add_option("--max-wait-time", default=None, type=float,
+        help="Reject new requests if the estimated wait time exceeds N seconds.")
+    parser.add_option("--time-budget", action="append", default=[],
+        metavar="COMMAND:SECONDS",
+        help="Terminate render processes that need longer for a task with this command.")
+    parser.add_option("--cache-time-budget", action="append", default=[],
+        metavar="CACHE:SECONDS",
+        help="Time budget for tile tasks of this cache.")
+    parser.add_option("--max-retries", default=1, type=int,
+        help="Requeue tasks of terminated render processes this many times.")
+    parser.add_option("--journal", metavar="FILE",
+        help="Journal file for background tasks.")
+    parser.add_option("--broker-shards", default=1, type=int,
+        help="Number of broker threads in this process. Tasks are "
+            "distributed by their cache, each broker gets its share of the "
+            "renderers and of --max-seed-renderer. Does not scale beyond "
+            "one CPU core.")
+    parser.add_option("--http-keepalive", default=0, type=int, metavar="N",
+        help="Number of idle upstream connections per host and renderer "
+            "that are kept open, e.g. 4. Disabled by default.")
+    parser.add_option("--tile-buffer", default=0, type=int, metavar="MB",
+        help="Size of the shared memory for render_tiles results, e.g. 64. "
+            "render_tiles is disabled by default.")
+    parser.add_option("--event-server", action="store_true", default=False,
+        help="Handle all connections in a single event loop, instead of "
+            "one server thread for each waiting request.")
+    parser.add_option("--unix-socket", metavar="PATH",
+        help="Also listen on this Unix socket for local clients other than "
+            "MapProxy, MapProxy always connects to the TCP address.")
+    parser.add_option("--unix-socket-mode", metavar="MODE",
+        help="Permissions of the Unix socket, e.g. 660.")
+    parser.add_option("--listen-backlog", default=256, type=int, metavar="N",
+        help="Size of the queue for new connections.")
+    parser.add_option("--recent-results-ttl", default=0, type=float, metavar="SECONDS",
+        help="Answer new tasks with the result of identical tasks that "
+            "finished within this time, e.g. 2. Disabled by default.")
+    parser.add_option("--recent-results-size", default=10000, type=int, metavar="N",
+        help="Maximum number of recent results.")
+    parser.add_option("--job-ttl", default=300, type=float, metavar="SECONDS",
+        help="Keep the results of finished jobs this long.")
+    parser.add_option("--max-jobs", default=10000, type=int, metavar="N",
+        help="Maximum number of pending and finished jobs.")
     parser.add_option("--pidfile")
     parser.add_option("--log-config", dest="log_config_file")
     parser.add_option("--verbose", action="store_true", default=False)
@@ -72,8 +162,17 @@ def main():
     if not broker_address:
         fatal('mapproxy config (%s) does not define renderd address' % (
             options.conf_file))
-    broker_address = broker_address.replace('localhost', '127.0.0.1')
-    broker_port = int(broker_address.rsplit(':', 1)[1]) # TODO
+    bind_addrs = [parse_renderd_address(broker_address)]
+    if options.unix_socket:
+        bind_addrs.append(options.unix_socket)
+
+    socket_mode = None
+    if options.unix_socket_mode:
+        try:
+            socket_mode = int(options.unix_socket_mode, 8)
+        except ValueError:
+            fatal('invalid --unix-socket-mode %r, expected octal mode like 660'
+                % options.unix_socket_mode)
 
     tile_managers = {}
     with conf:
@@ -82,6 +181,9 @@ def main():
                 tile_manager._expire_timestamp = 2**32 # future ~2106
                 tile_managers[tile_manager.identifier] = tile_manager
 
+    if options.renderer_threads < 1:
+        fatal('--renderer-threads needs to be 1 or more')
+
     if options.renderer is None:
         pool_size = multiprocessing.cpu_count()
     else:
@@ -96,13 +198,80 @@ def main():
     log.debug('starting %d processes with the following min priorities: %r',
         pool_size, process_priorities)
 
-    def worker_factory(in_queue, out_queue):
+    def worker_factory(in_queue, out_queue, tile_buffer=None):
         return SeedWorker(tile_managers, conf.base_config,
+            http_max_idle=options.http_keepalive,
+            tile_buffer=tile_buffer,
+            threads=options.renderer_threads,
             in_queue=in_queue,
             out_queue=out_queue)
 
-    worker_pool = WorkerPool(worker_factory, pool_size=pool_size)
-    task_queue = RenderQueue(process_priorities)
+    max_waiting_per_priority = {}
+    for limit in options.max_waiting_priority:
+        try:
+            priority, num = limit.split(':')
+            max_waiting_per_priority[int(priority)] = int(num)
+        except ValueError:
+            fatal('invalid --max-waiting-priority %r, expected PRIORITY:N' % limit)
+    time_budgets = TimeBudgets(
+        commands=parse_time_budgets(options.time_budget, '--time-budget'),
+        caches=parse_time_budgets(options.cache_time_budget, '--cache-time-budget'),
+    )
+
+    admission = AdmissionControl(
+        max_waiting=options.max_waiting,
+        max_waiting_per_priority=max_waiting_per_priority,
+        max_wait_time=options.max_wait_time,
+    )
+
+    # each shard needs at least one process for the lowest priority
+    num_shards = options.broker_shards
+    max_shards = process_priorities.count(min(process_priorities))
+    if not 1 <= num_shards <= max_shards:
+        fatal('--broker-shards needs to be between 1 and %d' % max_shards)
+
+    max_rss = None
+    if options.renderer_max_memory:
+        max_rss = options.renderer_max_memory * 1024 * 1024
+
+    brokers = []
+    for shard, shard_priorities in enumerate(
+        split_process_priorities(process_priorities, num_shards)):
+        # each shard gets its own part of the tile buffer, the buffer
+        # needs to exist before the render processes are started
+        tile_buffer = None
+        if options.tile_buffer > 0:
+            tile_buffer = TileBuffer(options.tile_buffer * 1024 * 1024 // num_shards)
+        worker_pool = WorkerPool(
+            functools.partial(worker_factory, tile_buffer=tile_buffer),
+            pool_size=len(shard_priorities),
+            slots=options.renderer_threads,
+            max_tasks=options.renderer_max_tasks,
+            max_rss=max_rss,
+            use_fork_server=options.fork_server)
+        # the queue counts task slots, each thread of a process gets
+        # the min priority of the process
+        slot_priorities = [p for p in shard_priorities
+            for _ in xrange(options.renderer_threads)]
+        task_queue = RenderQueue(slot_priorities,
+            aging_interval=options.priority_aging_interval,
+            aging_step=options.priority_aging_step,
+            aging_max_priority=options.priority_aging_max,
+        )
+        journal = None
+        if options.journal:
+            journal_file = options.journal
+            if num_shards > 1:
+                journal_file = '%s.%d' % (journal_file, shard)
+            journal = TaskJournal(journal_file)
+        recent_results = None
+        if options.recent_results_ttl > 0:
+            recent_results = RecentResults(ttl=options.recent_results_ttl,
+                max_size=options.recent_results_size)
+        brokers.append(Broker(worker_pool, task_queue, batch_size=options.batch_size,
+            admission=admission, journal=journal, time_budgets=time_budgets,
+            max_retries=options.max_retries, tile_buffer=tile_buffer,
+            recent_results=recent_results))
 
     if options.pidfile:
         with open(options.pidfile, 'w') as f:
@@ -111,22 +280,42 @@ def main():
             os.unlink(options.pidfile)
         atexit.register(remove_pid)
 
+    servers = []
     try:
-        broker = Broker(worker_pool, task_queue)
+        if num_shards == 1:
+            broker = brokers[0]
+        else:
+            broker = ShardedBroker(brokers)
         broker.start()
 
-        app = RenderdApp(broker)
+        app = RenderdApp(broker,
+            jobs=JobStore(ttl=options.job_ttl, max_jobs=options.max_jobs))
 
-        server = CherryPyWSGIServer(
-                ('127.0.0.1', broker_port), app,
-                numthreads=64,
-                request_queue_size=256,
-        )
-        server.start()
+        for bind_addr in bind_addrs:
+            if options.event_server:
+                server = EventServer(bind_addr, app,
+                    backlog=options.listen_backlog,
+                    socket_mode=socket_mode,
+                )
+            else:
+                server = RenderdWSGIServer(
+                        bind_addr, app,
+                        socket_mode=socket_mode,
+                        numthreads=64,
+                        request_queue_size=options.listen_backlog,
+                )
+            servers.append(server)
+
+        # one server for each address, the first runs in the main thread
+        for server in servers[1:]:
+            t = threading.Thread(target=server.start)
+            t.daemon = True
+            t.start()
+        servers[0].start()
 
     except (KeyboardInterrupt, SystemExit):
         print >>sys.stderr, 'exiting...'
-        if server:
+        for server in servers:
             server.stop()
         return 0
     except Exception:
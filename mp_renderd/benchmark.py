@@ -0,0 +1,159 @@
+# This file is part of the MapProxy project.
+# Copyright (C) 2013 Omniscale GmbH & Co. KG <http://omniscale.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Latency benchmark for small JSON requests to renderd over TCP and
+Unix sockets::
+
+    python -m mp_renderd.benchmark --requests 5000
+
+The server answers all requests with an echo broker without render
+processes, so only the transport and the HTTP handling are measured.
+MapProxy itself always connects over TCP, the Unix socket results only
+apply to other clients of ``--unix-socket``.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import httplib
+import optparse
+import tempfile
+import threading
+
+from mp_renderd.wsgi import RenderdApp, RenderdWSGIServer
+from mp_renderd.eventserver import EventServer
+from mp_renderd.task import Task
+
+class EchoBroker(object):
+    """
+    Broker that returns the results immediately.
+    """
+    def admit(self, task):
+        return None
+
+    def dispatch(self, task, response_queue=None, client_connected=None):
+        result = Task(task.id, {'status': 'ok'})
+        if response_queue is None:
+            return result
+        response_queue.put(result)
+
+    def status(self):
+        return {'running': 0, 'waiting': 0, 'worker': 0}
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, path, timeout=10):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+def tcp_connection(bind_addr):
+    return httplib.HTTPConnection(bind_addr[0], bind_addr[1], timeout=10)
+
+def unix_connection(bind_addr):
+    return UnixHTTPConnection(bind_addr)
+
+def start_server(server_type, bind_addr):
+    app = RenderdApp(EchoBroker())
+    if server_type == 'event':
+        server = EventServer(bind_addr, app)
+        server.bind()
+        bind_addr = server.bind_addr
+    else:
+        if not isinstance(bind_addr, basestring):
+            # CherryPy does not report the port it bound to
+            s = socket.socket()
+            s.bind(bind_addr)
+            bind_addr = s.getsockname()
+            s.close()
+        server = RenderdWSGIServer(bind_addr, app, numthreads=16)
+    t = threading.Thread(target=server.start)
+    t.daemon = True
+    t.start()
+    while not server.ready:
+        time.sleep(0.01)
+    return server, bind_addr
+
+def measure(connect, num_requests, keep_alive):
+    """
+    Send `num_requests` and return the latencies in seconds. Opens a
+    new connection for each request if `keep_alive` is ``False``.
+    """
+    body = json.dumps({'command': 'tile', 'cache_identifier': 'osm',
+        'tiles': [[0, 0, 1]], 'priority': 100})
+    latencies = []
+    conn = None
+    for _ in xrange(num_requests):
+        start = time.time()
+        if conn is None:
+            conn = connect()
+        conn.request('POST', '/', body)
+        resp = conn.getresponse()
+        resp.read()
+        if not keep_alive:
+            conn.close()
+            conn = None
+        latencies.append(time.time() - start)
+    if conn is not None:
+        conn.close()
+    return latencies
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--requests", default=2000, type=int,
+        help="Number of requests for each measurement.")
+    parser.add_option("--server", default="threaded", choices=["threaded", "event"],
+        help="threaded (CherryPy, default) or event.")
+    options, args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    transports = [
+        ('tcp', ('127.0.0.1', 0), tcp_connection),
+        ('unix', os.path.join(tmp_dir, 'renderd.sock'), unix_connection),
+    ]
+    print '%-6s %-12s %10s %10s %10s' % ('', 'connection', 'median ms', 'p99 ms', 'req/s')
+    try:
+        for name, bind_addr, connection in transports:
+            server, bind_addr = start_server(options.server, bind_addr)
+            connect = lambda: connection(bind_addr)
+            # warm up
+            measure(connect, 100, True)
+            for keep_alive in (True, False):
+                start = time.time()
+                latencies = measure(connect, options.requests, keep_alive)
+                duration = time.time() - start
+                print '%-6s %-12s %10.3f %10.3f %10.0f' % (name,
+                    'keep-alive' if keep_alive else 'new',
+                    percentile(latencies, 0.5) * 1000,
+                    percentile(latencies, 0.99) * 1000,
+                    len(latencies) / duration)
+            server.stop()
+    finally:
+        for f in os.listdir(tmp_dir):
+            os.unlink(os.path.join(tmp_dir, f))
+        os.rmdir(tmp_dir)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,91 +14,525 @@
 # limitations under the License.
 
 import time
+import zlib
 import Queue
 import threading
 
-from mp_renderd.queue import fan_in_queue
+from mp_renderd.queue import WakeupQueue, wait_readable, drain_connection
+from mp_renderd.task import Task
+from mp_renderd.admission import AdmissionControl
+from mp_renderd.watchdog import TimeBudgets
+from mp_renderd.tilebuffer import TileData
+from mp_renderd.metrics import BrokerMetrics, exposition
 
 import logging
 log = logging.getLogger(__name__)
 
 STOP_BROKER = '696054488d18402b9155a531e0a31714'
 
+def expired_result(task, reason):
+    """
+    Return a result for `task` that was not rendered since nobody
+    waits for it anymore.
+    """
+    return error_result(task, 'expired', 'task %s expired: %s' % (task.id, reason))
+
+def error_result(task, status, error_message):
+    """
+    Return a result for `task` that was not rendered by a worker.
+    """
+    doc = {
+        'status': status,
+        'error_message': error_message,
+    }
+    result = Task(task.id, doc, priority=task.priority)
+    result.key = task.key
+    return result
+
 class Broker(threading.Thread):
     check_interval = 30
+    # how often (in seconds) dispatch checks if the client is still connected
+    client_check_interval = 1
 
-    def __init__(self, worker, render_queue):
+    def __init__(self, worker, render_queue, batch_size=1, admission=None,
+        journal=None, time_budgets=None, max_retries=1, tile_buffer=None,
+        recent_results=None):
         threading.Thread.__init__(self)
         self.daemon = True
-        self.task_in_queue = Queue.Queue()
+        self.task_in_queue = WakeupQueue()
         self.render_queue = render_queue
 
         self.response_queues = {}
         self.worker = worker
-        self.result_queue = self.worker.result_queue
+        # max number of tile tasks for the same cache in one worker message
+        self.batch_size = batch_size
+        if admission is None:
+            admission = AdmissionControl()
+        self.admission = admission
+        # request_id of the (first) dispatched task ->
+        # (worker_id, dispatched tasks, dispatch time, budget deadline)
+        self.in_flight = {}
+        # TaskJournal for background tasks
+        self.journal = journal
+        if time_budgets is None:
+            time_budgets = TimeBudgets()
+        self.time_budgets = time_budgets
+        # how often a task is requeued after its worker failed
+        self.max_retries = max_retries
+        # TileBuffer of the workers for render_tiles results
+        self.tile_buffer = tile_buffer
+        # RecentResults for new tasks that are identical to finished tasks
+        self.recent_results = recent_results
+        self.metrics = BrokerMetrics(render_queue.running_tasks.process_min_priorities)
 
-        self.read_queue = fan_in_queue([self.result_queue, self.task_in_queue])
+    def admit(self, task, shards=None):
+        """
+        Return ``None`` if `task` should be dispatched or the reason
+        why it is rejected. `shards` are the brokers of a
+        `ShardedBroker`, the waiting tasks of all brokers that share
+        the admission control count for its limits.
+        """
+        queues = None
+        if shards is not None:
+            queues = [(b.render_queue, len(b.task_in_queue)) for b in shards
+                if b.admission is self.admission]
+        return self.admission.check(task, self.render_queue,
+            incoming=len(self.task_in_queue), shards=queues)
 
-    def dispatch(self, task, response_queue=None):
+    def dispatch(self, task, response_queue=None, client_connected=None):
+        """
+        Dispatch `task` and return the result. Returns immediately and
+        puts the result into `response_queue` if that is set.
+
+        Stops waiting when the ``task.deadline`` is reached or when the
+        `client_connected` callable returns ``False`` and returns a
+        result with the status ``expired``. The broker drops abandoned
+        tasks instead of rendering them.
+        """
         if response_queue is None:
             q = Queue.Queue()
             self.task_in_queue.put((task, q))
-            return q.get()
+            if task.deadline is None and client_connected is None:
+                return q.get()
+            return self._wait_for_result(task, q, client_connected)
         else:
             self.task_in_queue.put((task, response_queue))
 
+    def _wait_for_result(self, task, q, client_connected):
+        while True:
+            timeout = self.client_check_interval
+            if task.deadline is not None:
+                timeout = max(0, min(timeout, task.deadline - time.time()))
+            try:
+                return q.get(timeout=timeout)
+            except Queue.Empty:
+                pass
+
+            if task.deadline is not None and time.time() >= task.deadline:
+                reason = 'deadline exceeded'
+            elif client_connected is not None and not client_connected():
+                reason = 'client disconnected'
+            else:
+                continue
+            task.cancelled = True
+            return expired_result(task, reason)
+
     def dispatch_background(self, task):
         self.task_in_queue.put((task, None))
 
+    def status(self):
+        """
+        Return a dict with the number of running and waiting tasks and
+        the number of worker processes.
+        """
+        return {
+            'running': self.render_queue.running,
+            'waiting': self.render_queue.waiting,
+            'worker': self.worker.pool_size,
+        }
+
+    def metrics_text(self):
+        """
+        Return the metrics of this broker in the Prometheus text format.
+        """
+        return exposition([self])
+
     def shutdown(self):
         self.task_in_queue.put(STOP_BROKER)
 
+    def replay_journal(self):
+        """
+        Queue all outstanding background tasks from the journal.
+        """
+        tasks = self.journal.open()
+        if tasks:
+            log.info('replaying %d background tasks from journal %s',
+                len(tasks), self.journal.filename)
+        now = time.time()
+        for task in tasks:
+            task.stamp('enqueued', now)
+            self.response_queues[task.request_id] = None
+            self.render_queue.add(task)
+
     def run(self):
+        if self.journal:
+            self.replay_journal()
+            self.distribute_tasks()
+
         shutdown = False
         next_check = time.time() + self.check_interval
         while True:
             if next_check < time.time():
-                self.worker.check_processes()
+                # dead workers can leave results in their pipes
+                self.handle_worker_results(self.worker.result_connections())
+                dead = self.worker.check_processes()
+                self.release_orphaned_tile_data()
+                for worker_id in dead:
+                    self.recover_tasks(worker_id, 'error', 'worker died')
                 next_check = time.time() + self.check_interval
 
-            try:
-                src, data = self.read_queue.get(timeout=10)
-            except Queue.Empty:
+            timeout = 10
+            if self.journal:
+                commit_timeout = self.journal.commit_timeout()
+                if commit_timeout is not None:
+                    timeout = min(timeout, commit_timeout)
+            next_deadline = self.next_budget_deadline()
+            if next_deadline is not None:
+                timeout = max(0, min(timeout, next_deadline - time.time()))
+
+            # wait directly on the result pipes of the workers, on the
+            # wakeup pipe of the task_in_queue and on the sentinels of
+            # the workers, no forwarder threads involved
+            sentinels = self.worker.sentinels()
+            result_conns = self.worker.result_connections()
+            readable = wait_readable([self.task_in_queue] + result_conns
+                + sentinels.keys(), timeout=timeout)
+            if not readable:
+                if self.check_budgets():
+                    self.distribute_tasks()
+                if self.journal:
+                    self.journal.commit()
                 continue
 
             # new tasks
-            if src == self.task_in_queue:
-                if data == STOP_BROKER:
-                    shutdown = True
-                else:
-                    task, resp_queue = data
-                    log.debug('new task (prio: %s): %s %s ', task.priority, task.id, task.doc)
-                    self.response_queues[task.request_id] = resp_queue
-                    self.render_queue.add(task)
+            if self.task_in_queue in readable:
+                for data in self.task_in_queue.get_all():
+                    if data == STOP_BROKER:
+                        shutdown = True
+                    else:
+                        task, resp_queue = data
+                        task.stamp('enqueued')
+                        log.debug('new task (prio: %s): %s %s ', task.priority, task.id, task.doc)
+                        if self.answer_from_recent_results(task, resp_queue):
+                            continue
+                        self.response_queues[task.request_id] = resp_queue
+                        if resp_queue is None and self.journal:
+                            self.journal.add(task)
+                        self.render_queue.add(task)
 
             # results from workers
-            elif src == self.result_queue:
-                log.debug('result from %s (prio: %s): %s %s', data.worker_id, data.priority, data.id, data.doc)
-                self.worker.put(data.worker_id)
-                orig_requests = self.render_queue.remove(data.id)
-                for req in orig_requests:
-                    response_queue = self.response_queues.pop(req.request_id)
-                    if response_queue:
-                        response_queue.put(data)
-
-            while True:
-                # distribute tasks to workers
-                if self.render_queue.has_new_tasks() and self.worker.is_available():
-                    task = self.render_queue.next()
-                    if self.render_queue.already_running(task):
-                        log.info('task %s already running - running: %d - waiting: %d',
-                            task.id, self.render_queue.running, self.render_queue.waiting)
-                        continue
-                    log.info('distributing task %s (prio: %s) - running: %d - waiting: %d',
-                        task.id, task.priority, self.render_queue.running, self.render_queue.waiting)
-                    w = self.worker.get()
-                    w.dispatch(task)
-                break
+            self.handle_worker_results([c for c in result_conns if c in readable])
+
+            # after the results, a worker can send its last result
+            # before it dies
+            for fd in readable:
+                if isinstance(fd, int):
+                    self.handle_dead_worker(sentinels[fd])
+
+            self.check_budgets()
+            self.distribute_tasks()
+
+            if self.journal:
+                self.journal.commit()
 
             if not self.render_queue.running and not self.render_queue.has_new_tasks() and shutdown:
                 break
+
+        if self.journal:
+            self.journal.close()
+
+    def answer_from_recent_results(self, task, response_queue):
+        """
+        Answer `task` with the result of an identical task that finished
+        recently. Returns ``False`` if there is no such result.
+        """
+        if self.recent_results is None:
+            return False
+        result = self.recent_results.get(task)
+        if result is None:
+            return False
+        log.info('task %s answered with a recent result', task.id)
+        self.metrics.record_result(result, [task])
+        if response_queue is not None:
+            response_queue.put(result)
+        return True
+
+    def handle_worker_results(self, conns):
+        """
+        Handle the results in the result pipes `conns` of the workers.
+        """
+        # the results are not referenced after this method returns,
+        # their tile data is released when the requesters are done
+        for conn in conns:
+            for data in drain_connection(conn):
+                now = time.time()
+                if isinstance(data, list):
+                    # batch of results from one worker
+                    for result in data:
+                        result.stamp('result_received', now)
+                        self.claim_tile_data(result)
+                    if not self.release_worker(data[0], len(data)):
+                        continue
+                    for result in data:
+                        self.handle_result(result)
+                else:
+                    data.stamp('result_received', now)
+                    self.claim_tile_data(data)
+                    if not self.release_worker(data):
+                        continue
+                    self.handle_result(data)
+
+    def distribute_tasks(self):
+        """
+        Distribute new tasks to the available workers. A single wakeup
+        can bring multiple new tasks and results.
+        """
+        while self.render_queue.has_new_tasks() and self.worker.is_available():
+            task = self.render_queue.next()
+            if self.render_queue.is_abandoned(task):
+                log.info('dropping abandoned task %s (prio: %s) - running: %d - waiting: %d',
+                    task.id, task.priority, self.render_queue.running, self.render_queue.waiting)
+                self.handle_result(expired_result(task, 'abandoned before it was rendered'))
+                continue
+            if self.render_queue.already_running(task):
+                log.info('task %s already running - running: %d - waiting: %d',
+                    task.id, self.render_queue.running, self.render_queue.waiting)
+                continue
+            log.info('distributing task %s (prio: %s) - running: %d - waiting: %d',
+                task.id, task.priority, self.render_queue.running, self.render_queue.waiting)
+            batch = []
+            if self.batch_size > 1:
+                for batch_task in self.render_queue.next_batch(task, self.batch_size - 1):
+                    if self.render_queue.is_abandoned(batch_task):
+                        log.info('dropping abandoned task %s from the batch of task %s',
+                            batch_task.id, task.id)
+                        self.handle_result(expired_result(batch_task,
+                            'abandoned before it was rendered'))
+                        continue
+                    batch.append(batch_task)
+            cache_identifier = None
+            if isinstance(task.doc, dict):
+                cache_identifier = task.doc.get('cache_identifier')
+            w = self.worker.get(cache_identifier)
+            now = time.time()
+            for t in [task] + batch:
+                t.stamp('dispatched', now)
+            self.in_flight[task.request_id] = (w.id, [task] + batch, now,
+                self.time_budgets.deadline([task] + batch, now))
+            if batch:
+                log.info('batched %d tasks with task %s', len(batch), task.id)
+                w.dispatch_batch([task] + batch)
+            else:
+                w.dispatch(task)
+
+    def release_worker(self, result, num_tasks=1):
+        """
+        Free the task slot of the worker that returned `result` (the
+        first result of a batch with `num_tasks`). Returns ``False`` for
+        results of tasks that were already recovered from a terminated
+        worker.
+        """
+        in_flight = self.in_flight.get(result.request_id)
+        if in_flight is None or in_flight[0] != result.worker_id:
+            log.warn('ignoring result of recovered task %s from worker %s',
+                result.id, result.worker_id)
+            return False
+        del self.in_flight[result.request_id]
+        self.worker.put(result.worker_id, rss=result.worker_rss)
+        self.admission.record_task_time((time.time() - in_flight[2]) / num_tasks)
+        return True
+
+    def next_budget_deadline(self):
+        deadlines = [deadline for _, _, _, deadline in self.in_flight.itervalues()
+            if deadline is not None]
+        if not deadlines:
+            return None
+        return min(deadlines)
+
+    def check_budgets(self, now=None):
+        """
+        Terminate workers with tasks that exceeded their time budget and
+        recover their tasks. Returns ``True`` if workers were terminated.
+        """
+        if now is None:
+            now = time.time()
+        exceeded = {}
+        for request_id, (worker_id, _, started, deadline) in self.in_flight.items():
+            if deadline is not None and now >= deadline:
+                exceeded.setdefault(worker_id, set()).add(request_id)
+                log.warn('task %s exceeded its time budget of %.1fs on worker %s',
+                    self.in_flight[request_id][1][0].id, deadline - started, worker_id)
+
+        for worker_id in exceeded:
+            self.worker.kill(worker_id)
+        if exceeded:
+            self.release_orphaned_tile_data()
+        for worker_id, request_ids in exceeded.iteritems():
+            self.recover_tasks(worker_id, 'timeout', 'exceeded time budget',
+                culprits=request_ids)
+        return bool(exceeded)
+
+    def handle_dead_worker(self, worker_id):
+        if worker_id not in self.worker.processes:
+            # already removed, e.g. killed by check_budgets
+            return
+        log.warn('worker %s died', worker_id)
+        # complete results that the worker sent before it died
+        self.handle_worker_results([self.worker.processes[worker_id][1].results])
+        self.worker.remove_dead(worker_id)
+        self.release_orphaned_tile_data()
+        self.recover_tasks(worker_id, 'error', 'worker died')
+
+    def claim_tile_data(self, result):
+        """
+        Take over the tiles that the worker wrote into the tile buffer
+        for `result`. The tiles are released with the result.
+        """
+        if self.tile_buffer is None or not isinstance(result.doc, dict):
+            return
+        tiles = result.doc.get('tile_data')
+        if not tiles:
+            return
+        claimed = [t for t in tiles
+            if self.tile_buffer.claim(t['offset'], result.worker_pid)]
+        result.tile_data = TileData(self.tile_buffer, claimed)
+        if len(claimed) < len(tiles):
+            result.doc = {
+                'status': 'error',
+                'error_message': 'tile data of task %s was released' % result.id,
+            }
+            result.tile_data = None
+
+    def release_orphaned_tile_data(self):
+        """
+        Release the tiles that terminated or dead workers wrote into the
+        tile buffer, but never returned.
+        """
+        if self.tile_buffer is None:
+            return
+        released = self.tile_buffer.release_orphans(self.worker.pids())
+        if released:
+            log.info('released %d orphaned tiles from the tile buffer', released)
+
+    def recover_tasks(self, worker_id, status, reason, culprits=None):
+        """
+        Requeue all tasks that were running on the terminated worker.
+        The tasks of `culprits` (request_ids of dispatched tasks, all by
+        default) count as a retry. They fail with `status` when they
+        have no retries left.
+        """
+        for request_id, in_flight in self.in_flight.items():
+            if in_flight[0] != worker_id:
+                continue
+            del self.in_flight[request_id]
+            failed = culprits is None or request_id in culprits
+            for task in in_flight[1]:
+                self.requeue(task, failed, status, reason)
+
+    def requeue(self, task, failed, status, reason):
+        if failed:
+            if task.retries >= self.max_retries:
+                log.warn('task %s failed after %d retries: %s', task.id, task.retries, reason)
+                self.handle_result(error_result(task, status, 'task %s failed after %d retries: %s' % (
+                    task.id, task.retries, reason)))
+                return
+            task.retries += 1
+        log.info('requeueing task %s (retry %d): %s', task.id, task.retries, reason)
+        self.render_queue.requeue(task.key)
+
+    def handle_result(self, data):
+        log.debug('result from %s (prio: %s): %s %s', data.worker_id, data.priority, data.id, data.doc)
+        orig_requests = self.render_queue.remove(data.key, data)
+        self.metrics.record_result(data, orig_requests)
+        if self.recent_results is not None:
+            for req in orig_requests:
+                # not for tasks with tiles from failed tasks
+                if req.request_id == data.request_id and req.failed_result is None:
+                    self.recent_results.add(req, data)
+        for req in orig_requests:
+            response_queue = self.response_queues.pop(req.request_id)
+            if response_queue:
+                response_queue.put(req.failed_result or data)
+            elif self.journal:
+                self.journal.done(req)
+
+def split_process_priorities(process_priorities, num_shards):
+    """
+    Split the min priorities of all processes into `num_shards` lists,
+    so that each shard gets a fair share of the processes for each
+    priority.
+
+    >>> split_process_priorities([50, 50, 0, 0, 0], 2)
+    [[0, 0, 50], [0, 50]]
+    """
+    assert len(process_priorities) >= num_shards
+    process_priorities = sorted(process_priorities)
+    return [process_priorities[i::num_shards] for i in range(num_shards)]
+
+def shard_key(task):
+    doc = task.doc
+    if isinstance(doc, dict) and doc.get('cache_identifier'):
+        return doc['cache_identifier']
+    return task.id
+
+class ShardedBroker(object):
+    """
+    Distributes tasks to multiple `Broker` threads by the hash of their
+    ``cache_identifier`` (or ``id`` for tasks without a cache). Each
+    broker has its own `RenderQueue` and `WorkerPool`, so that tasks
+    for the same cache are still merged and deduplicated.
+
+    The brokers are threads of one process and share the GIL, so
+    sharding does not add CPU capacity for dispatching. Priority
+    reservations are applied within each shard.
+
+    Offers the same interface as a single `Broker`.
+    """
+    def __init__(self, brokers):
+        self.brokers = brokers
+
+    def broker_for(self, task):
+        key = str(shard_key(task))
+        return self.brokers[(zlib.crc32(key) & 0xffffffff) % len(self.brokers)]
+
+    def start(self):
+        for broker in self.brokers:
+            broker.start()
+
+    def shutdown(self):
+        for broker in self.brokers:
+            broker.shutdown()
+
+    def join(self, timeout=None):
+        for broker in self.brokers:
+            broker.join(timeout)
+
+    def admit(self, task):
+        return self.broker_for(task).admit(task, shards=self.brokers)
+
+    def dispatch(self, task, response_queue=None, client_connected=None):
+        return self.broker_for(task).dispatch(task, response_queue=response_queue,
+            client_connected=client_connected)
+
+    def dispatch_background(self, task):
+        self.broker_for(task).dispatch_background(task)
+
+    def metrics_text(self):
+        return exposition(self.brokers)
+
+    def status(self):
+        status = {'running': 0, 'waiting': 0, 'worker': 0}
+        for broker in self.brokers:
+            for key, value in broker.status().iteritems():
+                status[key] += value
+        return status
@@ -0,0 +1,195 @@
+# This file is part of the MapProxy project.
+# Copyright (C) 2013 Omniscale GmbH & Co. KG <http://omniscale.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+import socket
+import threading
+import urllib2
+import httplib
+
+import logging
+log = logging.getLogger(__name__)
+
+class HTTPConnectionPool(object):
+    """
+    Keep-alive connections for the urllib2 openers of the MapProxy
+    HTTP client.
+
+    `install()` replaces ``do_open`` of the HTTP(S) handlers of an opener,
+    so that requests reuse an idle connection to the same host instead
+    of opening (and closing) a new connection each time. A connection is
+    returned to the pool once its response was read completely.
+
+    :param max_idle: maximum number of idle connections per host
+    """
+    def __init__(self, max_idle=4):
+        self.max_idle = max_idle
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.reused = 0
+        self.connections = 0
+
+    def install(self, opener):
+        for handler in opener.handlers:
+            if isinstance(handler, urllib2.AbstractHTTPHandler):
+                handler.do_open = self._do_open_func(handler)
+
+    def _do_open_func(self, handler):
+        def do_open(http_class, req, **http_conn_args):
+            return self.do_open(handler, http_class, req, **http_conn_args)
+        return do_open
+
+    def reuse_rate(self):
+        """
+        Return the share of requests that reused an idle connection.
+        """
+        if not self.requests:
+            return 0.0
+        return self.reused / float(self.requests)
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'reused': self.reused,
+            'connections': self.connections,
+            'reuse_rate': self.reuse_rate(),
+        }
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.itervalues():
+            for conn in conns:
+                conn.close()
+
+    def _get(self, key):
+        with self.lock:
+            self.requests += 1
+            conns = self.idle.get(key)
+            if conns:
+                self.reused += 1
+                return conns.pop()
+            self.connections += 1
+        return None
+
+    def _release(self, key, conn, complete):
+        if not complete:
+            conn.close()
+            return
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def do_open(self, handler, http_class, req, **http_conn_args):
+        """
+        Replacement for ``AbstractHTTPHandler.do_open`` that takes the
+        connection from the pool. Requests on a reused connection are
+        retried once with a new connection, as the server may have closed
+        the idle connection in the meantime.
+        """
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers['Connection'] = 'keep-alive'
+        headers = dict(
+            (name.title(), val) for name, val in headers.items())
+
+        tunnel_headers = None
+        if req._tunnel_host:
+            tunnel_headers = {}
+            proxy_auth_hdr = 'Proxy-Authorization'
+            if proxy_auth_hdr in headers:
+                tunnel_headers[proxy_auth_hdr] = headers.pop(proxy_auth_hdr)
+
+        key = (handler, host, req._tunnel_host)
+        conn = self._get(key)
+        reused = conn is not None
+        while True:
+            if conn is None:
+                conn = http_class(host, timeout=req.timeout, **http_conn_args)
+                conn.response_class = _PooledResponse
+                conn.set_debuglevel(handler._debuglevel)
+                if tunnel_headers is not None:
+                    conn.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+            else:
+                conn.timeout = req.timeout
+                if conn.sock is not None:
+                    timeout = req.timeout
+                    if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+                        timeout = socket.getdefaulttimeout()
+                    conn.sock.settimeout(timeout)
+            try:
+                conn.request(req.get_method(), req.get_selector(), req.data, headers)
+                r = conn.getresponse(buffering=True)
+            except (socket.error, httplib.HTTPException), err:
+                conn.close()
+                if reused:
+                    log.debug('reused connection to %s failed, retrying: %s', host, err)
+                    conn = None
+                    reused = False
+                    with self.lock:
+                        self.connections += 1
+                    continue
+                raise urllib2.URLError(err)
+            break
+
+        if not r.will_close:
+            r.release = functools.partial(self._release, key, conn)
+
+        # see AbstractHTTPHandler.do_open
+        r.recv = r.read
+        fp = socket._fileobject(r, close=True)
+
+        resp = urllib2.addinfourl(fp, r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
+
+class _PooledResponse(httplib.HTTPResponse):
+    """
+    HTTPResponse that calls `release` once it is closed, with
+    ``complete=True`` if the response was read completely. Otherwise the
+    connection is not in a usable state anymore.
+    """
+    release = None
+    _reading = False
+
+    def read(self, amt=None):
+        self._reading = True
+        try:
+            data = httplib.HTTPResponse.read(self, amt)
+        finally:
+            self._reading = False
+        if self.isclosed():
+            self._finish(complete=True)
+        return data
+
+    def close(self):
+        httplib.HTTPResponse.close(self)
+        if not self._reading:
+            self._finish(complete=False)
+
+    def _finish(self, complete):
+        release, self.release = self.release, None
+        if release:
+            release(complete)
@@ -0,0 +1,653 @@
+# This file is part of the MapProxy project.
+# Copyright (C) 2013 Omniscale GmbH & Co. KG <http://omniscale.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import json
+import errno
+import heapq
+import select
+import socket
+import collections
+from cStringIO import StringIO
+
+from mp_renderd.queue import WakeupQueue
+from mp_renderd.broker import expired_result
+from mp_renderd.wsgi import (Request, exception_response, overload_doc,
+    parse_task_doc, parse_batch, batch_line)
+from mapproxy.response import Response
+
+import logging
+log = logging.getLogger(__name__)
+
+READ = select.POLLIN | select.POLLPRI
+WRITE = select.POLLOUT
+ERROR = select.POLLERR | select.POLLHUP
+
+MAX_HEADER_SIZE = 64 * 1024
+MAX_CHUNK_LINE_SIZE = 1024
+MAX_BODY_SIZE = 16 * 1024 * 1024
+
+class RequestTooLarge(Exception):
+    pass
+
+class EventServer(object):
+    """
+    HTTP server for `RenderdApp` that handles all connections in a
+    single event loop.
+
+    Requests for tasks do not block a thread while they wait for the
+    result. The task is dispatched with a `ResultFuture` as response
+    queue and the broker thread wakes up the event loop when the result
+    is ready. Batch requests stream the results as chunked NDJSON, like
+    ``RenderdApp.do_batch``. The other endpoints are called as WSGI
+    application, with ``mp_renderd.event_loop`` set in the environ so
+    that they never block the loop. Requests for pending jobs with a
+    ``wait`` are answered when the job is done.
+
+    Request bodies are read completely before the request is handled,
+    with ``Content-Length`` or ``Transfer-Encoding: chunked``.
+
+    :param bind_addr: ``(host, port)`` tuple or the path of a Unix socket
+    :param app: `RenderdApp`
+    :param backlog: size of the listen queue
+    :param keepalive_timeout: close idle keep-alive connections after
+        this many seconds
+    :param socket_mode: permissions of the Unix socket, e.g. ``0660``
+    :param max_body_size: answer requests with larger bodies with 413
+    """
+    def __init__(self, bind_addr, app, backlog=1024, keepalive_timeout=60,
+        socket_mode=None, max_body_size=MAX_BODY_SIZE):
+        self.bind_addr = bind_addr
+        self.app = app
+        self.backlog = backlog
+        self.socket_mode = socket_mode
+        self.keepalive_timeout = keepalive_timeout
+        self.max_body_size = max_body_size
+        self.results = WakeupQueue()
+        self.connections = {}
+        self.socket = None
+        self.ready = False
+        # (deadline, connection, future) of requests with a timeout
+        self._deadlines = []
+        # (deadline, connection) with one entry for each connection,
+        # checked by close_idle_connections
+        self._idle_deadlines = []
+        self._stop = False
+
+    @property
+    def is_unix_socket(self):
+        return isinstance(self.bind_addr, basestring)
+
+    def bind(self):
+        if self.is_unix_socket:
+            # remove the socket of a previous run
+            if os.path.exists(self.bind_addr):
+                os.unlink(self.bind_addr)
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.bind(self.bind_addr)
+            if self.socket_mode is not None:
+                os.chmod(self.bind_addr, self.socket_mode)
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind(self.bind_addr)
+            self.bind_addr = self.socket.getsockname()
+        self.socket.listen(self.backlog)
+        self.socket.setblocking(False)
+
+    def start(self):
+        """
+        Run the event loop until `stop` is called.
+        """
+        if self.socket is None:
+            self.bind()
+        self.poller = _Poller()
+        self.poller.register(self.socket.fileno(), READ)
+        self.poller.register(self.results.fileno(), READ)
+        self.ready = True
+        try:
+            while not self._stop:
+                self.poll()
+        finally:
+            self.ready = False
+            for conn in self.connections.values():
+                self.close(conn)
+            self.socket.close()
+            self.socket = None
+            if self.is_unix_socket:
+                try:
+                    os.unlink(self.bind_addr)
+                except OSError:
+                    pass
+
+    def stop(self):
+        self._stop = True
+        # wake up the event loop
+        self.results.put(None)
+
+    def poll(self):
+        now = time.time()
+        timeout = self.keepalive_timeout
+        if self._deadlines:
+            timeout = max(0, min(timeout, self._deadlines[0][0] - now))
+        if self._idle_deadlines:
+            timeout = max(0, min(timeout, self._idle_deadlines[0][0] - now))
+        for fd, events in self.poller.poll(timeout):
+            if fd == self.socket.fileno():
+                self.accept()
+            elif fd == self.results.fileno():
+                for item in self.results.get_all():
+                    if item is not None:
+                        self.handle_result(*item)
+            else:
+                conn = self.connections.get(fd)
+                if conn is None:
+                    continue
+                if events & (READ | ERROR):
+                    self.handle_read(conn)
+                if events & WRITE and not conn.closed:
+                    self.handle_write(conn)
+        self.check_deadlines()
+        self.close_idle_connections()
+
+    def accept(self):
+        while True:
+            try:
+                sock, _ = self.socket.accept()
+            except socket.error, ex:
+                if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                if ex.args[0] in (errno.EMFILE, errno.ENFILE):
+                    log.warn('too many open connections: %s', ex)
+                    return
+                raise
+            sock.setblocking(False)
+            if not self.is_unix_socket:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = Connection(sock)
+            self.connections[conn.fileno] = conn
+            self.poller.register(conn.fileno, READ)
+            if self.keepalive_timeout:
+                heapq.heappush(self._idle_deadlines,
+                    (conn.last_active + self.keepalive_timeout, conn))
+
+    def handle_read(self, conn):
+        try:
+            data = conn.sock.recv(65536)
+        except socket.error, ex:
+            if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = ''
+        if not data:
+            # client closed the connection
+            if conn.future is not None:
+                conn.future.cancel()
+            self.close(conn)
+            return
+        conn.last_active = time.time()
+        conn.inbuf += data
+        self.handle_requests(conn)
+
+    def handle_requests(self, conn):
+        # one request at a time, pipelined requests stay in inbuf
+        while conn.future is None and not conn.outbuf and not conn.closed:
+            try:
+                request = conn.parse_request(self.max_body_size)
+            except RequestTooLarge:
+                conn.inbuf = ''
+                self.respond_error(conn, 413, 'request entity too large')
+                return
+            if request is None:
+                if (len(conn.inbuf) > MAX_HEADER_SIZE
+                    and conn.inbuf.find('\r\n\r\n', 0, MAX_HEADER_SIZE) < 0):
+                    self.close(conn)
+                return
+            if request is False:
+                self.respond_error(conn, 400, 'bad request')
+                return
+            self.handle_request(conn, request)
+
+    def handle_request(self, conn, request):
+        method, path, version, headers, body = request
+        conn.keep_alive = _keep_alive(version, headers)
+        environ = _environ(method, path, headers, body)
+
+        path = path.split('?', 1)[0]
+        if path == '/batch':
+            self.handle_batch(conn, body, environ)
+            return
+        if path.startswith('/jobs/') and self.wait_for_job(conn, path, environ):
+            return
+        if path != '/':
+            # status and errors are answered immediately
+            environ['mp_renderd.event_loop'] = True
+            status_headers = []
+            def start_response(status, headers, exc_info=None):
+                status_headers[:] = [status, headers]
+            chunks = self.app(environ, start_response)
+            self.respond(conn, status_headers[0], status_headers[1], chunks)
+            return
+
+        try:
+            task, rejected = self.app.new_task(parse_task_doc(body), environ)
+        except Exception, ex:
+            self.respond_response(conn, exception_response(ex), environ)
+            return
+        if rejected:
+            self.respond_response(conn, Response(json.dumps(overload_doc(rejected)),
+                content_type='application/json', status=503), environ)
+            return
+
+        conn.future = self.dispatch(conn, task)
+        conn.environ = environ
+
+    def dispatch(self, conn, task):
+        future = ResultFuture(self.results, conn, task)
+        if task.deadline is not None:
+            heapq.heappush(self._deadlines, (task.deadline, conn, future))
+        self.app.broker.dispatch(task, future)
+        return future
+
+    def wait_for_job(self, conn, path, environ):
+        """
+        Wait in the event loop for the result of a pending job. Returns
+        ``False`` if the request is answered by the application.
+        """
+        try:
+            wait = self.app.job_wait(Request(environ))
+        except ValueError:
+            return False
+        job = self.app.jobs.get(path[len('/jobs/'):])
+        if job is None or not wait:
+            return False
+        waiter = JobWaiter(self.results, conn, job)
+        if not job.add_waiter(waiter.put):
+            # already done
+            return False
+        heapq.heappush(self._deadlines, (time.time() + wait, conn, waiter))
+        conn.future = waiter
+        conn.environ = environ
+        return True
+
+    def handle_batch(self, conn, body, environ):
+        try:
+            docs = parse_batch(body)
+            tasks = [self.app.new_task(doc, environ) for doc in docs]
+        except Exception, ex:
+            self.respond_response(conn, exception_response(ex), environ)
+            return
+
+        self.start_chunked(conn, '200 OK', [('Content-type', 'application/x-ndjson')])
+        batch = Batch()
+        conn.future = batch
+        for index, (task, rejected) in enumerate(tasks):
+            if rejected:
+                self.write_chunk(conn, batch_line(index, task.id, overload_doc(rejected)))
+                continue
+            batch.pending[self.dispatch(conn, task)] = index
+        self.handle_batch_progress(conn)
+
+    def handle_batch_result(self, conn, future, result):
+        index = conn.future.pending.pop(future)
+        self.write_chunk(conn, batch_line(index, future.task.id,
+            self.app.result_doc(future.task, result)))
+        self.handle_batch_progress(conn)
+
+    def handle_batch_progress(self, conn):
+        if not conn.future.pending:
+            conn.future = None
+            self.end_chunked(conn)
+        else:
+            self.handle_write(conn)
+
+    def is_waiting(self, conn, future):
+        """
+        Return ``True`` if `conn` still waits for the result of `future`.
+        """
+        if conn.closed:
+            return False
+        if isinstance(conn.future, Batch):
+            return future in conn.future.pending
+        return conn.future is future
+
+    def handle_result(self, conn, future, result):
+        if not self.is_waiting(conn, future):
+            # client disconnected or deadline exceeded
+            return
+        if isinstance(conn.future, Batch):
+            self.handle_batch_result(conn, future, result)
+            return
+        conn.future = None
+        if isinstance(future, JobWaiter):
+            self.respond_response(conn, self.app.job_response(future.job), conn.environ)
+            conn.environ = None
+            return
+        # the tile data of the result is released with the result,
+        # keep it until all chunks are sent
+        conn.result = result
+        try:
+            resp = self.app.result_response(result, future.task)
+        except Exception, ex:
+            resp = exception_response(ex)
+        self.respond_response(conn, resp, conn.environ)
+        conn.environ = None
+
+    def check_deadlines(self):
+        now = time.time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, conn, future = heapq.heappop(self._deadlines)
+            if self.is_waiting(conn, future):
+                future.cancel()
+                result = None
+                if not isinstance(future, JobWaiter):
+                    result = expired_result(future.task, 'deadline exceeded')
+                self.handle_result(conn, future, result)
+
+    def close_idle_connections(self):
+        """
+        Close connections without activity for `keepalive_timeout`
+        seconds. Busy connections and connections with later activity
+        are checked again at their next possible deadline.
+        """
+        now = time.time()
+        while self._idle_deadlines and self._idle_deadlines[0][0] <= now:
+            _, conn = heapq.heappop(self._idle_deadlines)
+            if conn.closed:
+                continue
+            if conn.future is not None or conn.outbuf:
+                deadline = now + self.keepalive_timeout
+            else:
+                deadline = conn.last_active + self.keepalive_timeout
+                if deadline <= now:
+                    self.close(conn)
+                    continue
+            heapq.heappush(self._idle_deadlines, (deadline, conn))
+
+    def respond_response(self, conn, resp, environ):
+        status_headers = []
+        def start_response(status, headers, exc_info=None):
+            status_headers[:] = [status, headers]
+        chunks = resp(environ, start_response)
+        self.respond(conn, status_headers[0], status_headers[1], chunks)
+
+    def respond_error(self, conn, status, message):
+        conn.keep_alive = False
+        body = '%d %s' % (status, message)
+        self.respond(conn, '%d %s' % (status, message.title()),
+            [('Content-type', 'text/plain')], [body])
+
+    def respond(self, conn, status, headers, chunks):
+        chunks = [c for c in chunks if len(c)]
+        header_names = set(k.lower() for k, _ in headers)
+        if 'content-length' not in header_names:
+            headers = headers + [('Content-length', str(sum(len(c) for c in chunks)))]
+        if not conn.keep_alive:
+            headers = headers + [('Connection', 'close')]
+        head = ['HTTP/1.1 %s\r\n' % status]
+        head.extend('%s: %s\r\n' % (k, v) for k, v in headers)
+        head.append('\r\n')
+        conn.outbuf.append(''.join(head))
+        conn.outbuf.extend(chunks)
+        self.handle_write(conn)
+
+    def start_chunked(self, conn, status, headers):
+        headers = headers + [('Transfer-Encoding', 'chunked')]
+        if not conn.keep_alive:
+            headers = headers + [('Connection', 'close')]
+        head = ['HTTP/1.1 %s\r\n' % status]
+        head.extend('%s: %s\r\n' % (k, v) for k, v in headers)
+        head.append('\r\n')
+        conn.outbuf.append(''.join(head))
+
+    def write_chunk(self, conn, data):
+        conn.outbuf.append('%x\r\n%s\r\n' % (len(data), data))
+
+    def end_chunked(self, conn):
+        conn.outbuf.append('0\r\n\r\n')
+        self.handle_write(conn)
+
+    def handle_write(self, conn):
+        while conn.outbuf:
+            chunk = conn.outbuf[0]
+            try:
+                sent = conn.sock.send(chunk)
+            except socket.error, ex:
+                if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                self.close(conn)
+                return
+            if sent < len(chunk):
+                # buffer() of the rest, without copying tile data
+                conn.outbuf[0] = buffer(chunk, sent)
+                break
+            conn.outbuf.popleft()
+
+        conn.last_active = time.time()
+        if conn.outbuf:
+            self.poller.modify(conn.fileno, READ | WRITE)
+            return
+        conn.result = None
+        self.poller.modify(conn.fileno, READ)
+        if conn.future is not None:
+            # batch with pending results
+            return
+        if not conn.keep_alive:
+            self.close(conn)
+        elif conn.inbuf:
+            self.handle_requests(conn)
+
+    def close(self, conn):
+        if conn.closed:
+            return
+        conn.closed = True
+        del self.connections[conn.fileno]
+        try:
+            self.poller.unregister(conn.fileno)
+        except (KeyError, IOError, ValueError):
+            pass
+        conn.sock.close()
+        conn.outbuf.clear()
+        conn.result = None
+
+class ResultFuture(object):
+    """
+    Response queue for a single task. `put` is called by the broker
+    thread and passes the result to the event loop.
+    """
+    def __init__(self, results, conn, task):
+        self.results = results
+        self.conn = conn
+        self.task = task
+
+    def put(self, result):
+        self.results.put((self.conn, self, result))
+
+    def cancel(self):
+        # the broker drops the task if it is not running
+        self.task.cancelled = True
+
+class JobWaiter(object):
+    """
+    Request that waits for the result of a job. `put` is called by the
+    broker thread when the job is done and wakes up the event loop.
+    """
+    def __init__(self, results, conn, job):
+        self.results = results
+        self.conn = conn
+        self.job = job
+
+    def put(self, job):
+        self.results.put((self.conn, self, None))
+
+    def cancel(self):
+        self.job.remove_waiter(self.put)
+
+class Batch(object):
+    """
+    Pending tasks of a batch request.
+    """
+    def __init__(self):
+        # ResultFuture -> index of the task in the batch
+        self.pending = {}
+
+    def cancel(self):
+        for future in self.pending:
+            future.cancel()
+
+class Connection(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.fileno = sock.fileno()
+        self.inbuf = ''
+        self.outbuf = collections.deque()
+        self.keep_alive = True
+        self.closed = False
+        self.future = None
+        self.environ = None
+        self.result = None
+        self.last_active = time.time()
+
+    def parse_request(self, max_body_size=None):
+        """
+        Return the next complete request from `inbuf` as
+        ``(method, path, version, headers, body)``. Returns ``None``
+        if the request is incomplete and ``False`` if it is invalid.
+        Raises `RequestTooLarge` if the body exceeds `max_body_size`.
+        Chunked bodies are returned decoded.
+        """
+        end = self.inbuf.find('\r\n\r\n')
+        if end < 0:
+            return None
+        lines = self.inbuf[:end].split('\r\n')
+        try:
+            method, path, version = lines[0].split(' ', 2)
+            headers = {}
+            for line in lines[1:]:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            return False
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            body = _chunked_body(self.inbuf, end + 4, max_body_size)
+            if not body:
+                return body
+            body, body_end = body
+            self.inbuf = self.inbuf[body_end:]
+            return method, path, version, headers, body
+        if max_body_size is not None and length > max_body_size:
+            raise RequestTooLarge()
+        if len(self.inbuf) < end + 4 + length:
+            return None
+        body = self.inbuf[end + 4:end + 4 + length]
+        self.inbuf = self.inbuf[end + 4 + length:]
+        return method, path, version, headers, body
+
+def _chunked_body(data, pos, max_body_size=None):
+    """
+    Decode the chunked body in `data` that starts at `pos`. Returns
+    ``(body, end)``, ``None`` if the body is incomplete and ``False``
+    if it is invalid. Raises `RequestTooLarge` if the body exceeds
+    `max_body_size`.
+    """
+    chunks = []
+    size = 0
+    while True:
+        line_end = data.find('\r\n', pos)
+        if line_end < 0:
+            if len(data) - pos > MAX_CHUNK_LINE_SIZE:
+                return False
+            return None
+        try:
+            length = int(data[pos:line_end].split(';', 1)[0].strip(), 16)
+        except ValueError:
+            return False
+        if length < 0:
+            return False
+        size += length
+        if max_body_size is not None and size > max_body_size:
+            raise RequestTooLarge()
+        pos = line_end + 2
+        if length == 0:
+            break
+        if len(data) < pos + length + 2:
+            return None
+        if data[pos + length:pos + length + 2] != '\r\n':
+            return False
+        chunks.append(data[pos:pos + length])
+        pos += length + 2
+    # optional trailer fields, terminated by an empty line
+    end = data.find('\r\n\r\n', pos - 2)
+    if end < 0:
+        if len(data) - pos > MAX_HEADER_SIZE:
+            return False
+        return None
+    return ''.join(chunks), end + 4
+
+def _keep_alive(version, headers):
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.0':
+        return connection == 'keep-alive'
+    return connection != 'close'
+
+def _environ(method, path, headers, body):
+    path, _, query = path.partition('?')
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'CONTENT_LENGTH': str(len(body)),
+        'CONTENT_TYPE': headers.get('content-type', ''),
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '0',
+        'wsgi.input': StringIO(body),
+        'wsgi.url_scheme': 'http',
+    }
+    for name, value in headers.iteritems():
+        if name in ('content-length', 'content-type'):
+            continue
+        environ['HTTP_' + name.upper().replace('-', '_')] = value
+    return environ
+
+class _Poller(object):
+    """
+    ``select.epoll`` or ``select.poll`` with a timeout in seconds.
+    """
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._poll = select.epoll()
+            self._scale = 1
+        else:
+            self._poll = select.poll()
+            self._scale = 1000
+
+    def register(self, fd, events):
+        self._poll.register(fd, events)
+
+    def modify(self, fd, events):
+        self._poll.modify(fd, events)
+
+    def unregister(self, fd):
+        self._poll.unregister(fd)
+
+    def poll(self, timeout):
+        while True:
+            try:
+                return self._poll.poll(timeout * self._scale)
+            except (IOError, select.error), ex:
+                if ex.args[0] != errno.EINTR:
+                    raise
@@ -0,0 +1,200 @@
+# This file is part of the MapProxy project.
+# Copyright (C) 2013 Omniscale GmbH & Co. KG <http://omniscale.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gc
+import os
+import signal
+import threading
+import multiprocessing
+import multiprocessing.util
+from multiprocessing.reduction import send_handle, recv_handle
+from _multiprocessing import Connection
+
+from mp_renderd.queue import STOP, WakeupQueue, ResultWriter, wait_readable
+
+import logging
+log = logging.getLogger(__name__)
+
+class ForkServer(object):
+    """
+    Process that starts new worker processes on request.
+
+    The fork server is started once, before the broker starts any
+    threads, and all workers are forked from it. New workers start
+    quickly, they share the memory of the already loaded configuration
+    (copy-on-write) and they do not inherit threads and locks from the
+    broker process.
+
+    Each worker receives its tasks through its own connection and sends
+    its results through its own pipe. The broker ends are passed back
+    to the broker. The task connection also tells the broker if the
+    worker is still alive.
+
+    :param worker_factory: factory for the worker processes, called in
+        the fork server with ``in_queue`` and ``out_queue``
+    """
+    def __init__(self, worker_factory):
+        self.worker_factory = worker_factory
+        self.conn, self._server_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=self._serve)
+
+    def start(self):
+        self.process.start()
+        self._server_conn.close()
+        # stop the server before multiprocessing joins it on exit
+        multiprocessing.util.Finalize(self, _stop_server, args=(self.conn, ),
+            exitpriority=10)
+
+    def stop(self):
+        _stop_server(self.conn)
+        self.process.join()
+
+    def start_worker(self):
+        """
+        Start a new worker and return a `ForkedWorker`.
+        """
+        self.conn.send('start')
+        worker_id, pid = self.conn.recv()
+        fd = recv_handle(self.conn)
+        results_fd = recv_handle(self.conn)
+        return ForkedWorker(worker_id, pid, Connection(fd),
+            Connection(results_fd, writable=False))
+
+    def _serve(self):
+        self.conn.close()
+        # move everything that is loaded so far out of the reach of the
+        # garbage collector, so that the workers do not touch (and copy)
+        # these pages (Python >= 3.7)
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+
+        log.debug('fork server %d started', os.getpid())
+        while True:
+            try:
+                message = self._server_conn.recv()
+            except (EOFError, KeyboardInterrupt):
+                return
+            if message == STOP:
+                return
+            # reap stopped workers
+            multiprocessing.active_children()
+
+            worker_conn, broker_conn = multiprocessing.Pipe()
+            results, results_writer = multiprocessing.Pipe(duplex=False)
+            worker = self.worker_factory(
+                in_queue=ConnectionQueue(worker_conn, peer=broker_conn),
+                out_queue=ResultWriter(results_writer))
+            worker.start()
+            worker_conn.close()
+            results_writer.close()
+
+            self._server_conn.send((worker.id, worker.pid))
+            send_handle(self._server_conn, broker_conn.fileno(), None)
+            send_handle(self._server_conn, results.fileno(), None)
+            broker_conn.close()
+            results.close()
+
+def _stop_server(conn):
+    try:
+        conn.send(STOP)
+    except (IOError, ValueError):
+        # server or connection is already closed
+        pass
+
+class ForkedWorker(object):
+    """
+    Handle for a worker that was started by the `ForkServer`.
+    Offers the methods of `BaseWorker` that are used by the
+    `WorkerPool`.
+    """
+    def __init__(self, id, pid, conn, results):
+        self.id = id
+        self.pid = pid
+        self.conn = conn
+        # read end of the result pipe
+        self.results = results
+        self.in_queue = ConnectionSender(conn)
+        # readable when the worker exited
+        self.sentinel = conn.fileno()
+
+    def dispatch(self, task):
+        task.worker_id = self.id
+        self.in_queue.put(task)
+
+    def dispatch_batch(self, tasks):
+        for task in tasks:
+            task.worker_id = self.id
+        self.in_queue.put(tasks)
+
+    def is_alive(self):
+        # the worker never writes to the connection,
+        # it is only readable when the worker closed it
+        try:
+            return not self.conn.poll()
+        except IOError:
+            return False
+
+    def terminate(self):
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+class ConnectionSender(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def put(self, item):
+        self.conn.send(item)
+
+class ConnectionQueue(object):
+    """
+    Input queue of a forked worker. All threads of the worker read
+    from the same connection. Messages that the worker puts into its own
+    input queue (`STOP` for the other threads) are returned first.
+
+    :param peer: the broker end of the connection, it is closed in
+        the worker process
+    """
+    def __init__(self, conn, peer=None):
+        self.conn = conn
+        self.peer = peer
+        self.pending = []
+        # created in the worker process by the first get()
+        self.local = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.local is None:
+                self.local = WakeupQueue()
+                if self.peer is not None:
+                    self.peer.close()
+                    self.peer = None
+            while True:
+                self.pending.extend(self.local.get_all())
+                if self.pending:
+                    return self.pending.pop(0)
+                if self.conn in wait_readable([self.conn, self.local]):
+                    try:
+                        return self.conn.recv()
+                    except EOFError:
+                        # broker is gone
+                        return STOP
+
+    def put(self, item):
+        # does not block while another thread waits in get()
+        self.local.put(item)
@@ -0,0 +1,126 @@
+# This file is part of the MapProxy project.
+# Copyright (C) 2013 Omniscale GmbH & Co. KG <http://omniscale.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Check which tiles are already cached and fresh, without loading
+the tile data and without locking.
+"""
+
+import errno
+import os
+
+def fresh_tiles(cache, coords, refresh_before):
+    """
+    Return the set of tile `coords` that are stored in `cache` with a
+    modification time of `refresh_before` or later.
+    Returns an empty set if the cache does not store timestamps.
+    """
+    from mapproxy.cache.file import FileCache
+    from mapproxy.cache.mbtiles import MBTilesCache, MBTilesLevelCache
+
+    if not coords or not cache.supports_timestamp:
+        return set()
+    if isinstance(cache, FileCache):
+        return _fresh_file_tiles(cache, coords, refresh_before)
+    if isinstance(cache, MBTilesCache):
+        return _fresh_mbtiles_tiles(cache, coords, refresh_before)
+    if isinstance(cache, MBTilesLevelCache):
+        fresh = set()
+        for level, level_coords in _group(coords, lambda c: c[2]).iteritems():
+            fresh.update(_fresh_mbtiles_tiles(cache._get_level(level),
+                level_coords, refresh_before))
+        return fresh
+    return _fresh_tiles_metadata(cache, coords, refresh_before)
+
+def _group(items, key):
+    groups = {}
+    for item in items:
+        groups.setdefault(key(item), []).append(item)
+    return groups
+
+def _fresh_file_tiles(cache, coords, refresh_before):
+    """
+    Lists each tile directory once and only stats the tiles that exist.
+    """
+    from mapproxy.cache.tile import Tile
+
+    locations = [(coord, cache.tile_location(Tile(coord))) for coord in coords]
+    fresh = set()
+    for dirname, dir_locations in _group(locations,
+        lambda l: os.path.dirname(l[1])).iteritems():
+        try:
+            names = set(os.listdir(dirname))
+        except OSError, ex:
+            if ex.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            continue
+        for coord, location in dir_locations:
+            if os.path.basename(location) not in names:
+                continue
+            try:
+                # lstat for linked single color tiles, like FileCache
+                mtime = os.lstat(location).st_mtime
+            except OSError, ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+                continue
+            if mtime >= refresh_before:
+                fresh.add(coord)
+    return fresh
+
+def _fresh_mbtiles_tiles(cache, coords, refresh_before):
+    """
+    Queries the timestamps of all tiles with one SQL query (for each
+    999 arguments).
+    """
+    from mapproxy.cache.mbtiles import sqlite_datetime_to_timestamp
+
+    if not cache.supports_timestamp:
+        return set()
+
+    args = []
+    for x, y, z in coords:
+        args.extend((x, y, z))
+
+    fresh = set()
+    while args:
+        cur_args = args[:999]
+        args = args[999:]
+        stmt = ('SELECT tile_column, tile_row, zoom_level, last_modified FROM tiles WHERE '
+            + ' OR '.join(['(tile_column = ? AND tile_row = ? AND zoom_level = ?)']
+                * (len(cur_args) // 3)))
+        cursor = cache.db.cursor()
+        try:
+            cursor.execute(stmt, cur_args)
+            for x, y, z, last_modified in cursor:
+                timestamp = sqlite_datetime_to_timestamp(last_modified)
+                if timestamp is not None and timestamp >= refresh_before:
+                    fresh.add((x, y, z))
+        finally:
+            cursor.close()
+    return fresh
+
+def _fresh_tiles_metadata(cache, coords, refresh_before):
+    from mapproxy.cache.tile import Tile
+
+    fresh = set()
+    for coord in coords:
+        tile = Tile(coord)
+        if not cache.is_cached(tile):
+            continue
+        cache.load_tile_metadata(tile)
+        if tile.timestamp and tile.timestamp >= refresh_before:
+            fresh.add(coord)
+    return fresh
@@ -0,0 +1,132 @@
+# This file is part of the MapProxy project.
+# Copyright (C) 2013 Omniscale GmbH & Co. KG <http://omniscale.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import uuid
+import threading
+import collections
+
+class Job(object):
+    """
+    Task that was submitted without waiting for its result. The job is
+    the response queue of the task, `put` is called by the broker
+    thread.
+
+    Only the result doc is kept, so that tile data of ``render_tiles``
+    results is not held by finished jobs.
+    """
+    def __init__(self, task, on_done=None):
+        self.id = uuid.uuid4().hex
+        self.task = task
+        self.doc = None
+        self.submitted = time.time()
+        self.finished = None
+        self._on_done = on_done
+        self._done = threading.Event()
+        self._waiters = []
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._done.is_set():
+            return 'done'
+        return 'pending'
+
+    def put(self, result):
+        with self._lock:
+            self.doc = result.doc
+            self.finished = time.time()
+            self._done.set()
+            waiters, self._waiters = self._waiters, []
+        if self._on_done:
+            self._on_done(self)
+        for waiter in waiters:
+            waiter(self)
+
+    def wait(self, timeout):
+        """
+        Wait up to `timeout` seconds for the result. Returns ``True``
+        if the job is done.
+        """
+        return self._done.wait(timeout)
+
+    def add_waiter(self, callback):
+        """
+        Call `callback` with this job when it is done. Returns ``False``
+        (and does not call `callback`) if the job is already done.
+        """
+        with self._lock:
+            if self._done.is_set():
+                return False
+            self._waiters.append(callback)
+            return True
+
+    def remove_waiter(self, callback):
+        with self._lock:
+            if callback in self._waiters:
+                self._waiters.remove(callback)
+
+class JobStore(object):
+    """
+    Jobs by their id. Finished jobs are removed after `ttl` seconds.
+    If the store holds `max_jobs`, the oldest finished jobs are removed
+    early and no new jobs are accepted while all jobs are pending.
+    """
+    def __init__(self, ttl=300, max_jobs=10000):
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self.jobs = {}
+        # ids of finished jobs, oldest first
+        self._finished = collections.deque()
+        self._lock = threading.Lock()
+
+    def submit(self, task):
+        """
+        Return a new `Job` for `task` or ``None`` if the store is full.
+        """
+        with self._lock:
+            self._expire(time.time())
+            while len(self.jobs) >= self.max_jobs and self._finished:
+                self.jobs.pop(self._finished.popleft(), None)
+            if len(self.jobs) >= self.max_jobs:
+                return None
+            job = Job(task, on_done=self._job_done)
+            self.jobs[job.id] = job
+            return job
+
+    def get(self, job_id):
+        """
+        Return the job with `job_id` or ``None`` if it is unknown or
+        expired.
+        """
+        with self._lock:
+            self._expire(time.time())
+            return self.jobs.get(job_id)
+
+    def _job_done(self, job):
+        with self._lock:
+            self._finished.append(job.id)
+
+    def _expire(self, now):
+        while self._finished:
+            job = self.jobs.get(self._finished[0])
+            if job is not None and job.finished + self.ttl > now:
+                break
+            self._finished.popleft()
+            if job is not None:
+                del self.jobs[job.id]
+
+    def __len__(self):
+        return len(self.jobs)
@@ -0,0 +1,159 @@
+# This file is part of the MapProxy project.
+# Copyright (C) 2013 Omniscale GmbH & Co. KG <http://omniscale.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import time
+
+from collections import OrderedDict
+
+from mp_renderd.task import Task
+
+import logging
+log = logging.getLogger(__name__)
+
+class TaskJournal(object):
+    """
+    Append-only journal for background tasks, so that they survive a
+    restart of renderd.
+
+    Each line is a JSON record. ``add`` records contain the task,
+    ``done`` records mark the task as finished. Records are collected
+    and written with a single ``fsync`` by `commit()` (group commit).
+    The journal is compacted to the outstanding tasks on `open()` and
+    when it contains too many finished tasks.
+
+    The journal is only used from the broker thread.
+
+    :param filename: path of the journal file
+    :param commit_interval: minimum time in seconds between two commits
+    """
+    # compact if the file has this many records more than outstanding tasks
+    compact_threshold = 10000
+
+    def __init__(self, filename, commit_interval=0.2):
+        self.filename = filename
+        self.commit_interval = commit_interval
+        # request_id -> JSON line of the add record
+        self.outstanding = OrderedDict()
+        self._pending = []
+        self._last_commit = 0
+        self._records = 0
+        self._file = None
+
+    def open(self):
+        """
+        Open the journal and return all outstanding tasks of an
+        existing journal (oldest first).
+        """
+        if os.path.exists(self.filename):
+            with open(self.filename) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # incomplete line from a crash during a commit
+                        log.warn('ignoring invalid record in journal %s', self.filename)
+                        continue
+                    if record['op'] == 'add':
+                        self.outstanding[record['request_id']] = line.rstrip('\n')
+                    elif record['op'] == 'done':
+                        self.outstanding.pop(record['request_id'], None)
+        self._compact()
+        return [self._load_task(line) for line in self.outstanding.itervalues()]
+
+    def _load_task(self, line):
+        record = json.loads(line)
+        task = Task(record['id'], record['doc'], priority=record['priority'])
+        task.request_id = record['request_id']
+        return task
+
+    def _compact(self):
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            for line in self.outstanding.itervalues():
+                f.write(line + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_filename, self.filename)
+
+        if self._file:
+            self._file.close()
+        self._file = open(self.filename, 'a')
+        self._records = len(self.outstanding)
+
+    def add(self, task):
+        """
+        Record a new task. Tasks that are already recorded (e.g. tasks
+        from `open()`) are ignored.
+        """
+        if task.request_id in self.outstanding:
+            return
+        # serialize now, the doc of the task can change while it is queued
+        line = json.dumps({
+            'op': 'add',
+            'request_id': task.request_id,
+            'id': task.id,
+            'doc': task.doc,
+            'priority': task.priority,
+        })
+        self.outstanding[task.request_id] = line
+        self._pending.append(line)
+
+    def done(self, task):
+        """
+        Record that `task` is finished. Ignores unknown tasks.
+        """
+        if self.outstanding.pop(task.request_id, None) is None:
+            return
+        self._pending.append(json.dumps({'op': 'done', 'request_id': task.request_id}))
+
+    def commit_timeout(self, now=None):
+        """
+        Return the number of seconds until the next `commit()` is due,
+        or ``None`` if there is nothing to commit.
+        """
+        if not self._pending:
+            return None
+        if now is None:
+            now = time.time()
+        return max(0, self._last_commit + self.commit_interval - now)
+
+    def commit(self, force=False):
+        """
+        Write all recorded changes to disk, unless the last commit
+        was less than `commit_interval` seconds ago.
+        """
+        if not self._pending:
+            return
+        now = time.time()
+        if not force and now < self._last_commit + self.commit_interval:
+            return
+
+        self._file.write('\n'.join(self._pending) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._records += len(self._pending)
+        self._pending = []
+        self._last_commit = now
+
+        if self._records - len(self.outstanding) > self.compact_threshold:
+            self._compact()
+
+    def close(self):
+        if self._file:
+            self.commit(force=True)
+            self._file.close()
+            self._file = None
@@ -0,0 +1,221 @@
+# This file is part of the MapProxy project.
+# Copyright (C) 2013 Omniscale GmbH & Co. KG <http://omniscale.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Metrics of the brokers in the Prometheus text format.
+
+Histograms are recorded by the broker thread, which is the only
+writer, so recording needs no lock. Counters that other parts already
+keep (rejections, recycled workers, etc.) are only read when the
+metrics are requested. Reading takes copies and can be off by the
+results that are recorded at the same time.
+"""
+
+import bisect
+import time
+
+# seconds, from metatiles of fast sources to slow seeding tasks
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+    5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+class Histogram(object):
+    """
+    Histogram with fixed `buckets` for each combination of label values.
+
+    :param label_names: names of the labels, the label values of
+        `observe` are in the same order
+    """
+    def __init__(self, name, help, label_names, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        # label values -> counts for each bucket (not cumulative), +Inf
+        # bucket, sum
+        self.series = {}
+
+    def observe(self, label_values, value):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def merge(self, other):
+        """
+        Return a new histogram with the series of this and the `other`
+        histogram, e.g. from another broker shard.
+        """
+        merged = Histogram(self.name, self.help, self.label_names, self.buckets)
+        for histogram in (self, other):
+            for label_values, series in histogram.series.items():
+                total = merged.series.get(label_values)
+                if total is None:
+                    merged.series[label_values] = list(series)
+                else:
+                    merged.series[label_values] = [a + b for a, b in zip(total, series)]
+        return merged
+
+    def lines(self):
+        yield '# HELP %s %s' % (self.name, self.help)
+        yield '# TYPE %s histogram' % self.name
+        for label_values, series in sorted(self.series.items()):
+            series = list(series)
+            labels = zip(self.label_names, label_values)
+            count = 0
+            for le, n in zip(self.buckets + ('+Inf', ), series):
+                count += n
+                yield '%s_bucket%s %d' % (self.name, format_labels(labels + [('le', le)]), count)
+            yield '%s_sum%s %s' % (self.name, format_labels(labels), repr(series[-1]))
+            yield '%s_count%s %d' % (self.name, format_labels(labels), count)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+        for name, value in labels)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def simple_metric(name, type, help, samples):
+    """
+    Return the lines of a counter or gauge. `samples` is a list of
+    ``(labels, value)``.
+    """
+    yield '# HELP %s %s' % (name, help)
+    yield '# TYPE %s %s' % (name, type)
+    for labels, value in samples:
+        yield '%s%s %s' % (name, format_labels(labels), value)
+
+def priority_band(priority, bands):
+    """
+    Return the band of `priority`: the highest min priority of the
+    render processes (`bands`, sorted) that is not above `priority`.
+    """
+    if priority is None:
+        return bands[0]
+    i = bisect.bisect_right(bands, priority)
+    return bands[max(0, i - 1)]
+
+class BrokerMetrics(object):
+    """
+    Latency histograms of a broker, by cache, priority band and status.
+
+    :param process_min_priorities: min priorities of the render
+        processes, each distinct value is a priority band
+    """
+    label_names = ('cache', 'priority', 'status')
+
+    def __init__(self, process_min_priorities):
+        self.bands = sorted(set(process_min_priorities))
+        self.queue_wait = Histogram('renderd_queue_wait_seconds',
+            'Time tasks waited in the queue before they were dispatched.',
+            self.label_names)
+        self.execution = Histogram('renderd_execution_seconds',
+            'Time from dispatching a task to a render process until its result arrived.',
+            self.label_names)
+        self.total = Histogram('renderd_request_seconds',
+            'Time from receiving a task until its result was returned, including deduplicated tasks.',
+            self.label_names)
+
+    def record_result(self, result, requests, now=None):
+        """
+        Record the times of `result` and of all `requests` that
+        receive this result.
+        """
+        if now is None:
+            now = time.time()
+        dispatched = result.trace.get('dispatched')
+        if dispatched is not None:
+            # the cache of the task, the result doc of the worker does
+            # not contain it
+            task = result
+            for req in requests:
+                if req.request_id == result.request_id:
+                    task = req
+            labels = self._labels(task, result)
+            self.execution.observe(labels, now - dispatched)
+            enqueued = result.trace.get('enqueued')
+            if enqueued is not None:
+                self.queue_wait.observe(labels, dispatched - enqueued)
+        for req in requests:
+            enqueued = req.trace.get('enqueued')
+            if enqueued is not None:
+                self.total.observe(self._labels(req, req.failed_result or result),
+                    now - enqueued)
+
+    def _labels(self, task, result):
+        cache = ''
+        if isinstance(task.doc, dict):
+            cache = task.doc.get('cache_identifier') or ''
+        status = ''
+        if isinstance(result.doc, dict):
+            status = result.doc.get('status') or ''
+        return (cache, priority_band(task.priority, self.bands), status)
+
+def exposition(brokers):
+    """
+    Return the metrics of all `brokers` (shards) in the Prometheus
+    text format.
+    """
+    histograms = None
+    for broker in brokers:
+        metrics = broker.metrics
+        if histograms is None:
+            histograms = [metrics.queue_wait, metrics.execution, metrics.total]
+        else:
+            histograms = [h.merge(o) for h, o in zip(histograms,
+                [metrics.queue_wait, metrics.execution, metrics.total])]
+
+    lines = []
+    for histogram in histograms:
+        lines.extend(histogram.lines())
+
+    def total(attr):
+        return sum(attr(b) for b in brokers)
+
+    lines.extend(simple_metric('renderd_dedup_hits_total', 'counter',
+        'Tasks that got the result of another task with the same id or tiles.',
+        [([], total(lambda b: b.render_queue.dedup_hits))]))
+    # all shards share the admission control
+    admissions = dict((id(b.admission), b.admission) for b in brokers
+        if b.admission is not None).values()
+    lines.extend(simple_metric('renderd_rejected_total', 'counter',
+        'Tasks that were rejected by the admission control.',
+        [([], sum(a.rejected for a in admissions))]))
+    lines.extend(simple_metric('renderd_worker_restarts_total', 'counter',
+        'Render processes that were replaced.',
+        [([('reason', 'recycled')], total(lambda b: b.worker.recycled)),
+         ([('reason', 'killed')], total(lambda b: b.worker.killed)),
+         ([('reason', 'died')], total(lambda b: b.worker.died))]))
+    lines.extend(simple_metric('renderd_affinity_total', 'counter',
+        'Tile tasks that went to a render process that served the same cache before (hit) or not (miss).',
+        [([('result', 'hit')], total(lambda b: b.worker.affinity_hits)),
+         ([('result', 'miss')], total(lambda b: b.worker.affinity_misses))]))
+    recent = [b.recent_results for b in brokers if b.recent_results is not None]
+    if recent:
+        lines.extend(simple_metric('renderd_recent_results_total', 'counter',
+            'New tasks that were answered with the result of an identical, recently finished task (hit) or not (miss).',
+            [([('result', 'hit')], sum(r.hits for r in recent)),
+             ([('result', 'miss')], sum(r.misses for r in recent))]))
+    lines.extend(simple_metric('renderd_tasks', 'gauge',
+        'Number of running and waiting tasks.',
+        [([('state', 'running')], total(lambda b: b.render_queue.running)),
+         ([('state', 'waiting')], total(lambda b: b.render_queue.waiting))]))
+    lines.extend(simple_metric('renderd_workers', 'gauge',
+        'Number of render processes.',
+        [([], total(lambda b: b.worker.pool_size))]))
+    return '\n'.join(lines) + '\n'
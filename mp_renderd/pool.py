@@ -13,11 +13,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import threading
 import multiprocessing
 
+from mp_renderd.queue import STOP, ResultWriter
+from mp_renderd.forkserver import ForkServer
+
 import logging
 log = logging.getLogger(__name__)
 
+# serializes the start of processes of all pools (each broker shard
+# starts its workers in its own thread). a process that is forked while
+# another worker starts inherits the write ends of the sentinel and the
+# result pipe of that worker and the broker would not notice its exit.
+_start_lock = threading.Lock()
+
 class WorkerPool(object):
     """
     Starts and manages a pool of worker processes.
@@ -36,51 +47,280 @@ class WorkerPool(object):
     `get()` returns the input queue from one of the available (idle)
     workers. `put()` moves the queue back ot the list of available processes.
 
+    `get()` prefers an idle worker that served the same cache before
+    (cache affinity), as long as that worker did not render more than
+    `max_imbalance` tasks more than the least busy idle worker.
+
+    Each worker sends its results through its own pipe (see
+    `result_connections()`), so that a terminated worker cannot corrupt
+    the results of other workers.
+
+    Workers with multiple task threads have `slots` task slots. They
+    stay available until all slots are in use.
+
+    Workers are recycled after `max_tasks` tasks or when their resident
+    memory exceeds `max_rss` bytes. A recycled worker gets no new tasks
+    and it is stopped as soon as its current tasks are done. A spare
+    worker that was started in advance takes its place right away.
+
+    With `use_fork_server` all workers are forked from a `ForkServer`
+    that is started with the pool.
     """
-    def __init__(self, worker_factory, pool_size=2):
+    def __init__(self, worker_factory, pool_size=2, max_imbalance=100, slots=1,
+        max_tasks=None, max_rss=None, use_fork_server=False):
         self.processes = {}
         self.pool_size = pool_size
+        self.slots = slots
+        # worker_id -> number of free task slots
+        self.free_slots = {}
         self.worker_factory = worker_factory
-        self.result_queue = None
         self.available = set()
         self.inuse = set()
-        self.result_queue = multiprocessing.Queue()
+        self.max_imbalance = max_imbalance
+        # worker_id -> cache_identifier of the last task
+        self.last_cache = {}
+        # worker_id -> number of tasks
+        self.task_counts = {}
+        self.affinity_hits = 0
+        self.affinity_misses = 0
+        self.max_tasks = max_tasks
+        self.max_rss = max_rss
+        # workers that are stopped when their current tasks are done
+        self.retiring = set()
+        # stopped workers that are not joined yet
+        self.retired = []
+        # (task_queue, worker) of started workers that replace recycled workers
+        self.spares = []
+        self.recycled = 0
+        # workers that were terminated or that died
+        self.killed = 0
+        self.died = 0
+        self.fork_server = None
+        if use_fork_server:
+            with _start_lock:
+                self.fork_server = ForkServer(worker_factory)
+                self.fork_server.start()
         self.start_processes()
 
     def is_available(self):
         return bool(self.available)
 
-    def get(self):
-        worker_id = self.available.pop()
+    def get(self, cache_identifier=None):
+        """
+        Return an idle worker, preferably one that served
+        `cache_identifier` before.
+        """
+        worker_id = self._select(cache_identifier)
+        self.free_slots[worker_id] -= 1
+        if not self.free_slots[worker_id]:
+            self.available.remove(worker_id)
         _, worker = self.processes[worker_id]
         self.inuse.add(worker_id)
+        if cache_identifier is not None:
+            self.last_cache[worker_id] = cache_identifier
+        self.task_counts[worker_id] = self.task_counts.get(worker_id, 0) + 1
         return worker
 
-    def put(self, worker_id):
+    def _select(self, cache_identifier):
+        if not self.available:
+            raise KeyError('no worker available')
+        if cache_identifier is None:
+            return next(iter(self.available))
+
+        least_busy = affine = None
+        for worker_id in self.available:
+            if least_busy is None or self.task_counts.get(worker_id, 0) < self.task_counts.get(least_busy, 0):
+                least_busy = worker_id
+            if affine is None and self.last_cache.get(worker_id) == cache_identifier:
+                affine = worker_id
+
+        if affine is not None and (self.task_counts.get(affine, 0)
+            - self.task_counts.get(least_busy, 0) <= self.max_imbalance):
+            self.affinity_hits += 1
+            return affine
+        self.affinity_misses += 1
+        return least_busy
+
+    def affinity_hit_rate(self):
+        """
+        Return the share of `get()` calls (with a cache) that returned a
+        worker that served the same cache before.
+        """
+        total = self.affinity_hits + self.affinity_misses
+        if not total:
+            return 0.0
+        return self.affinity_hits / float(total)
+
+    def put(self, worker_id, rss=None):
+        """
+        Return a task slot of the worker. `rss` is the resident memory
+        of the worker after the task.
+        """
         worker = self.processes[worker_id][1]
-        self.inuse.remove(worker.id)
+        self.free_slots[worker.id] += 1
+        idle = self.free_slots[worker.id] == self.slots
+        if idle:
+            self.inuse.remove(worker.id)
+
+        if worker.id not in self.retiring and self._needs_recycling(worker.id, rss):
+            self._retire(worker.id, rss)
+        if worker.id in self.retiring:
+            if idle:
+                self._stop(worker.id)
+            return
         self.available.add(worker.id)
 
-    def start_processes(self):
-        assert self.result_queue
-        log.debug('starting processes')
-        for i in xrange(self.pool_size - len(self.processes)):
+    def _needs_recycling(self, worker_id, rss):
+        if self.max_tasks and self.task_counts.get(worker_id, 0) >= self.max_tasks:
+            return True
+        if self.max_rss and rss is not None and rss > self.max_rss:
+            return True
+        return False
+
+    def _retire(self, worker_id, rss):
+        log.info('recycling worker %s after %d tasks (rss: %s)', worker_id,
+            self.task_counts.get(worker_id, 0), rss)
+        self.retiring.add(worker_id)
+        self.available.discard(worker_id)
+        self._replace()
+
+    def _replace(self):
+        if self.spares:
+            task_queue, p = self.spares.pop()
+        else:
+            task_queue, p = self._start_worker()
+        self._add_worker(task_queue, p)
+        self._start_spare()
+
+    def _stop(self, worker_id):
+        task_queue, proc = self._remove(worker_id)
+        task_queue.put(STOP)
+        self.retired.append(proc)
+        self.recycled += 1
+
+    def _remove(self, worker_id):
+        task_queue, proc = self.processes.pop(worker_id)
+        if not self.fork_server:
+            os.close(proc.sentinel)
+        proc.results.close()
+        self.available.discard(worker_id)
+        self.inuse.discard(worker_id)
+        self.retiring.discard(worker_id)
+        self.free_slots.pop(worker_id, None)
+        self.last_cache.pop(worker_id, None)
+        self.task_counts.pop(worker_id, None)
+        return task_queue, proc
+
+    def kill(self, worker_id):
+        """
+        Terminate the (hung) worker and replace it with a new worker.
+        """
+        # retiring workers are already replaced
+        replace = worker_id not in self.retiring
+        _, proc = self._remove(worker_id)
+        proc.terminate()
+        self.killed += 1
+        self.retired.append(proc)
+        if replace:
+            self._replace()
+
+    def _start_worker(self):
+        if self.fork_server:
+            p = self.fork_server.start_worker()
+            return p.in_queue, p
+        with _start_lock:
             task_queue = multiprocessing.Queue()
-            p = self.worker_factory(in_queue=task_queue, out_queue=self.result_queue)
+            results, results_writer = multiprocessing.Pipe(duplex=False)
+            p = self.worker_factory(in_queue=task_queue,
+                out_queue=ResultWriter(results_writer))
+            # only the worker keeps the write end open, the read end
+            # becomes readable when the worker exits
+            sentinel, write_end = os.pipe()
             p.start()
-            self.processes[p.id] = (task_queue, p)
-            self.available.add(p.id)
+            os.close(write_end)
+            # the result pipe reports EOF instead of blocking for the
+            # rest of an incomplete result when the worker is terminated
+            results_writer.close()
+        p.sentinel = sentinel
+        p.results = results
+        return task_queue, p
+
+    def result_connections(self):
+        """
+        Return the read ends of the result pipes of all workers.
+        """
+        return [p.results for _, p in self.processes.itervalues()]
+
+    def pids(self):
+        """
+        Return the pids of all workers that can still write into the
+        tile buffer, including terminated workers that did not exit yet.
+        """
+        pids = [p.pid for _, p in self.processes.itervalues()]
+        pids.extend(p.pid for _, p in self.spares)
+        pids.extend(p.pid for p in self.retired if p.is_alive())
+        return pids
+
+    def sentinels(self):
+        """
+        Return a dict with the sentinel file descriptor of each worker.
+        The sentinel becomes readable when the worker exits.
+        """
+        return dict((p.sentinel, worker_id)
+            for worker_id, (_, p) in self.processes.iteritems())
+
+    def remove_dead(self, worker_id):
+        """
+        Remove the dead worker and replace it with a new worker.
+        """
+        replace = worker_id not in self.retiring
+        _, proc = self._remove(worker_id)
+        if not self.fork_server:
+            # the sentinel is closed before the process exited, wait so
+            # that the worker no longer counts as alive in pids()
+            proc.join(1)
+        self.died += 1
+        self.retired.append(proc)
+        if replace:
+            self._replace()
+
+    def _add_worker(self, task_queue, p):
+        self.processes[p.id] = (task_queue, p)
+        self.free_slots[p.id] = self.slots
+        self.available.add(p.id)
+
+    def _start_spare(self):
+        if (self.max_tasks or self.max_rss) and not self.spares:
+            self.spares.append(self._start_worker())
+
+    def start_processes(self):
+        log.debug('starting processes')
+        num_running = len(self.processes) - len(self.retiring)
+        for i in xrange(self.pool_size - num_running):
+            self._add_worker(*self._start_worker())
+        self._start_spare()
 
     def clear_dead_processes(self):
+        """
+        Remove all dead workers. Returns the ids of the removed workers.
+        """
+        dead = []
         for _, proc in self.processes.values():
-            print proc.id, self.available
             if not proc.is_alive():
-                self.available.remove(proc.id)
-                self.processes.pop(proc.id)
+                self._remove(proc.id)
+                self.died += 1
+                dead.append(proc.id)
+        return dead
 
     def check_processes(self):
-        self.clear_dead_processes()
+        """
+        Replace dead workers. Returns the ids of the dead workers.
+        """
+        dead = self.clear_dead_processes()
+        self.spares = [(q, p) for q, p in self.spares if p.is_alive()]
+        self.retired = [p for p in self.retired if p.is_alive()]
         self.start_processes()
+        return dead
 
     def terminate_processes(self):
         log.debug('terminating processes')
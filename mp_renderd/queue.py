@@ -13,18 +13,75 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import errno
+import fcntl
 import heapq
+import itertools
+import select
 import time
 import threading
 import Queue
 
+from collections import deque, OrderedDict
+
+def tile_keys(task):
+    """
+    Return a list with ``(cache_identifier, tile_coord)`` tuples for
+    all tiles of a ``tile`` task. Returns ``None`` for other tasks.
+    """
+    doc = task.doc
+    if not isinstance(doc, dict) or doc.get('command') != 'tile':
+        return None
+    cache_identifier = doc.get('cache_identifier')
+    return [(cache_identifier, tuple(coord)) for coord in doc.get('tiles', []) if coord]
+
 class RenderQueue(object):
-    def __init__(self, process_min_priorities, default_priority=50):
+    """
+    Queue for waiting and running tasks.
+
+    Tasks with the same ``key`` (``id`` and command) are merged: a new
+    task is attached to a running or waiting task with that ``key``.
+    A waiting task is
+    promoted to the highest priority of all merged tasks.
+
+    Tile tasks are indexed by their tiles (``cache_identifier`` and
+    tile coord). A new tile task only keeps the tiles that no other
+    task is producing. It waits for the other tasks to finish before
+    it is returned by `remove()`. Tiles of waiting tasks with a lower
+    priority are taken over by the new task.
+
+    Waiting tile tasks are also indexed by cache and priority, so that
+    `next_batch()` can collect more tasks for the same cache.
+    """
+    def __init__(self, process_min_priorities, default_priority=50,
+        aging_interval=None, aging_step=10, aging_max_priority=None):
         process_min_priorities = sorted(process_min_priorities)
         self._min_priority = process_min_priorities[0]
         assert default_priority >= self._min_priority
         self.running_tasks = RunningTasks(process_min_priorities)
-        self.tasks = PriorityTaskQueue(default_priority)
+        self.tasks = PriorityTaskQueue(default_priority,
+            aging_interval=aging_interval, aging_step=aging_step,
+            aging_max_priority=aging_max_priority)
+
+        # key -> waiting task with that key
+        self.waiting_keys = {}
+        # request_id -> tasks that were merged into that waiting task
+        self.merged_tasks = {}
+        # (cache_identifier, priority) -> waiting tile tasks (oldest first)
+        self.waiting_tile_tasks = {}
+
+        # (cache_identifier, tile_coord) -> task that renders the tile
+        self.tile_producers = {}
+        # request_id -> tasks that wait for the tiles of that request
+        self.tile_dependents = {}
+        # request_id -> set of request_ids the task waits for
+        self.pending_producers = {}
+        # request_id -> task that waits only for other tasks
+        self.attached_tasks = {}
+        # number of tasks that were not queued, because other tasks
+        # produce their results
+        self.dedup_hits = 0
 
     @property
     def running(self):
@@ -34,18 +91,201 @@ class RenderQueue(object):
     def waiting(self):
         return len(self.tasks)
 
+    @property
+    def attached(self):
+        """
+        Number of tasks that wait only for tiles of other tasks.
+        """
+        return len(self.attached_tasks)
+
     def add(self, task):
         assert task.priority is None or task.priority >= self._min_priority
+        if task.priority is None:
+            task.priority = self.tasks.default_priority
+
+        if self.running_tasks.is_running(task.key):
+            # task gets the result of the running task
+            self.running_tasks.add(task)
+            self.dedup_hits += 1
+            return
+
+        waiting_task = self.waiting_keys.get(task.key)
+        if waiting_task is not None:
+            self.dedup_hits += 1
+            self.merged_tasks.setdefault(waiting_task.request_id, []).append(task)
+            if task.priority > waiting_task.priority:
+                self._remove_from_cache_index(waiting_task)
+                self.tasks.promote(waiting_task, task.priority)
+                self._add_to_cache_index(waiting_task)
+            return
+
+        keys = tile_keys(task)
+        if not keys:
+            self._add_waiting(task)
+            return
+
+        own_keys = []
+        for key in keys:
+            producer = self.tile_producers.get(key)
+            if producer is None:
+                self.tile_producers[key] = task
+                own_keys.append(key)
+            elif producer not in self.tasks or producer.priority >= task.priority:
+                # tile is already running or waiting with a higher priority
+                self._add_dependency(task, producer)
+            else:
+                # take over tile from waiting task with a lower priority
+                self.tile_producers[key] = task
+                own_keys.append(key)
+                self._remove_tile(producer, key)
+                self._add_dependency(producer, task)
+
+        if len(own_keys) != len(keys):
+            task.doc['tiles'] = [coord for _, coord in own_keys]
+
+        if own_keys:
+            self._add_waiting(task)
+        else:
+            self.attached_tasks[task.request_id] = task
+            self.dedup_hits += 1
+
+    def _add_waiting(self, task):
         self.tasks.add(task)
+        self.waiting_keys[task.key] = task
+        self._add_to_cache_index(task)
+
+    def _remove_waiting(self, task):
+        del self.waiting_keys[task.key]
+        self._remove_from_cache_index(task)
+
+    def _cache_index_key(self, task):
+        if tile_keys(task) is None:
+            return None
+        return task.doc.get('cache_identifier'), task.priority
+
+    def _add_to_cache_index(self, task):
+        key = self._cache_index_key(task)
+        if key is not None:
+            self.waiting_tile_tasks.setdefault(key, OrderedDict())[task.request_id] = task
+
+    def _remove_from_cache_index(self, task):
+        key = self._cache_index_key(task)
+        if key is None:
+            return
+        tasks = self.waiting_tile_tasks.get(key)
+        if tasks is not None:
+            tasks.pop(task.request_id, None)
+            if not tasks:
+                del self.waiting_tile_tasks[key]
+
+    def _add_dependency(self, task, producer):
+        pending = self.pending_producers.setdefault(task.request_id, set())
+        if producer.request_id not in pending:
+            pending.add(producer.request_id)
+            self.tile_dependents.setdefault(producer.request_id, []).append(task)
+
+    def _remove_tile(self, task, key):
+        task.doc['tiles'] = [coord for coord in task.doc['tiles']
+            if coord and tuple(coord) != key[1]]
+        if not task.doc['tiles']:
+            self.tasks.remove(task)
+            self._remove_waiting(task)
+            self.attached_tasks[task.request_id] = task
 
-    def remove(self, task_id):
-        return self.running_tasks.remove(task_id)
+    def _release_tiles(self, task):
+        for key in tile_keys(task) or []:
+            if self.tile_producers.get(key) is task:
+                del self.tile_producers[key]
+
+    def _with_merged(self, task):
+        tasks = [task]
+        for merged_task in self.merged_tasks.pop(task.request_id, []):
+            merged_task.failed_result = task.failed_result
+            tasks.append(merged_task)
+        return tasks
+
+    def remove(self, key, result=None):
+        """
+        Remove running tasks by `key`. Returns a list of all tasks that
+        are finished with that, including merged tasks and tasks that
+        were waiting for tiles of the removed tasks.
+
+        :param result: the result of the removed tasks. tasks that wait
+            for a failed result get it as ``failed_result``.
+        """
+        tasks = self.running_tasks.remove(key)
+        failed = result is not None and not _result_ok(result)
+
+        done = []
+        for task in tasks:
+            self._release_tiles(task)
+            if failed and task.failed_result is None:
+                task.failed_result = result
+            if task.request_id in self.pending_producers:
+                # own tiles are done, but still waiting for others
+                self.attached_tasks[task.request_id] = task
+            else:
+                done.extend(self._with_merged(task))
+
+        # (finished task, failed result for its dependents)
+        finished = deque((task, result if failed else None) for task in tasks)
+        while finished:
+            task, failed_result = finished.popleft()
+            for dependent in self.tile_dependents.pop(task.request_id, []):
+                if failed_result is not None and dependent.failed_result is None:
+                    dependent.failed_result = failed_result
+                pending = self.pending_producers[dependent.request_id]
+                pending.discard(task.request_id)
+                if pending:
+                    continue
+                del self.pending_producers[dependent.request_id]
+                if dependent.request_id in self.attached_tasks:
+                    attached = self.attached_tasks.pop(dependent.request_id)
+                    done.extend(self._with_merged(attached))
+                    # tasks that lost all their tiles to other tasks can
+                    # still have dependents
+                    finished.append((attached, attached.failed_result))
+
+        return done
+
+    def requeue(self, key):
+        """
+        Move the running tasks with `key` back to the waiting tasks,
+        e.g. after their worker died. Tasks that were added while the
+        task was running are merged into the requeued task.
+        Returns the requeued task.
+        """
+        tasks = self.running_tasks.remove(key)
+        task = tasks[0]
+        if tasks[1:]:
+            self.merged_tasks.setdefault(task.request_id, []).extend(tasks[1:])
+        self._add_waiting(task)
+        return task
+
+    def waiting_by_priority(self):
+        """
+        Return a dict with the number of waiting tasks for each priority.
+        """
+        return self.tasks.sizes()
+
+    def processes_for_priority(self, priority):
+        """
+        Return the number of processes that can run tasks with `priority`.
+        """
+        return len([p for p in self.running_tasks.process_min_priorities
+            if p <= priority])
 
     def has_new_tasks(self):
         if not self.tasks:
             return False
-        next_task = self.tasks.peek()
-        return self.running_tasks.process_available(next_task)
+        required_priority = self.running_tasks.required_priority()
+        if required_priority is None:
+            return False
+        try:
+            self.tasks.peek(required_priority)
+        except IndexError:
+            return False
+        return True
 
     def has_running_tasks(self):
         """
@@ -53,10 +293,17 @@ class RenderQueue(object):
         """
         return self.running_tasks
 
+    def has_key(self, key):
+        """
+        Return ``True`` if a waiting or running task has this `key`.
+        A new task with that `key` is merged with it.
+        """
+        return key in self.waiting_keys or self.running_tasks.is_running(key)
+
     def already_running(self, task):
         """
-        Return ``True`` if a task with ``task.id`` is already running.
-        Returns ``False`` if only `task` itself runs with that ``id``.
+        Return ``True`` if a task with ``task.key`` is already running.
+        Returns ``False`` if only `task` itself runs with that ``key``.
         """
         return task in self.running_tasks
 
@@ -65,48 +312,116 @@ class RenderQueue(object):
         Returns the next task to run. Marks the task as running.
         """
         assert self.has_new_tasks()
-        task = self.tasks.pop()
+        # processes are reserved by the original priority, aged tasks
+        # do not take processes from higher priority tasks
+        task = self.tasks.pop(self.running_tasks.required_priority())
+        self._remove_waiting(task)
         self.running_tasks.add(task)
         return task
 
+    def is_abandoned(self, task, now=None):
+        """
+        Return ``True`` if nobody waits for the result of the running
+        `task`: the task, all merged tasks and all tasks that wait for
+        its tiles are abandoned.
+        """
+        if now is None:
+            now = time.time()
+        if not task.is_abandoned(now):
+            return False
+        for other in self.merged_tasks.get(task.request_id, []):
+            if not other.is_abandoned(now):
+                return False
+        for other in self.tile_dependents.get(task.request_id, []):
+            if not other.is_abandoned(now):
+                return False
+        return True
+
+    def next_batch(self, task, max_tasks):
+        """
+        Returns up to `max_tasks` waiting tile tasks for the same cache
+        and with the same priority as the running tile `task`. Marks the
+        tasks as running within the process of `task`.
+        """
+        key = self._cache_index_key(task)
+        if key is None or max_tasks <= 0:
+            return []
+        waiting = self.waiting_tile_tasks.get(key)
+        if not waiting:
+            return []
+
+        batch = []
+        for batch_task in waiting.values():
+            if len(batch) >= max_tasks:
+                break
+            self.tasks.remove(batch_task)
+            self._remove_waiting(batch_task)
+            self.running_tasks.add(batch_task, batch_key=task.key)
+            batch.append(batch_task)
+        return batch
+
+def _result_ok(result):
+    doc = result.doc
+    return not isinstance(doc, dict) or doc.get('status', 'ok') == 'ok'
+
 class RunningTasks(object):
     """
-    Store running tasks and group them by ``task.id``.
+    Store running tasks and group them by ``task.key``.
     """
     def __init__(self, process_min_priorities):
         self.running = {}
+        # keys of running tasks that share the process of another task
+        self.batched_keys = {}
         self.process_min_priorities = sorted(process_min_priorities)
 
     def __contains__(self, task):
-        if task.id not in self.running:
+        if task.key not in self.running:
             return False
-        if task in self.running[task.id]:
+        if task in self.running[task.key]:
             # exclude task
-            return len(self.running[task.id]) >= 2
+            return len(self.running[task.key]) >= 2
         else:
-            return len(self.running[task.id]) >= 1
+            return len(self.running[task.key]) >= 1
 
-    def process_available(self, task):
-        num_running = len(self.running)
+    def is_running(self, key):
+        return key in self.running
+
+    def required_priority(self):
+        """
+        Return the minimal priority a task needs to run on the next
+        free process, or ``None`` if all processes are busy.
+        """
+        num_running = len(self.running) - len(self.batched_keys)
         num_procs = len(self.process_min_priorities)
         if num_running >= num_procs:
-            return False
+            return None
+        return self.process_min_priorities[num_running]
 
-        required_priority = self.process_min_priorities[num_running]
+    def process_available(self, task):
+        required_priority = self.required_priority()
+        if required_priority is None:
+            return False
         return required_priority <= task.priority
 
-    def add(self, task):
+    def add(self, task, batch_key=None):
         """
         Mark a new task as running.
+
+        :param batch_key: key of the running task that `task` is batched
+            with. Batched tasks do not require an extra process.
         """
-        self.running.setdefault(task.id, []).append(task)
+        if batch_key is not None and task.key not in self.running:
+            self.batched_keys[task.key] = batch_key
+        self.running.setdefault(task.key, []).append(task)
 
-    def remove(self, id):
+    def remove(self, key):
         """
-        Remove running tasks by id. Returns a list of all tasks
-        with that `id`.
+        Remove running tasks by key. Returns a list of all tasks
+        with that `key`.
         """
-        return self.running.pop(id)
+        tasks = self.running.pop(key)
+        self.batched_keys.pop(key, None)
+        return tasks
 
     def __len__(self):
         return len(self.running)
@@ -115,81 +430,274 @@ class PriorityTaskQueue(object):
     """
     Queue for tasks. Tasks are ordered by priority (highest first)
     then date (oldest first).
+
+    Tasks are stored in one heap for each priority band. With
+    `aging_interval` the effective priority of a waiting task grows by
+    `aging_step` for each full interval it waits, up to
+    `aging_max_priority` (defaults to `default_priority`). All tasks in
+    one band age at the same rate, so the bands never need to be
+    reordered and only the oldest task of each band is checked on
+    `pop()`. Tasks with a priority above `aging_max_priority` never age.
     """
-    def __init__(self, default_priority=50):
-        self._tasks = []
+    def __init__(self, default_priority=50, aging_interval=None,
+        aging_step=10, aging_max_priority=None):
+        self._bands = {}
+        self._band_sizes = {}
+        self._entries = {}
+        self._counter = itertools.count()
         self.default_priority = default_priority
+        self.aging_interval = aging_interval
+        self.aging_step = aging_step
+        if aging_max_priority is None:
+            aging_max_priority = default_priority
+        self.aging_max_priority = aging_max_priority
 
     def add(self, task):
         if task.priority is None:
             task.priority = self.default_priority
 
-        # self._tasks is a min-heap
-        # invert priority to get that a large value is a high priority
-        heapq.heappush(self._tasks, (-task.priority, time.time(), task))
+        # each band is a min-heap ordered by the time the task was added
+        entry = [time.time(), next(self._counter), task]
+        self._entries[task.request_id] = entry
+        heapq.heappush(self._bands.setdefault(task.priority, []), entry)
+        self._count(task.priority, 1)
+
+    def _count(self, priority, n):
+        size = self._band_sizes.get(priority, 0) + n
+        if size:
+            self._band_sizes[priority] = size
+        else:
+            del self._band_sizes[priority]
 
-    def pop(self):
+    def remove(self, task):
+        """
+        Remove `task` from the queue. The heap entry is only marked as
+        removed and skipped by `pop()` and `peek()`.
+        """
+        entry = self._entries.pop(task.request_id)
+        entry[2] = None
+        self._count(task.priority, -1)
+
+    def promote(self, task, priority):
+        """
+        Raise the priority of a waiting `task`. The task keeps its
+        position (time it was added) within the new priority.
+        """
+        if priority <= task.priority:
+            return
+        entry = self._entries[task.request_id]
+        entry[2] = None
+        self._count(task.priority, -1)
+        task.priority = priority
+        entry = [entry[0], entry[1], task]
+        self._entries[task.request_id] = entry
+        heapq.heappush(self._bands.setdefault(priority, []), entry)
+        self._count(priority, 1)
+
+    def effective_priority(self, priority, added, now=None):
+        """
+        Return the aged priority of a task with `priority` that was
+        added at `added`.
+        """
+        if not self.aging_interval or priority >= self.aging_max_priority:
+            return priority
+        if now is None:
+            now = time.time()
+        bands = int((now - added) / self.aging_interval)
+        return min(priority + bands * self.aging_step, self.aging_max_priority)
+
+    def _head(self, priority):
+        band = self._bands[priority]
+        while band and band[0][2] is None:
+            heapq.heappop(band)
+        if not band:
+            del self._bands[priority]
+            return None
+        return band[0]
+
+    def _next_band(self, min_priority):
+        now = time.time()
+        best_key = best_priority = None
+        for priority in self._bands.keys():
+            if min_priority is not None and priority < min_priority:
+                continue
+            entry = self._head(priority)
+            if entry is None:
+                continue
+            key = (-self.effective_priority(priority, entry[0], now), entry[0], entry[1])
+            if best_key is None or key < best_key:
+                best_key = key
+                best_priority = priority
+        return best_priority
+
+    def pop(self, min_priority=None):
         """
         Return the task with the highes priority (oldest first).
+
+        :param min_priority: only return tasks with at least this
+            (not aged) priority
         """
-        if not self._tasks:
+        priority = self._next_band(min_priority)
+        if priority is None:
             raise IndexError('pop from empty PriorityTaskQueue')
-        prio_, time_, task = heapq.heappop(self._tasks)
+        time_, count_, task = heapq.heappop(self._bands[priority])
+        del self._entries[task.request_id]
+        self._count(priority, -1)
         return task
 
-    def peek(self):
+    def peek(self, min_priority=None):
         """
         Return the task with the highes priority (oldest first)
         without removing it from the queue.
         """
-        if not self._tasks:
+        priority = self._next_band(min_priority)
+        if priority is None:
             raise IndexError('peek from empty PriorityTaskQueue')
-        return self._tasks[0][2]
+        return self._bands[priority][0][2]
+
+    def sizes(self):
+        """
+        Return a dict with the number of waiting tasks for each priority.
+        """
+        return self._band_sizes.copy()
+
+    def __contains__(self, task):
+        return task.request_id in self._entries
 
     def __len__(self):
-        return len(self._tasks)
+        return len(self._entries)
 
 
 # random but static sentiel for queue shutdown
 STOP = '91bc1c48397845b3b1738d9df3666c94'
 
-class QueueForwarder(threading.Thread):
-    def __init__(self, in_queue, out_queue):
-        self.in_queue = in_queue
-        self.out_queue = out_queue
-        threading.Thread.__init__(self)
-        self.daemon = True
+class WakeupQueue(object):
+    """
+    Unbounded FIFO queue for threads that can be waited on with ``select``.
 
-    def run(self):
-        while True:
-            item = self.in_queue.get()
-            self.out_queue.put((self.in_queue, item))
-            if item == STOP:
-                break
+    `put()` never blocks and writes a single byte to an internal pipe,
+    so the read end (`fileno()`) becomes readable as soon as new items
+    are available. Only one thread should consume the queue with
+    `get_all()`.
+    """
+    def __init__(self):
+        self._items = deque()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
 
-class QueueFanIn(threading.Thread):
-    def __init__(self, in_queues, out_queue):
-        self.in_queues = set(in_queues)
-        self.out_queue = out_queue
-        self._tmp_queue = Queue.Queue()
-        threading.Thread.__init__(self)
-        self.daemon = True
+    def fileno(self):
+        return self._wakeup_r
 
-        for q in self.in_queues:
-            QueueForwarder(q, self._tmp_queue).start()
+    def put(self, item):
+        self._items.append(item)
+        try:
+            os.write(self._wakeup_w, 'x')
+        except OSError, ex:
+            # pipe is full, the reader is already woken up
+            if ex.errno != errno.EAGAIN:
+                raise
 
-    def run(self):
+    def get_all(self):
+        """
+        Return a list with all queued items (oldest first).
+        Returns an empty list if there are no items.
+        """
+        # drain the pipe before popping the items, so that we never miss
+        # the wakeup for an item that is added while we collect them
         while True:
-            item = self._tmp_queue.get()
-            if item[1] == STOP:
-                self.in_queues.remove(item[0])
-                if not self.in_queues:
-                    self.out_queue.put(STOP)
+            try:
+                if not os.read(self._wakeup_r, 4096):
                     break
-            else:
-                self.out_queue.put(item)
+            except OSError, ex:
+                if ex.errno != errno.EAGAIN:
+                    raise
+                break
+
+        items = []
+        while True:
+            try:
+                items.append(self._items.popleft())
+            except IndexError:
+                break
+        return items
+
+    def __len__(self):
+        return len(self._items)
+
+    def close(self):
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
 
-def fan_in_queue(queues):
-    out = Queue.Queue()
-    QueueFanIn(queues, out).start()
-    return out
+def _fileno(queue):
+    if isinstance(queue, int):
+        # file descriptor
+        return queue
+    if hasattr(queue, 'fileno'):
+        return queue.fileno()
+    # multiprocessing.Queue, wait on the read end of the underlying pipe
+    return queue._reader.fileno()
+
+def wait_readable(queues, timeout=None):
+    """
+    Wait until one or more of `queues` have new items.
+
+    :param queues: list of `WakeupQueue`, ``multiprocessing.Queue`` or
+        file descriptors
+    :param timeout: maximum time to wait in seconds, ``None`` blocks
+    :returns: list of all readable queues, empty on timeout
+    """
+    fds = dict((_fileno(q), q) for q in queues)
+    while True:
+        try:
+            readable, _, _ = select.select(fds.keys(), [], [], timeout)
+        except select.error, ex:
+            if ex.args[0] == errno.EINTR:
+                continue
+            raise
+        return [fds[fd] for fd in readable]
+
+class ResultWriter(object):
+    """
+    Output queue of a worker: the write end of the result pipe of this
+    worker. `put` sends the result directly, without a feeder thread.
+    The lock only serializes the threads of the worker. A worker that
+    is terminated while it sends a result only breaks its own pipe.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def put(self, item):
+        with self.lock:
+            self.conn.send(item)
+
+def drain_connection(conn):
+    """
+    Return all items that are immediately available from the read end
+    of a result pipe. Stops at the end of the pipe and at the incomplete
+    message of a terminated worker.
+    """
+    items = []
+    while True:
+        try:
+            if not conn.poll():
+                break
+            items.append(conn.recv())
+        except (EOFError, IOError):
+            break
+    return items
+
+def drain_queue(queue):
+    """
+    Return all items that are immediately available from `queue`
+    (``Queue.Queue`` or ``multiprocessing.Queue``) without blocking.
+    """
+    items = []
+    while True:
+        try:
+            items.append(queue.get_nowait())
+        except Queue.Empty:
+            break
+    return items
@@ -0,0 +1,95 @@
+# This file is part of the MapProxy project.
+# Copyright (C) 2013 Omniscale GmbH & Co. KG <http://omniscale.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import time
+import collections
+
+class RecentResults(object):
+    """
+    LRU cache for the results of recently finished tasks. Tasks that
+    arrive shortly after an identical task finished (e.g. from other
+    MapProxy processes that waited for the same metatile) get the
+    cached result instead of rendering the tiles again.
+
+    The answers are copies of the cached result with a trace that only
+    contains the ``recent_result`` stage, the stages of the rendered
+    task happened before the new task arrived.
+
+    Only used by the broker thread.
+
+    :param ttl: seconds a result is valid after the task finished
+    :param max_size: maximum number of cached results
+    """
+    def __init__(self, ttl=2.0, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        # key -> (expires, finished, result), least recently used first
+        self.results = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, task, now=None):
+        """
+        Return a copy of the cached result for `task` or ``None``.
+        Results that finished before the ``refresh_before`` time that
+        the client sent are not used. The default ``refresh_before``
+        (the time of the request) is always after the cached result.
+        """
+        if now is None:
+            now = time.time()
+        key = task.key
+        cached = self.results.pop(key, None)
+        if cached is None or cached[0] <= now:
+            self.misses += 1
+            return None
+        self.results[key] = cached
+        refresh_before = task.refresh_before
+        if refresh_before is not None and refresh_before > cached[1]:
+            self.misses += 1
+            return None
+        self.hits += 1
+        result = copy.copy(cached[2])
+        result.trace = {}
+        result.stamp('recent_result', now)
+        return result
+
+    def add(self, task, result, now=None):
+        """
+        Cache the `result` of `task`. Only successful results without
+        tile data are cached.
+        """
+        if result.tile_data is not None:
+            return
+        if not isinstance(result.doc, dict) or result.doc.get('status') != 'ok':
+            return
+        if now is None:
+            now = time.time()
+        key = task.key
+        self.results.pop(key, None)
+        # the tiles were stored before the task ended in the worker
+        finished = result.trace.get('worker_end', now)
+        self.results[key] = (now + self.ttl, finished, result)
+        while len(self.results) > self.max_size:
+            self.results.popitem(last=False)
+        # drop expired results from the least recently used end
+        while self.results:
+            expires = next(self.results.itervalues())[0]
+            if expires > now:
+                break
+            self.results.popitem(last=False)
+
+    def __len__(self):
+        return len(self.results)
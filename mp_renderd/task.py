@@ -13,8 +13,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import time
 import uuid
 
+# stages of a task in the order they happen, see `Task.stamp`
+TRACE_STAGES = ('accepted', 'enqueued', 'recent_result', 'dispatched',
+    'worker_start', 'worker_end', 'result_received', 'responded')
+# stages that are stamped on the task of the requester, the other stages
+# are stamped on the task that was rendered and are part of the result
+REQUEST_STAGES = ('accepted', 'enqueued', 'responded')
+
 class Task(object):
     """
     Task for worker.
@@ -23,14 +31,81 @@ class Task(object):
     :param id: id for this task. identical tasks should share the same id,
         (e.g. requests for the same meta tile)
     :param doc: the task as JSON
+    :param deadline: time (``time.time()``) after which nobody waits
+        for the result of this task
     """
-    def __init__(self, id, doc, resp_queue=None, priority=None):
+    def __init__(self, id, doc, resp_queue=None, priority=None, deadline=None):
         self.id = id
         self.doc = doc
+        # tasks with the same key are merged. tasks with the same id, but
+        # with another command (e.g. tile and render_tiles) expect other
+        # results. the key is kept when doc is replaced by the result
+        command = None
+        if isinstance(doc, dict):
+            command = doc.get('command')
+        self.key = (id, command)
         self.priority = priority
         self.resp_queue = resp_queue
         self.request_id = uuid.uuid4().hex
         self.worker_id = None
+        # resident memory of the worker after it processed this task
+        self.worker_rss = None
+        # pid of the worker process that returned this result
+        self.worker_pid = None
+        # TileData of the result, see TileBuffer
+        self.tile_data = None
+        # result of a failed task this task depended on
+        self.failed_result = None
+        self.deadline = deadline
+        # refresh_before sent by the client, the doc also contains the
+        # default (time of the request), see RecentResults
+        self.refresh_before = None
+        # set when the requester stopped waiting for the result
+        self.cancelled = False
+        # number of times the task was requeued after its worker failed
+        self.retries = 0
+        # stage -> time.time(), see TRACE_STAGES
+        self.trace = {}
+
+    def stamp(self, stage, now=None):
+        """
+        Record the time when this task reached `stage`.
+        """
+        if now is None:
+            now = time.time()
+        self.trace[stage] = now
+
+    def is_abandoned(self, now=None):
+        """
+        Return ``True`` if nobody waits for the result of this task.
+        """
+        if self.cancelled:
+            return True
+        if self.deadline is None:
+            return False
+        if now is None:
+            now = time.time()
+        return now >= self.deadline
 
     def __repr__(self):
         return '<Task id=%s, priority=%s>' % (self.id, self.priority)
+
+def request_trace(task, result):
+    """
+    Return the trace of the requested `task` with the times of the
+    rendered `result`. The result can be shared with merged tasks,
+    so each requester has its own accepted and enqueued times.
+    """
+    trace = dict((stage, t) for stage, t in result.trace.iteritems()
+        if stage not in REQUEST_STAGES)
+    trace.update(task.trace)
+    return trace
+
+def trace_durations(trace):
+    """
+    Return the time (in seconds) between each two consecutive stages
+    of the `trace`, e.g. ``{'enqueued-dispatched': 0.2}``.
+    """
+    stages = [stage for stage in TRACE_STAGES if stage in trace]
+    return dict(('%s-%s' % (a, b), trace[b] - trace[a])
+        for a, b in zip(stages, stages[1:]))
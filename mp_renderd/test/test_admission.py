@@ -0,0 +1,125 @@
+# This file is part of the MapProxy project.
+# Copyright (C) 2013 Omniscale GmbH & Co. KG <http://omniscale.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import threading
+
+from mp_renderd.admission import AdmissionControl
+from mp_renderd.queue import RenderQueue
+from mp_renderd.task import Task
+
+from nose.tools import eq_
+
+def task(name, priority=None, deadline=None):
+    return Task(id=name, doc=name, priority=priority, deadline=deadline)
+
+class TestAdmissionControl(object):
+    def setup(self):
+        self.q = RenderQueue([0, 0, 50, 50], default_priority=50)
+
+    def test_no_limits(self):
+        a = AdmissionControl()
+        for i in range(100):
+            self.q.add(task(i, 10))
+        eq_(a.check(task('foo', 10), self.q), None)
+        eq_(a.rejected, 0)
+
+    def test_max_waiting(self):
+        a = AdmissionControl(max_waiting=10)
+        for i in range(9):
+            self.q.add(task(i, 10))
+        eq_(a.check(task('foo', 100), self.q), None)
+        assert a.check(task('foo', 100), self.q, incoming=1)
+        self.q.add(task(9, 10))
+        assert 'too many waiting tasks' in a.check(task('foo', 100), self.q)
+        eq_(a.rejected, 2)
+
+    def test_shards(self):
+        a = AdmissionControl(max_waiting=10, max_waiting_per_priority={10: 5})
+        q2 = RenderQueue([0, 50])
+        for i in range(3):
+            self.q.add(task(i, 10))
+            q2.add(task(i, 10))
+        shards = [(self.q, 0), (q2, 0)]
+        assert 'priority <= 10' in a.check(task('seed', 10), self.q, shards=shards)
+        eq_(a.check(task('foo', 50), self.q, shards=shards), None)
+        shards = [(self.q, 0), (q2, 4)]
+        assert 'too many waiting tasks (10)' in a.check(task('foo', 50), self.q,
+            shards=shards)
+
+    def test_max_waiting_per_priority(self):
+        a = AdmissionControl(max_waiting_per_priority={10: 5, 50: 10})
+        for i in range(5):
+            self.q.add(task(i, 10))
+        assert 'priority <= 10' in a.check(task('seed', 0), self.q)
+        assert 'priority <= 10' in a.check(task('seed', 10), self.q)
+        eq_(a.check(task('foo', 50), self.q), None)
+        eq_(a.check(task('foo', 100), self.q), None)
+        for i in range(5):
+            self.q.add(task(i + 10, 50))
+        assert 'priority <= 50' in a.check(task('foo', 50), self.q)
+        eq_(a.check(task('foo', 100), self.q), None)
+
+    def test_estimated_wait_time(self):
+        a = AdmissionControl(task_time=2.0)
+        eq_(a.estimated_wait_time(10, self.q), 0)
+        for i in range(4):
+            self.q.add(task(i, 10))
+        self.q.add(task('high', 100))
+        # 4 + 1 tasks on two processes
+        eq_(a.estimated_wait_time(10, self.q), 5.0)
+        # only 1 task on four processes
+        eq_(a.estimated_wait_time(50, self.q), 0.5)
+
+        a.record_task_time(12.0)
+        eq_(a.task_time, 3.0)
+
+    def test_max_wait_time(self):
+        a = AdmissionControl(max_wait_time=3.0, task_time=1.0)
+        for i in range(7):
+            self.q.add(task(i, 10))
+        assert 'estimated wait time' in a.check(task('seed', 10), self.q)
+        eq_(a.check(task('high', 100), self.q), None)
+
+    def test_merged(self):
+        a = AdmissionControl(max_waiting=5)
+        for i in range(5):
+            self.q.add(task(i, 10))
+        assert 'too many waiting tasks' in a.check(task('foo', 10), self.q)
+        # merged with a waiting task
+        eq_(a.check(task(3, 10), self.q), None)
+        # merged with a running task
+        running = self.q.next()
+        eq_(a.check(task(running.id, 10), self.q), None)
+        eq_(a.rejected, 1)
+
+    def test_rejected_threads(self):
+        a = AdmissionControl(max_waiting=0)
+        def check():
+            for i in range(1000):
+                a.check(task('foo'), self.q)
+        threads = [threading.Thread(target=check) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        eq_(a.rejected, 4000)
+
+    def test_deadline(self):
+        a = AdmissionControl(task_time=1.0)
+        for i in range(4):
+            self.q.add(task(i, 10))
+        eq_(a.check(task('seed', 10, deadline=time.time() + 10), self.q), None)
+        assert a.check(task('seed', 10, deadline=time.time() + 1), self.q)
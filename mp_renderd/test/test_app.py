@@ -0,0 +1,22 @@
+# This file is part of the MapProxy project.
+# Copyright (C) 2013 Omniscale GmbH & Co. KG <http://omniscale.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mp_renderd.app import parse_renderd_address
+
+from nose.tools import eq_
+
+def test_parse_renderd_address():
+    eq_(parse_renderd_address('http://localhost:8080'), ('127.0.0.1', 8080))
+    eq_(parse_renderd_address('http://127.0.0.1:8080/'), ('127.0.0.1', 8080))
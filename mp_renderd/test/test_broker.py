@@ -14,17 +14,25 @@
 # limitations under the License.
 
 import os
+import json
 import time
 import Queue
 import tempfile
 import shutil
 import random
+import struct
+import functools
 
-from mp_renderd.broker import Broker
+from mp_renderd.broker import Broker, ShardedBroker, split_process_priorities
 from mp_renderd.pool import WorkerPool
 from mp_renderd.worker import BaseWorker
 from mp_renderd.queue import RenderQueue
-from mp_renderd.task import Task
+from mp_renderd.task import Task, TRACE_STAGES, request_trace
+from mp_renderd.journal import TaskJournal
+from mp_renderd.watchdog import TimeBudgets
+from mp_renderd.tilebuffer import TileBuffer
+from mp_renderd.recent import RecentResults
+from mp_renderd.wsgi import RenderdApp
 
 from nose.tools import eq_
 
@@ -50,6 +58,30 @@ class TestWorker(BaseWorker):
     def do_exception(self, doc):
         raise Exception('foo')
 
+    def do_hang_once(self, doc):
+        if not os.path.exists(doc['filename']):
+            open(doc['filename'], 'w').close()
+            time.sleep(60)
+        return {}
+
+    def do_crash_once(self, doc):
+        if not os.path.exists(doc['filename']):
+            open(doc['filename'], 'w').close()
+            os._exit(1)
+        return {}
+
+    def do_crash(self, doc):
+        os._exit(1)
+
+    def do_crash_while_sending_once(self, doc):
+        if not os.path.exists(doc['filename']):
+            open(doc['filename'], 'w').close()
+            # header of a result that is never completed
+            with self.out_queue.lock:
+                os.write(self.out_queue.conn.fileno(), struct.pack('!i', 1024) + 'abc')
+                os._exit(1)
+        return {}
+
 class TestBroker(object):
     def setup(self):
         queue = RenderQueue([0, 0, 0, 50])
@@ -60,6 +92,31 @@ class TestBroker(object):
     def teardown(self):
         self.broker.shutdown()
 
+    def test_metrics(self):
+        resp = self.broker.dispatch(Task(1, {'command': 'sleep', 'time': 0.1,
+            'cache_identifier': 'osm'}, priority=60))
+        eq_(resp.doc['status'], 'ok')
+        labels = ('osm', 50, 'ok')
+        eq_(sum(self.broker.metrics.execution.series[labels][:-1]), 1)
+        assert self.broker.metrics.execution.series[labels][-1] >= 0.1
+        eq_(sum(self.broker.metrics.queue_wait.series[labels][:-1]), 1)
+        eq_(sum(self.broker.metrics.total.series[labels][:-1]), 1)
+
+        text = self.broker.metrics_text()
+        assert 'renderd_execution_seconds_count{cache="osm",priority="50",status="ok"} 1\n' in text
+        assert 'renderd_workers 4\n' in text
+
+    def test_trace(self):
+        task = Task(1, {'command': 'sleep', 'time': 0.1})
+        task.stamp('accepted')
+        resp = self.broker.dispatch(task)
+        eq_(resp.doc['status'], 'ok')
+        task.stamp('responded')
+        trace = request_trace(task, resp)
+        times = [trace[stage] for stage in TRACE_STAGES if stage != 'recent_result']
+        eq_(times, sorted(times))
+        assert trace['worker_end'] - trace['worker_start'] >= 0.1
+
     def test_worker_exception(self):
         resp = self.broker.dispatch(Task(1, {'command': 'exception'}))
         eq_(resp.doc['status'], 'error')
@@ -113,6 +170,43 @@ class TestBroker(object):
         finally:
             shutil.rmtree(tmp)
 
+    def test_deadline(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            q = Queue.Queue()
+            # block all processes for low priority tasks
+            for i in range(3):
+                self.broker.dispatch(Task('sleep%d' % i, {'command': 'sleep', 'time': 0.3}, priority=0), q)
+
+            filename = os.path.join(tmp, 'foo')
+            resp = self.broker.dispatch(Task('touch', {'command': 'touch_file', 'filename': filename},
+                priority=0, deadline=time.time() + 0.1))
+            eq_(resp.doc['status'], 'expired')
+            assert 'deadline exceeded' in resp.doc['error_message']
+
+            for i in range(3):
+                q.get()
+            # wait for a task that runs after the abandoned task
+            self.broker.dispatch(Task('sleep', {'command': 'sleep', 'time': 0}, priority=0))
+            assert not os.path.exists(filename)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_client_disconnected(self):
+        self.broker.client_check_interval = 0.01
+        q = Queue.Queue()
+        for i in range(3):
+            self.broker.dispatch(Task('sleep%d' % i, {'command': 'sleep', 'time': 0.1}, priority=0), q)
+
+        resp = self.broker.dispatch(Task('echo', {'command': 'echo'}, priority=0),
+            client_connected=lambda: False)
+        eq_(resp.doc['status'], 'expired')
+        assert 'client disconnected' in resp.doc['error_message']
+
+        resp = self.broker.dispatch(Task('echo', {'command': 'echo'}, priority=0),
+            client_connected=lambda: True)
+        eq_(resp.doc['status'], 'ok')
+
     def test_fuzz(self):
         q = Queue.Queue()
         for i in range(100):
@@ -175,3 +269,380 @@ class TestBroker(object):
             resp = q.get()
             assert resp.doc['status'] == 'ok'
             assert resp.id == 99999
+
+class TestJournalBroker(object):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.journal_file = os.path.join(self.tmp_dir, 'journal')
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def start_broker(self):
+        queue = RenderQueue([0])
+        worker = WorkerPool(TestWorker, 1)
+        broker = Broker(worker=worker, render_queue=queue, journal=TaskJournal(self.journal_file))
+        broker.start()
+        return broker
+
+    def test_replay(self):
+        journal = TaskJournal(self.journal_file)
+        journal.open()
+        for i in range(3):
+            journal.add(Task(i, {'command': 'touch_file', 'filename': os.path.join(self.tmp_dir, str(i))}))
+        journal.close()
+
+        broker = self.start_broker()
+        try:
+            broker.dispatch(Task('sleep', {'command': 'sleep', 'time': 0}, priority=0))
+            eq_(sorted(os.listdir(self.tmp_dir)), ['0', '1', '2', 'journal'])
+        finally:
+            broker.shutdown()
+            broker.join()
+
+        eq_(TaskJournal(self.journal_file).open(), [])
+
+    def test_record_background(self):
+        broker = self.start_broker()
+        try:
+            broker.dispatch(Task('sleep', {'command': 'sleep', 'time': 0.2}))
+            broker.dispatch_background(Task('bg', {'command': 'echo'}))
+            time.sleep(0.05)
+            # background task is waiting and recorded
+            records = [json.loads(l) for l in open(self.journal_file)]
+            eq_([(r['op'], r['id']) for r in records], [('add', 'bg')])
+        finally:
+            broker.shutdown()
+            broker.join()
+
+        records = [json.loads(l) for l in open(self.journal_file)]
+        eq_([r['op'] for r in records], ['add', 'done'])
+
+class TestRecentResults(object):
+    def setup(self):
+        queue = RenderQueue([0, 0])
+        worker = WorkerPool(TestWorker, 2)
+        self.recent = RecentResults(ttl=60)
+        self.broker = Broker(worker=worker, render_queue=queue,
+            recent_results=self.recent)
+        self.broker.start()
+
+    def teardown(self):
+        self.broker.shutdown()
+
+    def test_recent_result(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp, 'touched')
+            doc = {'command': 'touch_file', 'filename': filename}
+            resp = self.broker.dispatch(Task(1, doc))
+            eq_(resp.doc['status'], 'ok')
+            os.unlink(filename)
+
+            task = Task(1, doc)
+            task.stamp('accepted')
+            resp2 = self.broker.dispatch(task)
+            eq_(resp2.doc, resp.doc)
+            assert not os.path.exists(filename)
+            eq_(self.recent.hits, 1)
+            # no stages of the rendered task
+            eq_(sorted(request_trace(task, resp2)), ['accepted', 'enqueued', 'recent_result'])
+            text = self.broker.metrics_text()
+            assert 'renderd_recent_results_total{result="hit"} 1\n' in text
+            assert 'renderd_request_seconds_count{cache="",priority="0",status="ok"} 2\n' in text
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_recent_result_requests(self):
+        # new_task sets the default refresh_before of each request
+        app = RenderdApp(self.broker)
+        for _ in range(2):
+            task, rejected = app.new_task({'command': 'echo', 'id': 'foo'}, {})
+            eq_(rejected, None)
+            eq_(self.broker.dispatch(task).doc['status'], 'ok')
+        eq_(self.recent.hits, 1)
+
+        task, _ = app.new_task({'command': 'echo', 'id': 'foo',
+            'refresh_before': time.time()}, {})
+        self.broker.dispatch(task)
+        eq_(self.recent.hits, 1)
+
+    def test_no_errors(self):
+        eq_(self.broker.dispatch(Task(1, {'command': 'exception'})).doc['status'], 'error')
+        eq_(self.broker.dispatch(Task(1, {'command': 'exception'})).doc['status'], 'error')
+        eq_(self.recent.hits, 0)
+
+def test_split_process_priorities():
+    eq_(split_process_priorities([0, 0, 0, 50], 1), [[0, 0, 0, 50]])
+    eq_(split_process_priorities([50, 50, 0, 0], 2), [[0, 50], [0, 50]])
+    eq_(split_process_priorities([50, 0, 0, 0, 0], 3), [[0, 0], [0, 50], [0]])
+
+class TestShardedBroker(object):
+    def setup(self):
+        brokers = []
+        for priorities in split_process_priorities([0, 0, 0, 50], 2):
+            brokers.append(Broker(worker=WorkerPool(TestWorker, len(priorities)),
+                render_queue=RenderQueue(priorities)))
+        self.broker = ShardedBroker(brokers)
+        self.broker.start()
+
+    def teardown(self):
+        self.broker.shutdown()
+
+    def test_dispatch(self):
+        q = Queue.Queue()
+        for i in range(20):
+            self.broker.dispatch(Task(i, {'command': 'sleep', 'time': 0.01,
+                'cache_identifier': 'cache%d' % (i % 5)}, priority=10), q)
+        results = []
+        for i in range(20):
+            resp = q.get()
+            eq_(resp.doc['status'], 'ok')
+            results.append(resp.id)
+        eq_(sorted(results), list(range(20)))
+
+        resp = self.broker.dispatch(Task('foo', {'command': 'echo'}))
+        eq_(resp.doc['status'], 'ok')
+
+    def test_same_cache_same_shard(self):
+        t1 = Task(1, {'command': 'tile', 'cache_identifier': 'osm'})
+        t2 = Task(2, {'command': 'tile', 'cache_identifier': 'osm'})
+        assert self.broker.broker_for(t1) is self.broker.broker_for(t2)
+
+    def test_status(self):
+        eq_(self.broker.status(), {'running': 0, 'waiting': 0, 'worker': 4})
+
+    def test_metrics(self):
+        for i in range(4):
+            resp = self.broker.dispatch(Task(i, {'command': 'echo',
+                'cache_identifier': 'cache%d' % i}, priority=0))
+            eq_(resp.doc['status'], 'ok')
+        text = self.broker.metrics_text()
+        eq_(text.count('renderd_request_seconds_count{'), 4)
+        assert 'renderd_workers 4\n' in text
+
+class TestThreadedBroker(object):
+    def setup(self):
+        queue = RenderQueue([0] * 4)
+        worker = WorkerPool(functools.partial(TestWorker, threads=4), 1, slots=4)
+        self.broker = Broker(worker=worker, render_queue=queue)
+        self.broker.start()
+
+    def teardown(self):
+        self.broker.shutdown()
+
+    def test_parallel(self):
+        q = Queue.Queue()
+        start = time.time()
+        for i in range(8):
+            self.broker.dispatch(Task(i, {'command': 'sleep', 'time': 0.3}), q)
+        results = [q.get() for _ in range(8)]
+        eq_(sorted(r.id for r in results), range(8))
+        # two rounds of four parallel tasks in one process
+        assert time.time() - start < 1.2
+        eq_(self.broker.worker.free_slots.values(), [4])
+
+class TestRecyclingBroker(object):
+    def setup(self):
+        queue = RenderQueue([0, 0])
+        worker = WorkerPool(TestWorker, 2, max_tasks=3)
+        self.broker = Broker(worker=worker, render_queue=queue)
+        self.broker.start()
+
+    def teardown(self):
+        self.broker.shutdown()
+
+    def test_recycle(self):
+        q = Queue.Queue()
+        for i in range(20):
+            self.broker.dispatch(Task(i, {'command': 'sleep', 'time': 0.01}), q)
+        results = [q.get() for _ in range(20)]
+        eq_([r.doc['status'] for r in results], ['ok'] * 20)
+        assert self.broker.worker.recycled >= 4
+        eq_(len(self.broker.worker.processes), 2)
+        assert all(r.worker_rss > 0 for r in results)
+
+class TestWatchdogBroker(object):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        queue = RenderQueue([0, 0])
+        worker = WorkerPool(TestWorker, 2)
+        budgets = TimeBudgets(commands={'sleep': 0.2, 'hang_once': 0.2})
+        self.broker = Broker(worker=worker, render_queue=queue, time_budgets=budgets,
+            max_retries=1)
+        self.broker.start()
+
+    def teardown(self):
+        self.broker.shutdown()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_timeout(self):
+        start = time.time()
+        resp = self.broker.dispatch(Task(1, {'command': 'sleep', 'time': 10}))
+        eq_(resp.doc['status'], 'timeout')
+        assert 'failed after 1 retries' in resp.doc['error_message']
+        assert time.time() - start < 2
+
+        # killed workers are replaced
+        eq_(len(self.broker.worker.processes), 2)
+        resp = self.broker.dispatch(Task(2, {'command': 'sleep', 'time': 0.01}))
+        eq_(resp.doc['status'], 'ok')
+
+    def test_retry(self):
+        filename = os.path.join(self.tmp_dir, 'hang')
+        resp = self.broker.dispatch(Task(1, {'command': 'hang_once', 'filename': filename}))
+        eq_(resp.doc['status'], 'ok')
+
+    def test_no_budget(self):
+        resp = self.broker.dispatch(Task(1, {'command': 'echo'}))
+        eq_(resp.doc['status'], 'ok')
+        eq_(self.broker.in_flight, {})
+
+class TestCrashingWorkerBroker(object):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        queue = RenderQueue([0, 0])
+        worker = WorkerPool(TestWorker, 2)
+        self.broker = Broker(worker=worker, render_queue=queue, max_retries=1)
+        self.broker.start()
+
+    def teardown(self):
+        self.broker.shutdown()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_retry(self):
+        filename = os.path.join(self.tmp_dir, 'crash')
+        start = time.time()
+        resp = self.broker.dispatch(Task(1, {'command': 'crash_once', 'filename': filename}))
+        eq_(resp.doc['status'], 'ok')
+        # detected by the sentinel, not by the periodic check
+        assert time.time() - start < self.broker.check_interval / 2
+
+    def test_crash(self):
+        resp = self.broker.dispatch(Task(1, {'command': 'crash'}))
+        eq_(resp.doc['status'], 'error')
+        assert 'failed after 1 retries' in resp.doc['error_message']
+
+        # dead workers are replaced
+        eq_(len(self.broker.worker.processes), 2)
+        resp = self.broker.dispatch(Task(2, {'command': 'echo'}))
+        eq_(resp.doc['status'], 'ok')
+        eq_(self.broker.in_flight, {})
+
+    def test_crash_while_sending(self):
+        filename = os.path.join(self.tmp_dir, 'crash')
+        q = Queue.Queue()
+        self.broker.dispatch(Task(1, {'command': 'sleep', 'time': 0.2}), q)
+        self.broker.dispatch(Task(2, {'command': 'crash_while_sending_once',
+            'filename': filename}), q)
+        # the incomplete result only breaks the pipe of the dead worker
+        results = dict((r.id, r.doc['status']) for r in [q.get(), q.get()])
+        eq_(results, {1: 'ok', 2: 'ok'})
+        eq_(self.broker.in_flight, {})
+
+class TileBufferTestWorker(TestWorker):
+    def __init__(self, tile_buffer, **kw):
+        self.tile_buffer = tile_buffer
+        TestWorker.__init__(self, **kw)
+
+    def do_render_tiles(self, doc):
+        offset = self.tile_buffer.write(doc['data'])
+        if doc.get('crash'):
+            os._exit(1)
+        return {'tile_data': [{'tile': [0, 0, 1], 'offset': offset,
+            'length': len(doc['data'])}]}
+
+class TestTileBufferBroker(object):
+    def setup(self):
+        self.tile_buffer = TileBuffer(1024 * 1024)
+        queue = RenderQueue([0, 0])
+        worker = WorkerPool(functools.partial(TileBufferTestWorker,
+            tile_buffer=self.tile_buffer), 2)
+        self.broker = Broker(worker=worker, render_queue=queue,
+            tile_buffer=self.tile_buffer, max_retries=0)
+        self.broker.start()
+
+    def teardown(self):
+        self.broker.shutdown()
+
+    def test_tile_data(self):
+        resp = self.broker.dispatch(Task(1, {'command': 'render_tiles', 'data': 'foo'}))
+        eq_(resp.doc['status'], 'ok')
+        eq_(''.join(str(c) for c in resp.tile_data.chunks()), 'foo')
+        assert self.tile_buffer.used() > 0
+        del resp
+        # the broker thread drops its reference when it handled the result
+        deadline = time.time() + 2
+        while self.tile_buffer.used() and time.time() < deadline:
+            time.sleep(0.01)
+        eq_(self.tile_buffer.used(), 0)
+
+    def test_background(self):
+        self.broker.dispatch_background(Task(1, {'command': 'render_tiles', 'data': 'foo'}))
+        self.broker.dispatch(Task(2, {'command': 'echo'}))
+        # task 1 can run on the other worker
+        deadline = time.time() + 2
+        while self.broker.render_queue.running and time.time() < deadline:
+            time.sleep(0.01)
+        while self.tile_buffer.used() and time.time() < deadline:
+            time.sleep(0.01)
+        # nobody waits for the tiles of background tasks
+        eq_(self.tile_buffer.used(), 0)
+
+    def test_crash(self):
+        resp = self.broker.dispatch(Task(1, {'command': 'render_tiles', 'data': 'foo',
+            'crash': True}))
+        eq_(resp.doc['status'], 'error')
+        # written by the dead worker, but never returned
+        eq_(self.tile_buffer.used(), 0)
+
+class BatchTestWorker(TestWorker):
+    def do_tile(self, doc):
+        return {'batch_size': 1}
+
+    def do_tile_batch(self, docs):
+        return [{'batch_size': len(docs)} for _ in docs]
+
+class TestBatchBroker(object):
+    def setup(self):
+        queue = RenderQueue([0])
+        worker = WorkerPool(BatchTestWorker, 1)
+        self.broker = Broker(worker=worker, render_queue=queue, batch_size=4)
+        self.broker.start()
+
+    def teardown(self):
+        self.broker.shutdown()
+
+    def test_batch(self):
+        q = Queue.Queue()
+        # block the only worker
+        self.broker.dispatch(Task('sleep', {'command': 'sleep', 'time': 0.2}, priority=10), q)
+        for i in range(6):
+            self.broker.dispatch(Task(i, {'command': 'tile', 'cache_identifier': 'test',
+                'tiles': [[i, 0, 5]]}, priority=0), q)
+
+        results = {}
+        for i in range(7):
+            resp = q.get()
+            eq_(resp.doc['status'], 'ok')
+            results[resp.id] = resp.doc.get('batch_size')
+
+        eq_(results, {'sleep': None, 0: 4, 1: 4, 2: 4, 3: 4, 4: 2, 5: 2})
+
+    def test_abandoned_in_batch(self):
+        q = Queue.Queue()
+        self.broker.dispatch(Task('sleep', {'command': 'sleep', 'time': 0.2}, priority=10), q)
+        for i in range(4):
+            task = Task(i, {'command': 'tile', 'cache_identifier': 'test',
+                'tiles': [[i, 0, 5]]}, priority=0)
+            # requesters of 1 and 2 stopped waiting
+            task.cancelled = i in (1, 2)
+            self.broker.dispatch(task, q)
+
+        results = {}
+        for i in range(5):
+            resp = q.get()
+            results[resp.id] = (resp.doc['status'], resp.doc.get('batch_size'))
+
+        eq_(results, {'sleep': ('ok', None), 0: ('ok', 2), 1: ('expired', None),
+            2: ('expired', None), 3: ('ok', 2)})
@@ -0,0 +1,100 @@
+# This file is part of the MapProxy project.
+# Copyright (C) 2013 Omniscale GmbH & Co. KG <http://omniscale.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import urllib2
+import BaseHTTPServer
+import SocketServer
+
+from mp_renderd.connpool import HTTPConnectionPool
+
+from nose.tools import eq_
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        body = 'x' * 10000
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        if self.path == '/close':
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass
+
+class TestHTTPConnectionPool(object):
+    def setup(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        self.server.connections = set()
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.pool = HTTPConnectionPool()
+        self.opener = urllib2.build_opener()
+        self.pool.install(self.opener)
+
+    def teardown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuse(self):
+        for _ in range(3):
+            resp = self.opener.open(self.url + '/tile')
+            eq_(len(resp.read()), 10000)
+            resp.close()
+        eq_(len(self.server.connections), 1)
+        eq_(self.pool.requests, 3)
+        eq_(self.pool.reused, 2)
+        eq_(self.pool.connections, 1)
+
+    def test_incomplete_read(self):
+        resp = self.opener.open(self.url + '/tile')
+        resp.read(10)
+        resp.close()
+        resp = self.opener.open(self.url + '/tile')
+        eq_(len(resp.read()), 10000)
+        eq_(len(self.server.connections), 2)
+        eq_(self.pool.reused, 0)
+
+    def test_connection_close(self):
+        for _ in range(2):
+            resp = self.opener.open(self.url + '/close')
+            eq_(len(resp.read()), 10000)
+        eq_(len(self.server.connections), 2)
+        eq_(self.pool.reused, 0)
+
+    def test_retry_closed_idle_connection(self):
+        resp = self.opener.open(self.url + '/tile')
+        resp.read()
+        # close connection like a server after its keep-alive timeout
+        for conns in self.pool.idle.values():
+            for conn in conns:
+                conn.sock.shutdown(2)
+        resp = self.opener.open(self.url + '/tile')
+        eq_(len(resp.read()), 10000)
+        eq_(self.pool.requests, 2)
+        eq_(self.pool.connections, 2)
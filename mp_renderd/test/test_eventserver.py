@@ -0,0 +1,329 @@
+# This file is part of the MapProxy project.
+# Copyright (C) 2013 Omniscale GmbH & Co. KG <http://omniscale.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import stat
+import json
+import time
+import shutil
+import tempfile
+import socket
+import httplib
+import threading
+
+from mp_renderd.eventserver import EventServer, Connection, RequestTooLarge
+from mp_renderd.wsgi import RenderdApp
+from mp_renderd.task import Task
+from mp_renderd.benchmark import UnixHTTPConnection
+
+from nose.tools import eq_, raises
+
+class DummyBroker(object):
+    """
+    Returns the request doc as result after ``sleep`` seconds,
+    if the task was not cancelled.
+    """
+    def __init__(self):
+        self.tasks = []
+        self.timers = []
+
+    def admit(self, task):
+        return task.doc.get('reject')
+
+    def dispatch(self, task, response_queue=None, client_connected=None):
+        self.tasks.append(task)
+        def put_result():
+            if task.cancelled:
+                return
+            doc = dict(task.doc)
+            doc['status'] = 'ok'
+            response_queue.put(Task(task.id, doc))
+        t = threading.Timer(task.doc.get('sleep', 0), put_result)
+        t.daemon = True
+        t.start()
+        self.timers.append(t)
+
+    def shutdown(self):
+        for t in self.timers:
+            t.cancel()
+
+    def status(self):
+        return {'running': 1, 'waiting': 2, 'worker': 3}
+
+class TestEventServer(object):
+    def setup(self):
+        self.broker = DummyBroker()
+        self.server = EventServer(('127.0.0.1', 0), RenderdApp(self.broker))
+        self.server.bind()
+        self.thread = threading.Thread(target=self.server.start)
+        self.thread.daemon = True
+        self.thread.start()
+        self.port = self.server.bind_addr[1]
+
+    def teardown(self):
+        self.server.stop()
+        self.thread.join(2)
+        self.broker.shutdown()
+
+    def request(self, doc, conn=None, path='/'):
+        if conn is None:
+            conn = httplib.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        conn.request('POST', path, json.dumps(doc))
+        resp = conn.getresponse()
+        return resp.status, resp.read()
+
+    def test_request(self):
+        status, body = self.request({'command': 'tile', 'id': 'foo'})
+        eq_(status, 200)
+        doc = json.loads(body)
+        eq_(doc['status'], 'ok')
+        eq_(doc['command'], 'tile')
+        eq_(self.broker.tasks[0].id, 'foo')
+
+    def test_trace(self):
+        status, body = self.request({'command': 'tile', 'trace': True})
+        eq_(status, 200)
+        trace = json.loads(body)['trace']
+        eq_(sorted(trace), ['accepted', 'responded'])
+        assert trace['accepted'] <= trace['responded']
+
+        status, body = self.request({'command': 'tile'})
+        assert 'trace' not in json.loads(body)
+
+    def test_keep_alive(self):
+        conn = httplib.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        for i in range(3):
+            status, body = self.request({'command': 'tile', 'id': i}, conn)
+            eq_(json.loads(body)['id'], i)
+        eq_(len(self.server.connections), 1)
+
+    def test_close_idle(self):
+        self.server.keepalive_timeout = 0.2
+        conn = httplib.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        self.request({'command': 'tile', 'sleep': 0.3}, conn)
+        # not idle while the request waited for the result
+        eq_(len(self.server.connections), 1)
+        time.sleep(0.4)
+        eq_(len(self.server.connections), 0)
+        eq_(self.server._idle_deadlines, [])
+
+    def test_body_too_large(self):
+        self.server.max_body_size = 100
+        status, body = self.request({'command': 'tile', 'data': 'x' * 100})
+        eq_(status, 413)
+        status, body = self.request({'command': 'tile'})
+        eq_(status, 200)
+
+    def test_large_body(self):
+        status, body = self.request({'command': 'tile', 'data': 'x' * 200000})
+        eq_(status, 200)
+        eq_(len(json.loads(body)['data']), 200000)
+
+    def test_status(self):
+        status, body = self.request({}, path='/_status')
+        eq_(status, 200)
+        assert 'waiting: 2' in body
+        status, body = self.request({}, path='/unknown')
+        eq_(status, 404)
+
+    def test_rejected(self):
+        status, body = self.request({'command': 'tile', 'reject': 'too many'})
+        eq_(status, 503)
+        eq_(json.loads(body)['status'], 'overload')
+
+    def test_job(self):
+        status, body = self.request({'command': 'tile', 'id': 'foo', 'sleep': 0.3},
+            path='/jobs')
+        eq_(status, 202)
+        job_id = json.loads(body)['job_id']
+
+        conn = httplib.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        conn.request('GET', '/jobs/%s?wait=5' % job_id)
+        # the event loop answers other requests while the job request waits
+        status, body = self.request({'command': 'tile', 'id': 'bar'})
+        eq_(json.loads(body)['id'], 'bar')
+        resp = conn.getresponse()
+        eq_(resp.status, 200)
+        doc = json.loads(resp.read())
+        eq_(doc['state'], 'done')
+        eq_(doc['result']['id'], 'foo')
+
+    def test_job_wait_timeout(self):
+        status, body = self.request({'command': 'tile', 'sleep': 2}, path='/jobs')
+        job = self.server.app.jobs.get(json.loads(body)['job_id'])
+        conn = httplib.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        start = time.time()
+        conn.request('GET', '/jobs/%s?wait=0.1' % job.id)
+        eq_(json.loads(conn.getresponse().read())['state'], 'pending')
+        assert time.time() - start < 1
+        eq_(job._waiters, [])
+
+    def test_invalid_json(self):
+        conn = httplib.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        conn.request('POST', '/', 'no json')
+        eq_(conn.getresponse().status, 400)
+
+    def test_timeout(self):
+        start = time.time()
+        status, body = self.request({'command': 'tile', 'sleep': 2, 'timeout': 0.1})
+        eq_(status, 504)
+        eq_(json.loads(body)['status'], 'expired')
+        assert time.time() - start < 1
+        assert self.broker.tasks[0].cancelled
+
+    def test_client_disconnected(self):
+        s = socket.create_connection(('127.0.0.1', self.port))
+        body = json.dumps({'command': 'tile', 'sleep': 0.5})
+        s.sendall('POST / HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body))
+        time.sleep(0.1)
+        s.close()
+        time.sleep(0.1)
+        assert self.broker.tasks[0].cancelled
+        eq_(len(self.server.connections), 0)
+
+    def test_concurrent_requests(self):
+        # more waiting requests than the threads of the WSGI server
+        socks = []
+        body = json.dumps({'command': 'tile', 'sleep': 0.3})
+        start = time.time()
+        for _ in range(200):
+            s = socket.create_connection(('127.0.0.1', self.port))
+            s.sendall('POST / HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body))
+            socks.append(s)
+        for s in socks:
+            s.settimeout(5)
+            f = s.makefile()
+            eq_(f.readline(), 'HTTP/1.1 200 OK\r\n')
+            s.close()
+        assert time.time() - start < 3
+
+    def test_batch(self):
+        conn = httplib.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        docs = [
+            {'command': 'tile', 'id': 'slow', 'sleep': 0.3},
+            {'command': 'tile', 'id': 'fast'},
+            {'command': 'tile', 'id': 'rejected', 'reject': 'too many'},
+        ]
+        conn.request('POST', '/batch', '\n'.join(json.dumps(d) for d in docs))
+        resp = conn.getresponse()
+        eq_(resp.status, 200)
+        eq_(resp.getheader('transfer-encoding'), 'chunked')
+        lines = [json.loads(l) for l in resp.read().splitlines()]
+        # in the order the results are done
+        eq_([(l['index'], l['id'], l['status']) for l in lines],
+            [(2, 'rejected', 'overload'), (1, 'fast', 'ok'), (0, 'slow', 'ok')])
+
+        # connection is still usable
+        status, body = self.request({'command': 'tile', 'id': 'foo'}, conn)
+        eq_(json.loads(body)['id'], 'foo')
+
+    def test_batch_chunked(self):
+        docs = [{'command': 'tile', 'id': i, 'data': 'x' * 50000} for i in range(1, 5)]
+        s = socket.create_connection(('127.0.0.1', self.port))
+        s.settimeout(5)
+        s.sendall('POST /batch HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n')
+        for doc in docs:
+            line = json.dumps(doc) + '\n'
+            s.sendall('%x\r\n%s\r\n' % (len(line), line))
+            time.sleep(0.01)
+        s.sendall('0\r\n\r\n')
+        resp = httplib.HTTPResponse(s)
+        resp.begin()
+        eq_(resp.status, 200)
+        lines = [json.loads(l) for l in resp.read().splitlines()]
+        eq_(sorted(l['id'] for l in lines), [1, 2, 3, 4])
+        s.close()
+
+    def test_job_wait_done(self):
+        conn = httplib.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        conn.request('POST', '/jobs', json.dumps({'command': 'tile'}))
+        job = self.server.app.jobs.get(json.loads(conn.getresponse().read())['job_id'])
+        job.wait(5)
+        conn.request('GET', '/jobs/%s?wait=5' % job.id)
+        eq_(json.loads(conn.getresponse().read())['state'], 'done')
+
+    def test_batch_timeout(self):
+        conn = httplib.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        docs = [
+            {'command': 'tile', 'id': 'slow', 'sleep': 2, 'timeout': 0.1},
+            {'command': 'tile', 'id': 'fast'},
+        ]
+        conn.request('POST', '/batch', json.dumps(docs))
+        lines = [json.loads(l) for l in conn.getresponse().read().splitlines()]
+        eq_([(l['id'], l['status']) for l in lines], [('fast', 'ok'), ('slow', 'expired')])
+        assert self.broker.tasks[0].cancelled
+
+class TestUnixSocketEventServer(object):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'renderd.sock')
+        # stale socket of a previous run
+        open(self.path, 'w').close()
+        self.broker = DummyBroker()
+        self.server = EventServer(self.path, RenderdApp(self.broker), socket_mode=0600)
+        self.server.bind()
+        self.thread = threading.Thread(target=self.server.start)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def teardown(self):
+        self.server.stop()
+        self.thread.join(2)
+        self.broker.shutdown()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_request(self):
+        eq_(stat.S_IMODE(os.stat(self.path).st_mode), 0600)
+        conn = UnixHTTPConnection(self.path)
+        for i in range(2):
+            conn.request('POST', '/', json.dumps({'command': 'tile', 'id': i}))
+            resp = conn.getresponse()
+            eq_(resp.status, 200)
+            eq_(json.loads(resp.read())['id'], i)
+
+    def test_remove_socket(self):
+        self.server.stop()
+        self.thread.join(2)
+        assert not os.path.exists(self.path)
+
+def test_parse_chunked_request():
+    data = ('POST /batch HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+        '4\r\nfoo\n\r\nA;ext=1\r\n0123456789\r\n0\r\nX-Trailer: 1\r\n\r\n'
+        'GET /_status HTTP/1.1\r\n\r\n')
+    conn = Connection(socket.socket())
+    for i in range(len(data) - 30):
+        conn.inbuf = data[:i]
+        assert conn.parse_request() is None, i
+    conn.inbuf = data
+    method, path, _, _, body = conn.parse_request()
+    eq_((method, path, body), ('POST', '/batch', 'foo\n0123456789'))
+    eq_(conn.inbuf, 'GET /_status HTTP/1.1\r\n\r\n')
+    conn.sock.close()
+
+def test_parse_chunked_invalid():
+    conn = Connection(socket.socket())
+    for body in ['x\r\n', '3\r\nfoobar\r\n', '-1\r\n']:
+        conn.inbuf = 'POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n' + body
+        eq_(conn.parse_request(), False)
+    conn.sock.close()
+
+@raises(RequestTooLarge)
+def test_parse_chunked_too_large():
+    conn = Connection(socket.socket())
+    conn.inbuf = 'POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n10\r\n'
+    try:
+        conn.parse_request(max_body_size=10)
+    finally:
+        conn.sock.close()
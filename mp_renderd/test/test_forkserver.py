@@ -0,0 +1,110 @@
+# This file is part of the MapProxy project.
+# Copyright (C) 2013 Omniscale GmbH & Co. KG <http://omniscale.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import functools
+import Queue
+
+from mp_renderd.broker import Broker
+from mp_renderd.forkserver import ForkServer
+from mp_renderd.pool import WorkerPool
+from mp_renderd.queue import RenderQueue, STOP
+from mp_renderd.task import Task
+from mp_renderd.worker import BaseWorker
+
+from nose.tools import eq_
+
+class EchoWorker(BaseWorker):
+    def do_echo(self, doc):
+        return doc
+
+    def do_pid(self, doc):
+        return {'pid': os.getpid(), 'ppid': os.getppid()}
+
+    def do_sleep(self, doc):
+        time.sleep(doc['time'])
+        return {}
+
+def wait_dead(worker, timeout=2.0):
+    stop = time.time() + timeout
+    while time.time() < stop:
+        if not worker.is_alive():
+            return True
+        time.sleep(0.01)
+    return False
+
+def recv_result(worker, timeout=2.0):
+    assert worker.results.poll(timeout)
+    return worker.results.recv()
+
+class TestForkServer(object):
+    def start_server(self, worker_factory=EchoWorker):
+        self.server = ForkServer(worker_factory)
+        self.server.start()
+
+    def teardown(self):
+        self.server.stop()
+
+    def test_start_worker(self):
+        self.start_server()
+        w1 = self.server.start_worker()
+        w2 = self.server.start_worker()
+        assert w1.id != w2.id
+        assert w1.is_alive()
+
+        w1.dispatch(Task(1, {'command': 'pid'}))
+        result = recv_result(w1)
+        eq_(result.worker_id, w1.id)
+        eq_(result.doc['pid'], w1.pid)
+        # forked from the server, not from this process
+        eq_(result.doc['ppid'], self.server.process.pid)
+
+        w2.dispatch_batch([Task(2, {'command': 'echo'}), Task(3, {'command': 'echo'})])
+        eq_([r.id for r in recv_result(w2)], [2, 3])
+
+    def test_stop_worker(self):
+        self.start_server(functools.partial(EchoWorker, threads=3))
+        w = self.server.start_worker()
+        w.in_queue.put(STOP)
+        assert wait_dead(w)
+
+    def test_terminate_worker(self):
+        self.start_server()
+        w = self.server.start_worker()
+        w.terminate()
+        assert wait_dead(w)
+
+class TestForkServerBroker(object):
+    def setup(self):
+        queue = RenderQueue([0, 0])
+        worker = WorkerPool(EchoWorker, 2, max_tasks=3, use_fork_server=True)
+        self.broker = Broker(worker=worker, render_queue=queue)
+        self.broker.start()
+
+    def teardown(self):
+        self.broker.shutdown()
+        self.broker.join()
+        self.broker.worker.fork_server.stop()
+
+    def test_recycle(self):
+        q = Queue.Queue()
+        for i in range(20):
+            self.broker.dispatch(Task(i, {'command': 'sleep', 'time': 0.01}), q)
+        results = [q.get() for _ in range(20)]
+        eq_([r.doc['status'] for r in results], ['ok'] * 20)
+        assert self.broker.worker.recycled >= 4
+        for worker in self.broker.worker.retired:
+            assert wait_dead(worker)
@@ -0,0 +1,85 @@
+# This file is part of the MapProxy project.
+# Copyright (C) 2013 Omniscale GmbH & Co. KG <http://omniscale.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import time
+
+from mapproxy.cache.file import FileCache
+from mapproxy.cache.mbtiles import MBTilesCache, MBTilesLevelCache
+from mapproxy.cache.tile import Tile
+from mapproxy.image.opts import ImageOptions
+from mapproxy.image import BlankImageSource
+
+from mp_renderd.freshness import fresh_tiles
+
+from nose.tools import eq_
+
+def store(cache, coords):
+    for coord in coords:
+        tile = Tile(coord, BlankImageSource((256, 256), ImageOptions(format='image/png')))
+        cache.store_tile(tile)
+
+class FreshTilesTestBase(object):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_missing(self):
+        eq_(fresh_tiles(self.cache, [(0, 0, 1), (1, 0, 1)], 0), set())
+
+    def test_fresh(self):
+        store(self.cache, [(0, 0, 1), (1, 0, 1), (0, 0, 2)])
+        eq_(fresh_tiles(self.cache, [(0, 0, 1), (1, 0, 1), (1, 1, 1), (0, 0, 2)], time.time() - 60),
+            set([(0, 0, 1), (1, 0, 1), (0, 0, 2)]))
+
+    def test_outdated(self):
+        store(self.cache, [(0, 0, 1), (1, 0, 1)])
+        eq_(fresh_tiles(self.cache, [(0, 0, 1), (1, 0, 1)], time.time() + 60), set())
+
+class TestFileCache(FreshTilesTestBase):
+    def setup(self):
+        FreshTilesTestBase.setup(self)
+        self.cache = FileCache(self.tmp_dir, 'png')
+
+    def test_mtime(self):
+        store(self.cache, [(0, 0, 1), (1, 0, 1)])
+        location = self.cache.tile_location(Tile((0, 0, 1)))
+        os.utime(location, (1000, 1000))
+        eq_(fresh_tiles(self.cache, [(0, 0, 1), (1, 0, 1)], 2000), set([(1, 0, 1)]))
+
+class TestMBTilesCache(FreshTilesTestBase):
+    def setup(self):
+        FreshTilesTestBase.setup(self)
+        self.cache = MBTilesCache(os.path.join(self.tmp_dir, 'tmp.mbtiles'),
+            with_timestamps=True)
+
+    def test_many_tiles(self):
+        coords = [(x, y, 5) for x in range(20) for y in range(20)]
+        store(self.cache, coords[::2])
+        eq_(fresh_tiles(self.cache, coords, time.time() - 60), set(coords[::2]))
+
+    def test_without_timestamps(self):
+        cache = MBTilesCache(os.path.join(self.tmp_dir, 'nots.mbtiles'))
+        store(cache, [(0, 0, 1)])
+        eq_(fresh_tiles(cache, [(0, 0, 1)], 0), set())
+
+class TestMBTilesLevelCache(FreshTilesTestBase):
+    def setup(self):
+        FreshTilesTestBase.setup(self)
+        self.cache = MBTilesLevelCache(self.tmp_dir)
@@ -0,0 +1,81 @@
+# This file is part of the MapProxy project.
+# Copyright (C) 2013 Omniscale GmbH & Co. KG <http://omniscale.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import threading
+
+from mp_renderd.jobs import Job, JobStore
+from mp_renderd.task import Task
+
+from nose.tools import eq_
+
+class TestJob(object):
+    def test_put(self):
+        job = Job(Task(1, {}))
+        eq_(job.state, 'pending')
+        assert not job.wait(0)
+        job.put(Task(1, {'status': 'ok'}))
+        eq_(job.state, 'done')
+        eq_(job.doc, {'status': 'ok'})
+        assert job.wait(0)
+
+    def test_wait(self):
+        job = Job(Task(1, {}))
+        t = threading.Timer(0.05, job.put, [Task(1, {'status': 'ok'})])
+        t.start()
+        assert job.wait(5)
+        eq_(job.doc, {'status': 'ok'})
+
+    def test_waiters(self):
+        job = Job(Task(1, {}))
+        done = []
+        assert job.add_waiter(done.append)
+        job.add_waiter(done.extend)
+        job.remove_waiter(done.extend)
+        job.put(Task(1, {'status': 'ok'}))
+        eq_(done, [job])
+        # already done
+        assert not job.add_waiter(done.append)
+
+class TestJobStore(object):
+    def test_submit_get(self):
+        store = JobStore()
+        job = store.submit(Task(1, {}))
+        assert store.get(job.id) is job
+        eq_(store.get('unknown'), None)
+
+    def test_expire(self):
+        store = JobStore(ttl=0.05)
+        job = store.submit(Task(1, {}))
+        pending = store.submit(Task(2, {}))
+        job.put(Task(1, {'status': 'ok'}))
+        assert store.get(job.id) is job
+        time.sleep(0.1)
+        eq_(store.get(job.id), None)
+        # pending jobs do not expire
+        assert store.get(pending.id) is pending
+
+    def test_max_jobs(self):
+        store = JobStore(max_jobs=2)
+        job1 = store.submit(Task(1, {}))
+        job2 = store.submit(Task(2, {}))
+        eq_(store.submit(Task(3, {})), None)
+        # oldest finished job is removed for new jobs
+        job1.put(Task(1, {'status': 'ok'}))
+        job3 = store.submit(Task(3, {}))
+        assert job3 is not None
+        eq_(store.get(job1.id), None)
+        assert store.get(job2.id) is job2
+        eq_(len(store), 2)
@@ -0,0 +1,120 @@
+# This file is part of the MapProxy project.
+# Copyright (C) 2013 Omniscale GmbH & Co. KG <http://omniscale.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+from mp_renderd.journal import TaskJournal
+from mp_renderd.task import Task
+
+from nose.tools import eq_
+
+class TestTaskJournal(object):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'renderd.journal')
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_empty(self):
+        j = TaskJournal(self.filename)
+        eq_(j.open(), [])
+        assert os.path.exists(self.filename)
+        j.close()
+
+    def test_replay(self):
+        j = TaskJournal(self.filename)
+        j.open()
+        t1 = Task('foo', {'command': 'tile', 'tiles': [[0, 0, 0]]}, priority=10)
+        t2 = Task('bar', {'command': 'tile', 'tiles': [[1, 0, 0]]}, priority=0)
+        t3 = Task('baz', {'command': 'tile', 'tiles': [[2, 0, 0]]})
+        j.add(t1)
+        j.add(t2)
+        j.add(t3)
+        j.commit(force=True)
+        j.done(t2)
+        j.close()
+
+        j = TaskJournal(self.filename)
+        tasks = j.open()
+        eq_([(t.id, t.priority, t.request_id) for t in tasks],
+            [('foo', 10, t1.request_id), ('baz', None, t3.request_id)])
+        eq_(tasks[0].doc, t1.doc)
+
+        # replayed tasks are not recorded twice
+        j.add(tasks[0])
+        j.done(tasks[1])
+        j.close()
+        eq_(len(open(self.filename).readlines()), 3)
+
+        j = TaskJournal(self.filename)
+        eq_([t.id for t in j.open()], ['foo'])
+        # compacted
+        eq_(len(open(self.filename).readlines()), 1)
+        j.close()
+
+    def test_group_commit(self):
+        j = TaskJournal(self.filename, commit_interval=60)
+        j.open()
+        eq_(j.commit_timeout(), None)
+        j.add(Task('foo', {}))
+        eq_(j.commit_timeout(), 0)
+        j.commit()
+        eq_(len(open(self.filename).readlines()), 1)
+
+        j.add(Task('bar', {}))
+        j.add(Task('baz', {}))
+        assert j.commit_timeout() > 50
+        j.commit()
+        # not committed, last commit was less than 60s ago
+        eq_(len(open(self.filename).readlines()), 1)
+        j.commit(force=True)
+        eq_(len(open(self.filename).readlines()), 3)
+        j.close()
+
+    def test_doc_serialized_on_add(self):
+        j = TaskJournal(self.filename)
+        j.open()
+        t = Task('foo', {'tiles': [[0, 0, 0], [1, 0, 0]]})
+        j.add(t)
+        t.doc['tiles'] = [[1, 0, 0]]
+        j.close()
+        eq_(TaskJournal(self.filename).open()[0].doc, {'tiles': [[0, 0, 0], [1, 0, 0]]})
+
+    def test_incomplete_record(self):
+        j = TaskJournal(self.filename)
+        j.open()
+        j.add(Task('foo', {}))
+        j.close()
+        with open(self.filename, 'a') as f:
+            f.write('{"op": "add", "reque')
+        eq_([t.id for t in TaskJournal(self.filename).open()], ['foo'])
+
+    def test_compact(self):
+        j = TaskJournal(self.filename)
+        j.compact_threshold = 10
+        j.open()
+        for i in range(20):
+            t = Task(i, {})
+            j.add(t)
+            if i % 2:
+                j.done(t)
+            j.commit(force=True)
+        # compacted after 11 finished tasks
+        assert len(open(self.filename).readlines()) < 20
+        j.close()
+        eq_([t.id for t in TaskJournal(self.filename).open()], list(range(0, 20, 2)))
@@ -0,0 +1,92 @@
+# This file is part of the MapProxy project.
+# Copyright (C) 2013 Omniscale GmbH & Co. KG <http://omniscale.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mp_renderd.metrics import Histogram, BrokerMetrics, priority_band, format_labels
+from mp_renderd.task import Task
+
+from nose.tools import eq_
+
+def test_priority_band():
+    bands = [0, 50, 80]
+    eq_(priority_band(0, bands), 0)
+    eq_(priority_band(49, bands), 0)
+    eq_(priority_band(50, bands), 50)
+    eq_(priority_band(100, bands), 80)
+    eq_(priority_band(None, bands), 0)
+
+def test_format_labels():
+    eq_(format_labels([]), '')
+    eq_(format_labels([('cache', 'a"b'), ('le', 0.5)]), '{cache="a\\"b",le="0.5"}')
+
+class TestHistogram(object):
+    def test_lines(self):
+        h = Histogram('foo_seconds', 'Foo.', ('cache', ), buckets=(0.1, 1.0))
+        h.observe(('osm', ), 0.05)
+        h.observe(('osm', ), 0.5)
+        h.observe(('osm', ), 2.0)
+        eq_(list(h.lines()), [
+            '# HELP foo_seconds Foo.',
+            '# TYPE foo_seconds histogram',
+            'foo_seconds_bucket{cache="osm",le="0.1"} 1',
+            'foo_seconds_bucket{cache="osm",le="1.0"} 2',
+            'foo_seconds_bucket{cache="osm",le="+Inf"} 3',
+            'foo_seconds_sum{cache="osm"} 2.55',
+            'foo_seconds_count{cache="osm"} 3',
+        ])
+
+    def test_bucket_bound_inclusive(self):
+        h = Histogram('foo_seconds', 'Foo.', (), buckets=(0.1, 1.0))
+        h.observe((), 1.0)
+        eq_(h.series[()], [0, 1, 0, 1.0])
+
+    def test_merge(self):
+        a = Histogram('foo_seconds', 'Foo.', ('cache', ), buckets=(1.0, ))
+        b = Histogram('foo_seconds', 'Foo.', ('cache', ), buckets=(1.0, ))
+        a.observe(('osm', ), 0.5)
+        b.observe(('osm', ), 2.0)
+        b.observe(('dop', ), 0.5)
+        merged = a.merge(b)
+        eq_(merged.series, {('osm', ): [1, 1, 2.5], ('dop', ): [1, 0, 0.5]})
+        # merge does not modify the original histograms
+        eq_(a.series, {('osm', ): [1, 0, 0.5]})
+
+class TestBrokerMetrics(object):
+    def test_record_result(self):
+        metrics = BrokerMetrics([0, 0, 50])
+        task = Task(1, {'cache_identifier': 'osm'}, priority=60)
+        task.stamp('enqueued', 100.0)
+        task.stamp('dispatched', 101.0)
+        result = Task(1, {'status': 'ok'}, priority=60)
+        result.trace = dict(task.trace)
+        result.request_id = task.request_id
+        merged = Task(1, {'cache_identifier': 'osm'}, priority=10)
+        merged.stamp('enqueued', 102.0)
+
+        metrics.record_result(result, [task, merged], now=103.0)
+        eq_(metrics.queue_wait.series.keys(), [('osm', 50, 'ok')])
+        eq_(metrics.execution.series[('osm', 50, 'ok')][-1], 2.0)
+        eq_(metrics.total.series[('osm', 50, 'ok')][-1], 3.0)
+        eq_(metrics.total.series[('osm', 0, 'ok')][-1], 1.0)
+
+    def test_failed_result(self):
+        metrics = BrokerMetrics([0])
+        task = Task(1, {'cache_identifier': 'osm'}, priority=0)
+        task.stamp('enqueued', 100.0)
+        task.failed_result = Task(2, {'status': 'error'})
+        result = Task(1, {'status': 'ok'}, priority=0)
+        metrics.record_result(result, [task], now=101.0)
+        # results without dispatch time (e.g. expired) have no execution time
+        eq_(metrics.execution.series, {})
+        eq_(metrics.total.series.keys(), [('osm', 0, 'error')])
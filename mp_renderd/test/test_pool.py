@@ -13,10 +13,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import multiprocessing
 import uuid
 import time
+import threading
 from mp_renderd.pool import WorkerPool
+from mp_renderd.queue import wait_readable
+
+from nose.tools import eq_
+from nose.plugins.skip import SkipTest
 
 class DummyWorker(multiprocessing.Process):
     def __init__(self, in_queue, out_queue):
@@ -29,12 +35,37 @@ class DummyWorker(multiprocessing.Process):
 def test_clear_check_processes():
     pool = WorkerPool(DummyWorker, 2)
     assert pool.is_available()
-    time.sleep(.2)
+    while any(p.is_alive() for _, p in pool.processes.values()):
+        time.sleep(0.01)
     pool.clear_dead_processes()
     assert not pool.is_available()
     pool.check_processes()
     assert pool.is_available()
 
+def test_sentinels():
+    pool = WorkerPool(DummyWorker, 2)
+    sentinels = pool.sentinels()
+    eq_(sorted(sentinels.values()), sorted(pool.processes.keys()))
+    for fd in sentinels:
+        eq_(wait_readable([fd], timeout=2), [fd])
+    readable = wait_readable(sentinels.keys(), timeout=0)
+    eq_(sorted(readable), sorted(sentinels.keys()))
+
+    for fd in readable:
+        pool.remove_dead(sentinels[fd])
+    eq_(len(pool.processes), 2)
+    assert not set(pool.processes) & set(sentinels.values())
+
+def test_pids():
+    pool = WorkerPool(DummyWorker, 2)
+    eq_(sorted(pool.pids()), sorted(p.pid for _, p in pool.processes.values()))
+    worker_id, (_, proc) = pool.processes.items()[0]
+    pool.kill(worker_id)
+    proc.join()
+    # killed workers count until they exited
+    assert proc.pid not in pool.pids()
+    eq_(len(pool.pids()), 2)
+
 def test_available_worker():
     pool = WorkerPool(DummyWorker, 2)
 
@@ -61,3 +92,148 @@ def test_available_worker():
     assert not pool.is_available()
 
     assert w2 is w3
+
+def test_cache_affinity():
+    pool = WorkerPool(DummyWorker, 3)
+    w1 = pool.get('osm')
+    w2 = pool.get('aerial')
+    pool.put(w1.id)
+    pool.put(w2.id)
+    eq_(pool.affinity_misses, 2)
+
+    # prefer worker that rendered the cache before
+    for _ in range(5):
+        w = pool.get('osm')
+        assert w is w1
+        pool.put(w.id)
+        w = pool.get('aerial')
+        assert w is w2
+        pool.put(w.id)
+
+    eq_(pool.affinity_hits, 10)
+    eq_(pool.affinity_misses, 2)
+    eq_(pool.affinity_hit_rate(), 10 / 12.0)
+
+    # other worker if affine worker is busy
+    w1 = pool.get('osm')
+    w = pool.get('osm')
+    assert w is not w1
+    assert w is not w2
+
+def test_cache_affinity_imbalance():
+    pool = WorkerPool(DummyWorker, 2, max_imbalance=3)
+    w1 = pool.get('osm')
+    pool.put(w1.id)
+    for _ in range(3):
+        w = pool.get('osm')
+        assert w is w1
+        pool.put(w.id)
+    # w1 rendered 4 tasks more than the other worker
+    w = pool.get('osm')
+    assert w is not w1
+
+def test_slots():
+    pool = WorkerPool(DummyWorker, 2, slots=2)
+    workers = [pool.get() for _ in range(4)]
+    assert not pool.is_available()
+    eq_(sorted(w.id for w in workers), sorted(pool.processes.keys() * 2))
+
+    pool.put(workers[0].id)
+    assert pool.is_available()
+    eq_(pool.get(), workers[0])
+    assert not pool.is_available()
+
+    for w in workers:
+        pool.put(w.id)
+    eq_(pool.inuse, set())
+    eq_(pool.free_slots.values(), [2, 2])
+
+def test_recycle_max_tasks():
+    pool = WorkerPool(DummyWorker, 1, max_tasks=2)
+    eq_(len(pool.spares), 1)
+    spare = pool.spares[0][1]
+
+    w = pool.get()
+    pool.put(w.id)
+    eq_(pool.get(), w)
+    pool.put(w.id)
+
+    # spare replaced the worker, a new spare is started
+    eq_(pool.recycled, 1)
+    eq_(pool.processes.keys(), [spare.id])
+    eq_(pool.available, set([spare.id]))
+    eq_(len(pool.spares), 1)
+    assert pool.spares[0][1] not in (w, spare)
+    eq_(pool.retired, [w])
+
+def test_recycle_max_rss():
+    pool = WorkerPool(DummyWorker, 1, max_rss=1000)
+    w = pool.get()
+    pool.put(w.id, rss=500)
+    eq_(pool.get(), w)
+    pool.put(w.id, rss=2000)
+    eq_(pool.recycled, 1)
+    assert pool.get() != w
+
+def test_recycle_busy_worker():
+    pool = WorkerPool(DummyWorker, 1, slots=2, max_tasks=1)
+    w = pool.get()
+    eq_(pool.get(), w)
+    pool.put(w.id)
+    # no new tasks for the recycled worker, but it is still running
+    eq_(pool.recycled, 0)
+    assert w.id in pool.retiring
+    assert w.id not in pool.available
+    assert pool.is_available()
+    pool.put(w.id)
+    eq_(pool.recycled, 1)
+    assert w.id not in pool.processes
+
+def test_no_spares_without_recycling():
+    pool = WorkerPool(DummyWorker, 2)
+    eq_(pool.spares, [])
+
+class SleepingWorker(DummyWorker):
+    def run(self):
+        time.sleep(30)
+
+def pipe_write_inodes(pid):
+    """
+    Return the inodes of the pipe write ends that are open in `pid`.
+    """
+    inodes = set()
+    for fd in os.listdir('/proc/%d/fd' % pid):
+        try:
+            target = os.readlink('/proc/%d/fd/%s' % (pid, fd))
+            with open('/proc/%d/fdinfo/%s' % (pid, fd)) as f:
+                flags = [l for l in f if l.startswith('flags:')][0]
+        except (OSError, IOError):
+            continue
+        if target.startswith('pipe:') and int(flags.split()[1], 8) & os.O_WRONLY:
+            inodes.add(int(target[6:-1]))
+    return inodes
+
+def test_concurrent_pools():
+    if not os.path.exists('/proc/self/fd'):
+        raise SkipTest('needs /proc')
+    # broker shards start workers from their own threads
+    pools = []
+    def start_pool():
+        pools.append(WorkerPool(SleepingWorker, 10))
+    threads = [threading.Thread(target=start_pool) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    try:
+        workers = [p for pool in pools for _, p in pool.processes.values()]
+        sentinels = dict((p.pid, os.fstat(p.sentinel).st_ino) for p in workers)
+        for p in workers:
+            # only the own sentinel, a worker that inherited the sentinel
+            # of another worker hides its exit
+            others = set(sentinels.values()) - set([sentinels[p.pid]])
+            eq_(pipe_write_inodes(p.pid) & others, set())
+    finally:
+        for pool in pools:
+            for _, proc in pool.processes.values():
+                proc.terminate()
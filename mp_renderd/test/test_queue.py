@@ -13,12 +13,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import Queue
+import time
+import multiprocessing
 from mp_renderd.queue import (
     PriorityTaskQueue,
     RunningTasks,
     RenderQueue,
-    fan_in_queue,
+    WakeupQueue,
+    wait_readable,
+    drain_queue,
 )
 from mp_renderd.task import Task
 
@@ -85,6 +88,40 @@ class TestPriorityTaskQueue(object):
 
         assert bool(q) == False
 
+    def test_remove(self):
+        q = PriorityTaskQueue()
+        t1, t2, t3 = task('foo'), task('bar'), task('baz')
+        q.add(t1)
+        q.add(t2)
+        q.add(t3)
+        assert t1 in q
+        q.remove(t1)
+        assert t1 not in q
+        eq_(len(q), 2)
+        eq_(q.peek(), t2)
+        q.remove(t3)
+        eq_(q.pop(), t2)
+        assert bool(q) == False
+        assert_raises(IndexError, q.pop)
+
+    def test_promote(self):
+        q = PriorityTaskQueue()
+        t1, t2, t3 = task('foo', 10), task('bar', 10), task('baz', 20)
+        q.add(t1)
+        q.add(t2)
+        q.add(t3)
+        q.promote(t2, 20)
+        eq_(t2.priority, 20)
+        eq_(len(q), 3)
+        # t2 is older than t3
+        eq_(q.pop(), t2)
+        # no demotion
+        q.promote(t3, 5)
+        eq_(t3.priority, 20)
+        eq_(q.pop(), t3)
+        eq_(q.pop(), t1)
+        assert bool(q) == False
+
     def test_default_prio(self):
         q = PriorityTaskQueue(100)
         q.add(task('default'))
@@ -97,12 +134,74 @@ class TestPriorityTaskQueue(object):
 
         assert bool(q) == False
 
+class TestPriorityAging(object):
+    def test_effective_priority(self):
+        q = PriorityTaskQueue(50, aging_interval=60, aging_step=10)
+        eq_(q.effective_priority(0, 1000, now=1000), 0)
+        eq_(q.effective_priority(0, 1000, now=1059), 0)
+        eq_(q.effective_priority(0, 1000, now=1060), 10)
+        eq_(q.effective_priority(0, 1000, now=1250), 40)
+        # limited to aging_max_priority
+        eq_(q.effective_priority(0, 1000, now=2000), 50)
+        # high priorities are not aged
+        eq_(q.effective_priority(100, 1000, now=2000), 100)
+
+    def test_no_aging(self):
+        q = PriorityTaskQueue(50)
+        eq_(q.effective_priority(0, 1000, now=100000), 0)
+
+    def test_aged_task_first(self):
+        q = PriorityTaskQueue(50, aging_interval=0.05, aging_step=20)
+        q.add(task('seed', 0))
+        q.add(task('bg1', 10))
+        eq_(q.peek().id, 'bg1')
+        time.sleep(0.06)
+        q.add(task('bg2', 10))
+        # seed is now at 20, bg1 at 30
+        eq_(q.pop().id, 'bg1')
+        eq_(q.pop().id, 'seed')
+        eq_(q.pop().id, 'bg2')
+
+    def test_aged_task_below_max_priority(self):
+        q = PriorityTaskQueue(50, aging_interval=0.01, aging_step=20)
+        q.add(task('seed', 0))
+        time.sleep(0.05)
+        q.add(task('high', 51))
+        q.add(task('default', 50))
+        eq_(q.pop().id, 'high')
+        # seed is older than default and aged to 50
+        eq_(q.pop().id, 'seed')
+        eq_(q.pop().id, 'default')
+
+    def test_min_priority(self):
+        q = PriorityTaskQueue(50, aging_interval=0.01, aging_step=50)
+        q.add(task('seed', 0))
+        time.sleep(0.02)
+        q.add(task('high', 50))
+        eq_(q.peek().id, 'seed')
+        eq_(q.peek(50).id, 'high')
+        eq_(q.pop(50).id, 'high')
+        assert_raises(IndexError, q.pop, 50)
+        eq_(q.pop().id, 'seed')
+
+    def test_render_queue_reserved_process(self):
+        q = RenderQueue([0, 50], default_priority=50, aging_interval=0.01, aging_step=50)
+        q.add(task('seed1', 0))
+        q.add(task('seed2', 0))
+        eq_(q.next().id, 'seed1')
+        time.sleep(0.02)
+        # seed2 is aged but the remaining process is reserved
+        assert not q.has_new_tasks()
+        q.add(task('high', 50))
+        assert q.has_new_tasks()
+        eq_(q.next().id, 'high')
+
 class TestRunningTasks(object):
 
     @raises(KeyError)
     def test_remove_unknown_id(self):
         r = RunningTasks([0, 0, 0])
-        r.remove('foo')
+        r.remove(('foo', None))
 
     def test_add(self):
         r = RunningTasks([0, 0, 0])
@@ -110,7 +209,7 @@ class TestRunningTasks(object):
         r.add(task('bar'))
         eq_(len(r), 1)
 
-        tasks = r.remove('bar')
+        tasks = r.remove(('bar', None))
         eq_(tasks[0].id, 'bar')
         eq_(len(r), 0)
 
@@ -125,7 +224,7 @@ class TestRunningTasks(object):
 
         eq_(len(r), 1)
 
-        tasks = r.remove('foo')
+        tasks = r.remove(('foo', None))
         eq_(len(tasks), 3)
 
     def test_process_available(self):
@@ -149,21 +248,21 @@ class TestRunningTasks(object):
 
         # [low1, low2, mid, high1]
         assert not r.process_available(task('high2', 100))
-        r.remove('mid')
+        r.remove(('mid', None))
 
         # [low1, low2, high1]
         assert r.process_available(task('high2', 60))
         r.add(task('high2', 60))
 
         # [low1, low2, high1, high2]
-        r.remove('low1')
+        r.remove(('low1', None))
         # [low2, high1, high2]
         assert not r.process_available(task('low1', 0))
         assert not r.process_available(task('mid', 10))
 
-        r.remove('low2')
-        r.remove('high1')
-        r.remove('high2')
+        r.remove(('low2', None))
+        r.remove(('high1', None))
+        r.remove(('high2', None))
 
         # []
         assert r.process_available(task('low1', 0))
@@ -196,7 +295,7 @@ class TestRenderQueue(object):
         assert not q.has_running_tasks()
         eq_(q.next(), t1)
         assert q.has_running_tasks()
-        eq_(q.remove('foo'), [t1])
+        eq_(q.remove(('foo', None)), [t1])
         assert not q.has_running_tasks()
 
     def test_already_running(self):
@@ -205,28 +304,79 @@ class TestRenderQueue(object):
         t2 = task('foo', 0)
         q.add(t1)
         q.add(t2)
+        # t2 is merged into t1
         eq_(q.running, 0)
-        eq_(q.waiting, 2)
+        eq_(q.waiting, 1)
 
         assert not q.already_running(t1)
-        assert not q.already_running(t2)
         eq_(q.next(), t1)
         eq_(q.running, 1)
-        eq_(q.waiting, 1)
-
+        eq_(q.waiting, 0)
         assert not q.already_running(t1)
-        # t2 has same id as t1, so it is already
+        assert not q.has_new_tasks()
+
+        # t3 has same id as t1, so it is already
         # running since t1 is running
-        assert q.already_running(t2)
-        eq_(q.next(), t2)
+        t3 = task('foo', 0)
+        q.add(t3)
         eq_(q.running, 1)
         eq_(q.waiting, 0)
 
-        eq_(q.remove('foo'), [t1, t2])
+        eq_(q.remove(('foo', None)), [t1, t2, t3])
         assert not q.already_running(t1)
         eq_(q.running, 0)
         eq_(q.waiting, 0)
 
+    def test_requeue(self):
+        q = RenderQueue([0, 0], default_priority=50)
+        t1 = task('foo', 0)
+        t2 = task('foo', 0)
+        q.add(t1)
+        q.add(t2)
+        eq_(q.next(), t1)
+        t3 = task('foo', 0)
+        q.add(t3)
+
+        eq_(q.requeue(('foo', None)), t1)
+        eq_(q.running, 0)
+        eq_(q.waiting, 1)
+        assert not q.already_running(t1)
+
+        eq_(q.next(), t1)
+        eq_(q.remove(('foo', None)), [t1, t2, t3])
+        eq_(q.waiting, 0)
+
+    def test_requeue_tile_dependents(self):
+        q = RenderQueue([0, 0], default_priority=50)
+        t1 = tile_task('meta1', [[0, 0, 1], [1, 0, 1]])
+        q.add(t1)
+        eq_(q.next(), t1)
+        t2 = tile_task('meta2', [[1, 0, 1]])
+        q.add(t2)
+        eq_(q.attached, 1)
+
+        q.requeue(('meta1', 'tile'))
+        eq_(q.next(), t1)
+        eq_(q.remove(('meta1', 'tile')), [t1, t2])
+        eq_(q.tile_producers, {})
+
+    def test_merge_promote(self):
+        q = RenderQueue([0, 50], default_priority=50)
+        q.add(task('seed1', 0))
+        q.add(task('seed2', 0))
+        eq_(q.next().id, 'seed1')
+        # next process is reserved for priority 50
+        assert not q.has_new_tasks()
+
+        t = task('seed2', 100)
+        q.add(t)
+        eq_(q.waiting, 1)
+        assert q.has_new_tasks()
+        seed2 = q.next()
+        eq_(seed2.id, 'seed2')
+        eq_(seed2.priority, 100)
+        eq_(q.remove(('seed2', None)), [seed2, t])
+
     def test_render_queue(self):
         q = RenderQueue([0, 10], default_priority=50)
         tl1, tl2, tl3 = task('low1', 2), task('low2', 1), task('low3', 0)
@@ -253,49 +403,307 @@ class TestRenderQueue(object):
         assert not q.has_new_tasks()
         # [tm1, low2, low3], [low1, tm2]
 
-        q.remove(tl1.id)
+        q.remove(tl1.key)
         # [tm1, low2, low3], [tm2]
         assert q.has_new_tasks()
         eq_(q.next(), tm1)
         # [low2, low3], [tm2, tm1]
 
         assert not q.has_new_tasks()
-        q.remove(tm1.id)
+        q.remove(tm1.key)
         # [low2, low3], [tm2]
         assert not q.has_new_tasks()
 
-        q.remove(tm2.id)
+        q.remove(tm2.key)
         # [low2, low3], []
         assert q.has_new_tasks()
         eq_(q.next(), tl2)
         assert not q.has_new_tasks()
-        q.remove(tl2.id)
+        q.remove(tl2.key)
         assert q.has_new_tasks()
         eq_(q.next(), tl3)
 
 
-class TestFanInQueue(object):
-    def test(self):
-        q1 = Queue.Queue()
-        q2 = Queue.Queue()
-        q3 = Queue.Queue()
+def tile_task(name, tiles, priority=None, cache='cache'):
+    doc = {'command': 'tile', 'cache_identifier': cache, 'tiles': tiles}
+    return Task(id=name, doc=doc, priority=priority)
 
-        result = fan_in_queue([q1, q2, q3])
+class TestRenderQueueTileIndex(object):
+    def test_attach_to_running(self):
+        q = RenderQueue([0, 0], default_priority=50)
+        t1 = tile_task('meta1', [[0, 0, 1], [1, 0, 1]])
+        q.add(t1)
+        eq_(q.next(), t1)
 
-        q2.put(2)
-        q1.put(1)
-        q3.put(3)
+        t2 = tile_task('meta2', [[1, 0, 1], [2, 0, 1]])
+        q.add(t2)
+        # tile [1, 0, 1] is rendered by t1
+        eq_(t2.doc['tiles'], [(2, 0, 1)])
+        eq_(q.next(), t2)
+
+        # t2 waits for t1
+        eq_(q.remove(('meta2', 'tile')), [])
+        eq_(q.attached, 1)
+        eq_(q.remove(('meta1', 'tile')), [t1, t2])
+        eq_(q.attached, 0)
+        eq_(q.tile_producers, {})
+
+    def test_fully_attached(self):
+        q = RenderQueue([0, 0], default_priority=50)
+        t1 = tile_task('meta1', [[0, 0, 1], [1, 0, 1]])
+        t2 = tile_task('meta2', [[1, 0, 1], None])
+        q.add(t1)
+        q.add(t2)
+        eq_(q.waiting, 1)
+        eq_(q.attached, 1)
+        eq_(q.next(), t1)
+        assert not q.has_new_tasks()
+        eq_(q.remove(('meta1', 'tile')), [t1, t2])
+        eq_(q.attached, 0)
+
+    def test_other_cache(self):
+        q = RenderQueue([0, 0], default_priority=50)
+        q.add(tile_task('meta1', [[0, 0, 1]]))
+        q.add(tile_task('meta2', [[0, 0, 1]], cache='other'))
+        eq_(q.waiting, 2)
+        eq_(q.attached, 0)
+
+    def test_same_id(self):
+        q = RenderQueue([0, 0], default_priority=50)
+        t1 = tile_task('meta1', [[0, 0, 1]])
+        t2 = tile_task('meta1', [[0, 0, 1]])
+        q.add(t1)
+        q.add(t2)
+        # tasks with the same id are merged
+        eq_(q.waiting, 1)
+        eq_(q.attached, 0)
+        eq_(q.next(), t1)
+        assert not q.has_new_tasks()
+        eq_(q.remove(('meta1', 'tile')), [t1, t2])
+        eq_(q.tile_producers, {})
+
+    def test_same_id_other_command(self):
+        q = RenderQueue([0, 0], default_priority=50)
+        t1 = Task('meta1', {'command': 'render_tiles', 'cache_identifier': 'cache',
+            'tiles': [[0, 0, 1]]})
+        t2 = tile_task('meta1', [[1, 0, 1]])
+        t3 = tile_task('meta1', [[1, 0, 1]])
+        q.add(t1)
+        q.add(t2)
+        # only tasks with the same command are merged
+        eq_(q.waiting, 2)
+        eq_(q.next(), t1)
+        # merged into t2, not into the running t1
+        q.add(t3)
+        eq_(q.waiting, 1)
+        eq_(q.next(), t2)
+        eq_(q.remove(('meta1', 'tile')), [t2, t3])
+        eq_(q.remove(('meta1', 'render_tiles')), [t1])
+
+    def test_same_id_as_attached(self):
+        q = RenderQueue([0, 0], default_priority=50)
+        seed = tile_task('meta1', [[1, 0, 1]], priority=0)
+        q.add(seed)
+        seed2 = tile_task('meta1', [[1, 0, 1]], priority=0)
+        q.add(seed2)
+        t = tile_task('meta2', [[1, 0, 1]], priority=50)
+        q.add(t)
+        # seed is attached to t, including the merged seed2
+        eq_(q.waiting, 1)
+        eq_(q.attached, 1)
+        eq_(q.next(), t)
+        eq_(q.remove(('meta2', 'tile')), [t, seed, seed2])
+
+    def test_take_over_from_lower_priority(self):
+        q = RenderQueue([0, 0], default_priority=50)
+        seed = tile_task('meta1', [[0, 0, 1], [1, 0, 1]], priority=0)
+        q.add(seed)
+        t = tile_task('meta2', [[1, 0, 1], [2, 0, 1]], priority=50)
+        q.add(t)
+        eq_(t.doc['tiles'], [[1, 0, 1], [2, 0, 1]])
+        eq_(seed.doc['tiles'], [[0, 0, 1]])
+
+        eq_(q.next(), t)
+        eq_(q.next(), seed)
+        eq_(q.remove(('meta1', 'tile')), [])
+        eq_(q.remove(('meta2', 'tile')), [t, seed])
+
+    def test_take_over_all_tiles(self):
+        q = RenderQueue([0, 0], default_priority=50)
+        seed = tile_task('meta1', [[1, 0, 1]], priority=0)
+        q.add(seed)
+        t = tile_task('meta2', [[1, 0, 1], [2, 0, 1]], priority=50)
+        q.add(t)
+        eq_(q.waiting, 1)
+        eq_(q.attached, 1)
+        eq_(q.next(), t)
+        assert not q.has_new_tasks()
+        eq_(q.remove(('meta2', 'tile')), [t, seed])
+
+    def test_take_over_all_tiles_with_dependents(self):
+        q = RenderQueue([0, 0], default_priority=50)
+        e = tile_task('E', [[1, 0, 1]], priority=10)
+        q.add(e)
+        d = tile_task('D', [[1, 0, 1]], priority=10)
+        q.add(d)
+        # d waits for the tile of e
+        eq_(q.attached, 1)
+        n = tile_task('N', [[1, 0, 1]], priority=50)
+        q.add(n)
+        # n takes the only tile of e
+        eq_(q.attached, 2)
+        eq_(q.next(), n)
+        eq_(q.remove(('N', 'tile')), [n, e, d])
+        eq_(q.attached, 0)
+        eq_(q.pending_producers, {})
+        eq_(q.tile_dependents, {})
+
+    def test_take_over_all_tiles_failed(self):
+        q = RenderQueue([0, 0], default_priority=50)
+        e = tile_task('E', [[1, 0, 1]], priority=10)
+        d = tile_task('D', [[1, 0, 1]], priority=10)
+        n = tile_task('N', [[1, 0, 1]], priority=50)
+        for t in [e, d, n]:
+            q.add(t)
+        q.next()
+        result = Task('N', {'status': 'error'})
+        eq_(q.remove(('N', 'tile'), result), [n, e, d])
+        assert e.failed_result is result
+        assert d.failed_result is result
+
+    def test_attach_to_higher_priority(self):
+        q = RenderQueue([0, 0], default_priority=50)
+        t = tile_task('meta1', [[1, 0, 1]], priority=50)
+        q.add(t)
+        seed = tile_task('meta2', [[1, 0, 1], [2, 0, 1]], priority=0)
+        q.add(seed)
+        eq_(seed.doc['tiles'], [(2, 0, 1)])
+        eq_(t.doc['tiles'], [[1, 0, 1]])
+
+    def test_failed_result(self):
+        q = RenderQueue([0, 0], default_priority=50)
+        t1 = tile_task('meta1', [[1, 0, 1]])
+        t2 = tile_task('meta2', [[1, 0, 1]])
+        q.add(t1)
+        q.add(t2)
+        q.next()
+        result = Task('meta1', {'status': 'error'})
+        eq_(q.remove(('meta1', 'tile'), result), [t1, t2])
+        assert t2.failed_result is result
 
-        results = set([
-            result.get(),
-            result.get(),
-            result.get(),
-        ])
+class TestRenderQueueBatch(object):
+    def test_next_batch(self):
+        q = RenderQueue([0, 0], default_priority=50)
+        t1 = tile_task('meta1', [[0, 0, 1]], priority=0)
+        t2 = tile_task('meta2', [[1, 0, 1]], priority=0)
+        t3 = tile_task('meta3', [[2, 0, 1]], priority=0, cache='other')
+        t4 = tile_task('meta4', [[3, 0, 1]], priority=10)
+        t5 = tile_task('meta5', [[4, 0, 1]], priority=0)
+        t6 = tile_task('meta6', [[5, 0, 1]], priority=0)
+        for t in [t1, t2, t3, t4, t5, t6]:
+            q.add(t)
+
+        eq_(q.next(), t4)
+        # only same cache and priority
+        eq_(q.next_batch(t4, 5), [])
+        eq_(q.next(), t1)
+        eq_(q.next_batch(t1, 2), [t2, t5])
+        eq_(q.running, 4)
+        eq_(q.waiting, 2)
 
-        eq_(results, set([
-            (q1, 1),
-            (q2, 2),
-            (q3, 3),
-        ]))
+        # batched tasks do not occupy a process
+        assert not q.has_new_tasks()
+        q.remove(('meta4', 'tile'))
+        assert q.has_new_tasks()
+
+        eq_(q.remove(('meta1', 'tile')), [t1])
+        eq_(q.remove(('meta2', 'tile')), [t2])
+        eq_(q.remove(('meta5', 'tile')), [t5])
+        eq_(q.running, 0)
+        eq_(q.next(), t3)
+        eq_(q.next(), t6)
 
+    def test_next_batch_other_tasks(self):
+        q = RenderQueue([0], default_priority=50)
+        t1 = task('foo', 0)
+        q.add(t1)
+        q.add(task('bar', 0))
+        eq_(q.next(), t1)
+        eq_(q.next_batch(t1, 5), [])
 
+    def test_next_batch_promoted(self):
+        q = RenderQueue([0], default_priority=50)
+        t1 = tile_task('meta1', [[0, 0, 1]], priority=50)
+        t2 = tile_task('meta2', [[1, 0, 1]], priority=0)
+        q.add(t1)
+        q.add(t2)
+        q.add(tile_task('meta2', [[1, 0, 1]], priority=50))
+        eq_(q.next(), t1)
+        eq_(q.next_batch(t1, 5), [t2])
+
+class TestRenderQueueAbandoned(object):
+    def test_is_abandoned(self):
+        q = RenderQueue([0], default_priority=50)
+        t1 = task('foo', 0)
+        t2 = task('foo', 0)
+        q.add(t1)
+        q.add(t2)
+        eq_(q.next(), t1)
+        assert not q.is_abandoned(t1)
+        t1.cancelled = True
+        # t2 is merged into t1 and still waiting
+        assert not q.is_abandoned(t1)
+        t2.deadline = time.time() - 1
+        assert q.is_abandoned(t1)
+
+    def test_is_abandoned_tile_dependents(self):
+        q = RenderQueue([0], default_priority=50)
+        t1 = tile_task('meta1', [[0, 0, 1]])
+        t2 = tile_task('meta2', [[0, 0, 1]])
+        q.add(t1)
+        q.add(t2)
+        eq_(q.next(), t1)
+        t1.cancelled = True
+        assert not q.is_abandoned(t1)
+        t2.cancelled = True
+        assert q.is_abandoned(t1)
+
+class TestWakeupQueue(object):
+    def test_get_all(self):
+        q = WakeupQueue()
+        eq_(q.get_all(), [])
+        q.put(1)
+        q.put(2)
+        eq_(len(q), 2)
+        eq_(q.get_all(), [1, 2])
+        eq_(q.get_all(), [])
+        q.close()
+
+    def test_wait_readable(self):
+        q1 = WakeupQueue()
+        q2 = WakeupQueue()
+        eq_(wait_readable([q1, q2], timeout=0), [])
+        q2.put('foo')
+        eq_(wait_readable([q1, q2], timeout=0), [q2])
+        eq_(q2.get_all(), ['foo'])
+        eq_(wait_readable([q1, q2], timeout=0), [])
+
+    def test_many_items(self):
+        q = WakeupQueue()
+        # more items than fit into the wakeup pipe
+        for i in range(100000):
+            q.put(i)
+        eq_(wait_readable([q], timeout=0), [q])
+        eq_(q.get_all(), list(range(100000)))
+        eq_(wait_readable([q], timeout=0), [])
+
+    def test_wait_multiprocessing_queue(self):
+        q1 = WakeupQueue()
+        q2 = multiprocessing.Queue()
+        q2.put(1)
+        q2.put(2)
+        eq_(wait_readable([q1, q2], timeout=1), [q2])
+        results = []
+        while len(results) < 2:
+            results.extend(drain_queue(q2))
+        eq_(results, [1, 2])
@@ -0,0 +1,80 @@
+# This file is part of the MapProxy project.
+# Copyright (C) 2013 Omniscale GmbH & Co. KG <http://omniscale.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mp_renderd.recent import RecentResults
+from mp_renderd.task import Task
+
+from nose.tools import eq_
+
+def ok_result(id):
+    return Task(id, {'status': 'ok'})
+
+class TestRecentResults(object):
+    def test_get(self):
+        recent = RecentResults(ttl=2)
+        task = Task(1, {'command': 'tile'})
+        result = ok_result(1)
+        eq_(recent.get(task, now=100), None)
+        recent.add(task, result, now=100)
+        eq_(recent.get(Task(1, {'command': 'tile'}), now=101).doc, result.doc)
+        eq_(recent.get(Task(1, {'command': 'render_tiles'}), now=101), None)
+        eq_(recent.get(Task(1, {'command': 'tile'}), now=102), None)
+        eq_((recent.hits, recent.misses), (1, 3))
+
+    def test_trace(self):
+        recent = RecentResults(ttl=2)
+        result = ok_result(1)
+        result.stamp('dispatched', 98)
+        result.stamp('worker_end', 99)
+        recent.add(Task(1, {}), result, now=100)
+        cached = recent.get(Task(1, {}), now=101)
+        eq_(cached.trace, {'recent_result': 101})
+        eq_(result.trace['dispatched'], 98)
+
+    def test_refresh_before(self):
+        recent = RecentResults(ttl=2)
+        result = ok_result(1)
+        result.stamp('worker_end', 99)
+        recent.add(Task(1, {}), result, now=100)
+        task = Task(1, {})
+        task.refresh_before = 99.5
+        eq_(recent.get(task, now=101), None)
+        task.refresh_before = 98
+        assert recent.get(task, now=101) is not None
+        eq_((recent.hits, recent.misses), (1, 1))
+
+    def test_only_ok_results(self):
+        recent = RecentResults()
+        task = Task(1, {'command': 'tile'})
+        recent.add(task, Task(1, {'status': 'error'}))
+        result = ok_result(1)
+        result.tile_data = object()
+        recent.add(task, result)
+        eq_(len(recent), 0)
+
+    def test_lru(self):
+        recent = RecentResults(ttl=10, max_size=2)
+        for i in range(2):
+            recent.add(Task(i, {}), ok_result(i), now=100)
+        # 0 is used more recently than 1
+        assert recent.get(Task(0, {}), now=100) is not None
+        recent.add(Task(2, {}), ok_result(2), now=100)
+        eq_(sorted(k[0] for k in recent.results), [0, 2])
+
+    def test_expire(self):
+        recent = RecentResults(ttl=1)
+        recent.add(Task(1, {}), ok_result(1), now=100)
+        recent.add(Task(2, {}), ok_result(2), now=102)
+        eq_(list(recent.results), [(2, None)])
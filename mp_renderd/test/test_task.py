@@ -0,0 +1,43 @@
+# This file is part of the MapProxy project.
+# Copyright (C) 2013 Omniscale GmbH & Co. KG <http://omniscale.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mp_renderd.task import Task, request_trace, trace_durations
+
+from nose.tools import eq_
+
+def test_request_trace():
+    result = Task(1, {'status': 'ok'})
+    for stage, t in [('accepted', 1.0), ('enqueued', 2.0), ('dispatched', 4.0),
+        ('worker_start', 5.0), ('worker_end', 7.0), ('result_received', 8.0)]:
+        result.stamp(stage, t)
+    # merged task that arrived while the first task was running
+    task = Task(1, {})
+    task.stamp('accepted', 4.5)
+    task.stamp('enqueued', 4.6)
+    task.stamp('responded', 9.0)
+    eq_(request_trace(task, result), {
+        'accepted': 4.5,
+        'enqueued': 4.6,
+        'dispatched': 4.0,
+        'worker_start': 5.0,
+        'worker_end': 7.0,
+        'result_received': 8.0,
+        'responded': 9.0,
+    })
+
+def test_trace_durations():
+    eq_(trace_durations({}), {})
+    eq_(trace_durations({'accepted': 1.0, 'dispatched': 1.5, 'responded': 3.0}),
+        {'accepted-dispatched': 0.5, 'dispatched-responded': 1.5})
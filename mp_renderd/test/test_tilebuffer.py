@@ -0,0 +1,108 @@
+# This file is part of the MapProxy project.
+# Copyright (C) 2013 Omniscale GmbH & Co. KG <http://omniscale.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import multiprocessing
+
+from mp_renderd.tilebuffer import TileBuffer, TileData
+
+from nose.tools import eq_
+
+def write_tile(tile_buffer, data, queue):
+    queue.put(tile_buffer.write(data))
+
+def die_with_lock(tile_buffer):
+    tile_buffer._lock.__enter__()
+    os._exit(1)
+
+class TestTileBuffer(object):
+    def setup(self):
+        self.buf = TileBuffer(4 * 1024, block_size=1024)
+
+    def test_write_view(self):
+        offset = self.buf.write('foo')
+        eq_(str(self.buf.view(offset, 3)), 'foo')
+        eq_(self.buf.used(), 1024)
+        offset2 = self.buf.write('x' * 1500)
+        eq_(offset2, 1024)
+        eq_(self.buf.used(), 3072)
+        self.buf.release(offset)
+        self.buf.release(offset2)
+        eq_(self.buf.used(), 0)
+
+    def test_full(self):
+        offsets = [self.buf.write('x' * 1024) for _ in range(4)]
+        eq_(offsets, [0, 1024, 2048, 3072])
+        eq_(self.buf.write('x'), None)
+        self.buf.release(1024)
+        eq_(self.buf.write('x' * 2000), None)
+        # next allocation wraps around to the free block
+        eq_(self.buf.write('x'), 1024)
+
+    def test_claim(self):
+        offset = self.buf.write('foo')
+        assert not self.buf.claim(offset, os.getpid() + 1)
+        assert self.buf.claim(offset, os.getpid())
+        # claimed allocations are no orphans
+        eq_(self.buf.release_orphans([]), 0)
+        assert not self.buf.claim(offset, os.getpid())
+
+    def test_release_orphans(self):
+        offset = self.buf.write('foo')
+        eq_(self.buf.release_orphans([os.getpid()]), 0)
+        eq_(self.buf.release_orphans([]), 1)
+        eq_(self.buf.used(), 0)
+        assert not self.buf.claim(offset, os.getpid())
+
+    def test_write_from_process(self):
+        q = multiprocessing.Queue()
+        p = multiprocessing.Process(target=write_tile, args=(self.buf, 'foobar', q))
+        p.start()
+        offset = q.get()
+        p.join()
+        assert self.buf.claim(offset, p.pid)
+        eq_(str(self.buf.view(offset, 6)), 'foobar')
+
+    def test_process_dies_with_lock(self):
+        p = multiprocessing.Process(target=die_with_lock, args=(self.buf, ))
+        p.start()
+        p.join()
+        offset = self.buf.write('foo')
+        eq_(offset, 0)
+        eq_(self.buf.release_orphans([os.getpid()]), 0)
+
+    def test_release_partial_allocation(self):
+        # process died after it marked the first of three blocks
+        self.buf._owners[0] = os.getpid() + 1
+        self.buf._blocks[0] = 3
+        self.buf._blocks[1] = -1
+        offset = self.buf.write('x' * 1024)
+        eq_(offset, 2048)
+        eq_(self.buf.release_orphans([os.getpid()]), 1)
+        eq_(self.buf.used(), 1024)
+        assert self.buf.claim(offset, os.getpid())
+
+    def test_tile_data(self):
+        tiles = []
+        for data in ['foo', 'barbaz']:
+            offset = self.buf.write(data)
+            self.buf.claim(offset, os.getpid())
+            tiles.append({'tile': [0, 0, 1], 'offset': offset, 'length': len(data)})
+        tile_data = TileData(self.buf, tiles)
+        eq_(tile_data.length, 9)
+        eq_(''.join(str(c) for c in tile_data.chunks()), 'foobarbaz')
+        eq_(self.buf.used(), 2048)
+        del tile_data
+        eq_(self.buf.used(), 0)
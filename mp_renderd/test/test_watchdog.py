@@ -0,0 +1,37 @@
+# This file is part of the MapProxy project.
+# Copyright (C) 2013 Omniscale GmbH & Co. KG <http://omniscale.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mp_renderd.task import Task
+from mp_renderd.watchdog import TimeBudgets
+
+from nose.tools import eq_
+
+def tile_task(cache_identifier):
+    return Task('foo', {'command': 'tile', 'cache_identifier': cache_identifier,
+        'tiles': [[0, 0, 1]]})
+
+class TestTimeBudgets(object):
+    def setup(self):
+        self.budgets = TimeBudgets(commands={'tile': 60}, caches={'slow': 300})
+
+    def test_budget(self):
+        eq_(self.budgets.budget(tile_task('osm')), 60)
+        eq_(self.budgets.budget(tile_task('slow')), 300)
+        eq_(self.budgets.budget(Task('foo', {'command': 'other'})), None)
+
+    def test_deadline(self):
+        eq_(self.budgets.deadline([tile_task('osm')], 1000), 1060)
+        eq_(self.budgets.deadline([tile_task('osm'), tile_task('slow')], 1000), 1360)
+        eq_(self.budgets.deadline([tile_task('osm'), Task('foo', {'command': 'other'})], 1000), None)
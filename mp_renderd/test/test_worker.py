@@ -15,6 +15,9 @@
 
 import time
 import multiprocessing
+import shutil
+import tempfile
+from cStringIO import StringIO
 
 from mp_renderd.queue import STOP
 from mp_renderd.task import Task
@@ -22,6 +25,7 @@ from mp_renderd.task import Task
 from nose.tools import eq_
 from mp_renderd.worker import BaseWorker
 from mp_renderd.worker import SeedWorker
+from mp_renderd.tilebuffer import TileBuffer
 
 class SleepWorker(BaseWorker):
     def do_sleep(self, doc):
@@ -47,6 +51,7 @@ class TestSleepWorker(object):
         assert self.worker.handle_task_message()
         result = self.out_queue.get()
         eq_(result.doc, {'status': 'ok'})
+        assert result.trace['worker_start'] <= result.trace['worker_end']
 
 class TestBaseWorker(object):
     def setup(self):
@@ -66,6 +71,15 @@ class TestBaseWorker(object):
         self.worker.in_queue.put(STOP)
         assert not self.worker.handle_task_message()
 
+    def test_dispatch_batch_without_batch_method(self):
+        self.worker.dispatch_batch([
+            Task('foo', doc={'command': 'foo'}),
+            Task('bar', doc={'command': 'foo'}),
+        ])
+        assert self.worker.handle_task_message()
+        results = self.out_queue.get()
+        eq_([r.doc['error_message'] for r in results], ['unknown command: foo'] * 2)
+
 class ExceptionWorker(BaseWorker):
     def do_exception(self, doc):
         raise ValueError('foo')
@@ -84,6 +98,26 @@ class TestExceptionWorker(object):
         eq_(result.doc['error_message'], "exception while processing 'exception': foo")
         assert 'raise ValueError' in result.doc['error_detail']
 
+class TestThreadedWorker(object):
+    def setup(self):
+        self.in_queue = multiprocessing.Queue()
+        self.out_queue = multiprocessing.Queue()
+        self.worker = SleepWorker(in_queue=self.in_queue, out_queue=self.out_queue,
+            threads=4)
+
+    def test_parallel_tasks(self):
+        self.worker.start()
+        start = time.time()
+        for i in range(4):
+            self.worker.dispatch(Task(i, doc={'command': 'sleep', 'time': 0.3}))
+        results = [self.out_queue.get() for _ in range(4)]
+        assert time.time() - start < 1.0
+        eq_(sorted(r.id for r in results), [0, 1, 2, 3])
+
+        self.in_queue.put(STOP)
+        self.worker.join(2)
+        assert not self.worker.is_alive()
+
 class DummyCache(object):
     def __init__(self):
         self.requested_tiles = []
@@ -91,6 +125,16 @@ class DummyCache(object):
     def load_tile_coords(self, tiles):
         self.requested_tiles.extend(tiles)
 
+class DummyTileManager(DummyCache):
+    format = 'image/png'
+
+    def load_tile_coords(self, tiles):
+        from mapproxy.cache.tile import Tile
+        from mapproxy.image import ImageSource
+        DummyCache.load_tile_coords(self, tiles)
+        return [Tile(coord, ImageSource(StringIO('tile %d %d %d' % coord)))
+            for coord in tiles]
+
 class TestSeedWorker(object):
     def setup(self):
         self.in_queue = multiprocessing.Queue(2)
@@ -112,6 +156,29 @@ class TestSeedWorker(object):
         eq_(result.doc, {'status': 'ok'})
         eq_(self.caches['test_cache'].requested_tiles, [(0, 0, 0)])
 
+    def test_create_tile_batch(self):
+        self.worker.dispatch_batch([
+            Task('foo', doc={'command': 'tile', 'cache_identifier': 'test_cache', 'tiles': [[0, 0, 0]]}),
+            Task('bar', doc={'command': 'tile', 'cache_identifier': 'test_cache', 'tiles': [[5, 0, 0], None]}),
+        ])
+        assert self.worker.handle_task_message()
+        results = self.out_queue.get()
+        eq_([r.id for r in results], ['foo', 'bar'])
+        eq_([r.doc for r in results], [{'status': 'ok'}, {'status': 'ok'}])
+        eq_(self.caches['test_cache'].requested_tiles, [(0, 0, 0), (5, 0, 0)])
+
+    def test_create_tile_batch_unknown_cache(self):
+        self.worker.dispatch_batch([
+            Task('foo', doc={'command': 'tile', 'cache_identifier': 'unknown', 'tiles': [[0, 0, 0]]}),
+            Task('bar', doc={'command': 'tile', 'cache_identifier': 'unknown', 'tiles': [[5, 0, 0]]}),
+        ])
+        assert self.worker.handle_task_message()
+        results = self.out_queue.get()
+        eq_([r.doc for r in results], [
+            {'status': 'error', 'error_message': "unknown cache 'unknown'"},
+            {'status': 'error', 'error_message': "unknown cache 'unknown'"},
+        ])
+
     def test_create_tile_unknown_cache(self):
         self.worker.dispatch(Task('foo', doc={'command': 'tile', 'cache_identifier': 'unknown', 'tiles': [[0, 0, 0]]}))
         assert self.worker.handle_task_message()
@@ -135,4 +202,105 @@ class TestSeedWorker(object):
             result = self.out_queue.get()
             eq_(result.doc, {'status': 'ok'})
 
-        eq_(list(self.caches['test_cache'].requested_tiles), [(0, 0, 0), (5, 0, 0), (5, 1, 0), (5, 2, 0), (2, 3, 4)])
\ No newline at end of file
+        eq_(list(self.caches['test_cache'].requested_tiles), [(0, 0, 0), (5, 0, 0), (5, 1, 0), (5, 2, 0), (2, 3, 4)])
+
+
+class TestSeedWorkerFreshTiles(object):
+    def setup(self):
+        from mapproxy.cache.file import FileCache
+        self.tmp_dir = tempfile.mkdtemp()
+        self.in_queue = multiprocessing.Queue(2)
+        self.out_queue = multiprocessing.Queue(2)
+        self.tile_manager = DummyCache()
+        self.tile_manager.cache = FileCache(self.tmp_dir, 'png')
+        self.worker = SeedWorker(
+            caches={'test_cache': self.tile_manager},
+            base_config={},
+            in_queue=self.in_queue,
+            out_queue=self.out_queue,
+        )
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def store_tile(self, coord):
+        from mapproxy.cache.tile import Tile
+        from mapproxy.image import BlankImageSource
+        from mapproxy.image.opts import ImageOptions
+        self.tile_manager.cache.store_tile(Tile(coord,
+            BlankImageSource((256, 256), ImageOptions(format='image/png'))))
+
+    def test_skip_fresh_tiles(self):
+        self.store_tile((0, 0, 1))
+        self.worker.dispatch(Task('foo', doc={'command': 'tile', 'cache_identifier': 'test_cache',
+            'tiles': [[0, 0, 1], [1, 0, 1]], 'refresh_before': time.time() - 60}))
+        assert self.worker.handle_task_message()
+        eq_(self.out_queue.get().doc, {'status': 'ok'})
+        eq_(self.tile_manager.requested_tiles, [(1, 0, 1)])
+
+    def test_all_fresh(self):
+        self.store_tile((0, 0, 1))
+        self.worker.dispatch_batch([
+            Task('foo', doc={'command': 'tile', 'cache_identifier': 'test_cache',
+                'tiles': [[0, 0, 1]], 'refresh_before': time.time() - 60}),
+            Task('bar', doc={'command': 'tile', 'cache_identifier': 'test_cache',
+                'tiles': [[0, 0, 1], None], 'refresh_before': time.time() - 60}),
+        ])
+        assert self.worker.handle_task_message()
+        eq_([r.doc for r in self.out_queue.get()], [{'status': 'ok'}, {'status': 'ok'}])
+        eq_(self.tile_manager.requested_tiles, [])
+
+    def test_outdated_tiles(self):
+        self.store_tile((0, 0, 1))
+        self.worker.dispatch(Task('foo', doc={'command': 'tile', 'cache_identifier': 'test_cache',
+            'tiles': [[0, 0, 1]], 'refresh_before': time.time() + 60}))
+        assert self.worker.handle_task_message()
+        eq_(self.out_queue.get().doc, {'status': 'ok'})
+        eq_(self.tile_manager.requested_tiles, [(0, 0, 1)])
+
+class TestSeedWorkerRenderTiles(object):
+    def setup(self):
+        from mapproxy.cache.file import FileCache
+        self.tmp_dir = tempfile.mkdtemp()
+        self.in_queue = multiprocessing.Queue(2)
+        self.out_queue = multiprocessing.Queue(2)
+        self.tile_manager = DummyTileManager()
+        self.tile_manager.cache = FileCache(self.tmp_dir, 'png')
+        self.tile_buffer = TileBuffer(1024 * 1024)
+        self.worker = SeedWorker(
+            caches={'test_cache': self.tile_manager},
+            base_config={},
+            tile_buffer=self.tile_buffer,
+            in_queue=self.in_queue,
+            out_queue=self.out_queue,
+        )
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_render_tiles(self):
+        from mapproxy.cache.tile import Tile
+        from mapproxy.image import ImageSource
+        self.tile_manager.cache.store_tile(Tile((0, 0, 1), ImageSource(StringIO('cached'))))
+
+        self.worker.dispatch(Task('foo', doc={'command': 'render_tiles', 'cache_identifier': 'test_cache',
+            'tiles': [[0, 0, 1], [1, 0, 1], None], 'refresh_before': time.time() - 60}))
+        assert self.worker.handle_task_message()
+        result = self.out_queue.get()
+        eq_(result.doc['status'], 'ok')
+        eq_(result.doc['format'], 'image/png')
+        eq_(self.tile_manager.requested_tiles, [(1, 0, 1)])
+
+        tiles = result.doc['tile_data']
+        eq_([t['tile'] for t in tiles], [[0, 0, 1], [1, 0, 1]])
+        eq_([str(self.tile_buffer.view(t['offset'], t['length'])) for t in tiles],
+            ['cached', 'tile 1 0 1'])
+        assert all(self.tile_buffer.claim(t['offset'], result.worker_pid) for t in tiles)
+
+    def test_no_tile_buffer(self):
+        self.worker.tile_buffer = None
+        self.worker.dispatch(Task('foo', doc={'command': 'render_tiles', 'cache_identifier': 'test_cache',
+            'tiles': [[0, 0, 1]]}))
+        assert self.worker.handle_task_message()
+        eq_(self.out_queue.get().doc['status'], 'error')
+        eq_(self.tile_manager.requested_tiles, [])
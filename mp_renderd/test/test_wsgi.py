@@ -0,0 +1,225 @@
+# This file is part of the MapProxy project.
+# Copyright (C) 2013 Omniscale GmbH & Co. KG <http://omniscale.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import time
+import socket
+from cStringIO import StringIO
+
+from mp_renderd.wsgi import RenderdApp, BadRequest, parse_batch
+from mp_renderd.test.test_eventserver import DummyBroker
+
+from nose.tools import eq_, raises
+
+def environ(path, body):
+    return {
+        'REQUEST_METHOD': 'POST',
+        'PATH_INFO': path,
+        'SCRIPT_NAME': '',
+        'QUERY_STRING': '',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': StringIO(body),
+        'wsgi.url_scheme': 'http',
+        'HTTP_HOST': 'localhost',
+    }
+
+def test_parse_batch():
+    eq_(parse_batch('[{"id": 1}, {"id": 2}]'), [{'id': 1}, {'id': 2}])
+    eq_(parse_batch('{"id": 1}\n\n{"id": 2}\n'), [{'id': 1}, {'id': 2}])
+    eq_(parse_batch(''), [])
+
+@raises(BadRequest)
+def test_parse_batch_no_objects():
+    parse_batch('[1, 2]')
+
+@raises(BadRequest)
+def test_parse_batch_invalid_json():
+    parse_batch('{"id": 1}\nno json')
+
+def environ_get(path, query=''):
+    env = environ(path, '')
+    env['REQUEST_METHOD'] = 'GET'
+    env['QUERY_STRING'] = query
+    return env
+
+class TestRequest(object):
+    def setup(self):
+        self.broker = DummyBroker()
+        self.app = RenderdApp(self.broker)
+
+    def teardown(self):
+        self.broker.shutdown()
+
+    def request(self, env):
+        status = []
+        def start_response(s, headers):
+            status.append(s)
+        body = ''.join(self.app(env, start_response))
+        return status[0], json.loads(body)
+
+    def test_bad_request(self):
+        for body in ['[1, 2]', '"foo"', 'no json']:
+            status, doc = self.request(environ('/', body))
+            eq_(status, '400 Bad Request')
+            eq_(doc['status'], 'error')
+        for timeout in ['abc', 'nan', -1, 0, [1]]:
+            status, doc = self.request(environ('/',
+                json.dumps({'command': 'tile', 'timeout': timeout})))
+            eq_(status, '400 Bad Request')
+            assert 'invalid timeout' in doc['error_message']
+        env = environ('/', json.dumps({'command': 'tile'}))
+        env['HTTP_X_RENDERD_TIMEOUT'] = 'abc'
+        status, doc = self.request(env)
+        eq_(status, '400 Bad Request')
+        eq_(self.broker.tasks, [])
+
+class TestJobs(object):
+    def setup(self):
+        self.broker = DummyBroker()
+        self.app = RenderdApp(self.broker)
+
+    def teardown(self):
+        self.broker.shutdown()
+
+    def request(self, env):
+        status = []
+        def start_response(s, headers):
+            status.append((s, dict(headers)))
+        body = ''.join(self.app(env, start_response))
+        return status[0][0], status[0][1], json.loads(body)
+
+    def test_submit_wait(self):
+        status, headers, doc = self.request(environ('/jobs',
+            json.dumps({'command': 'tile', 'id': 'foo', 'sleep': 0.2})))
+        eq_(status, '202 Accepted')
+        eq_(doc['state'], 'pending')
+        eq_(doc['id'], 'foo')
+        eq_(headers['Location'], '/jobs/' + doc['job_id'])
+
+        status, _, doc = self.request(environ_get(headers['Location']))
+        eq_(status, '200 OK')
+        eq_(doc['state'], 'pending')
+        assert 'result' not in doc
+
+        status, _, doc = self.request(environ_get(headers['Location'], 'wait=5'))
+        eq_(doc['state'], 'done')
+        eq_(doc['result']['status'], 'ok')
+
+    def test_wait_timeout(self):
+        _, headers, _ = self.request(environ('/jobs',
+            json.dumps({'command': 'tile', 'sleep': 2})))
+        start = time.time()
+        _, _, doc = self.request(environ_get(headers['Location'], 'wait=0.1'))
+        eq_(doc['state'], 'pending')
+        assert time.time() - start < 1
+
+    def test_rejected(self):
+        status, _, doc = self.request(environ('/jobs',
+            json.dumps({'command': 'tile', 'reject': 'too many'})))
+        eq_(status, '503 Service Unavailable')
+        eq_(doc['status'], 'overload')
+
+    def test_bad_request(self):
+        for body in ['[1, 2]', '"foo"', 'no json']:
+            status, _, doc = self.request(environ('/jobs', body))
+            eq_(status, '400 Bad Request')
+            eq_(doc['status'], 'error')
+        _, headers, _ = self.request(environ('/jobs', json.dumps({'command': 'tile'})))
+        for wait in ['abc', 'nan']:
+            status, _, doc = self.request(environ_get(headers['Location'], 'wait=' + wait))
+            eq_(status, '400 Bad Request')
+            assert 'invalid wait' in doc['error_message']
+
+    def test_unknown_job(self):
+        status, _, doc = self.request(environ_get('/jobs/foo'))
+        eq_(status, '404 Not Found')
+
+class TestBatch(object):
+    def setup(self):
+        self.broker = DummyBroker()
+        self.app = RenderdApp(self.broker)
+
+    def teardown(self):
+        self.broker.shutdown()
+
+    def request(self, docs):
+        body = '\n'.join(json.dumps(d) for d in docs)
+        status = []
+        def start_response(s, headers):
+            status.append(s)
+        lines = list(self.app(environ('/batch', body), start_response))
+        return status[0], [json.loads(l) for l in lines]
+
+    def test_batch(self):
+        status, lines = self.request([
+            {'command': 'tile', 'id': 'slow', 'sleep': 0.2},
+            {'command': 'tile', 'id': 'fast'},
+            {'command': 'tile', 'reject': 'too many'},
+        ])
+        eq_(status, '200 OK')
+        eq_([(l['index'], l['status']) for l in lines],
+            [(2, 'overload'), (1, 'ok'), (0, 'ok')])
+        eq_(lines[1]['id'], 'fast')
+
+    def test_trace(self):
+        status, lines = self.request([
+            {'command': 'tile', 'id': 'foo', 'trace': True},
+            {'command': 'tile', 'id': 'bar'},
+        ])
+        lines = dict((l['id'], l) for l in lines)
+        eq_(sorted(lines['foo']['trace']), ['accepted', 'responded'])
+        assert 'trace' not in lines['bar']
+
+    def test_timeout(self):
+        status, lines = self.request([
+            {'command': 'tile', 'id': 'slow', 'sleep': 2, 'timeout': 0.1},
+        ])
+        eq_([(l['id'], l['status']) for l in lines], [('slow', 'expired')])
+        assert self.broker.tasks[0].cancelled
+
+    def test_bad_request(self):
+        for body in ['[1, 2]', 'no json', '{"id": 1}\n[1]']:
+            status = []
+            def start_response(s, headers):
+                status.append(s)
+            doc = json.loads(''.join(self.app(environ('/batch', body), start_response)))
+            eq_(status, ['400 Bad Request'])
+            eq_(doc['status'], 'error')
+
+    def test_client_check_with_results(self):
+        self.app.client_check_interval = 0.1
+        docs = [{'command': 'tile', 'id': i, 'sleep': 0.03 * i} for i in range(1, 31)]
+        body = '\n'.join(json.dumps(d) for d in docs)
+        # client that sent the request and closed the connection
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        client = socket.create_connection(listener.getsockname())
+        server, _ = listener.accept()
+        listener.close()
+        client.sendall(body)
+        client.close()
+        env = environ('/batch', body)
+        env['wsgi.input'] = server.makefile()
+        lines = list(self.app(env, lambda s, h: None))
+        # stopped while the other results arrived
+        assert len(lines) < 10, lines
+        server.close()
+
+    def test_cancel_on_close(self):
+        body = json.dumps({'command': 'tile', 'sleep': 2})
+        chunks = self.app(environ('/batch', body), lambda s, h: None)
+        chunks.close()
+        assert self.broker.tasks[0].cancelled
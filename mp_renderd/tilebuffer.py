@@ -0,0 +1,221 @@
+# This file is part of the MapProxy project.
+# Copyright (C) 2013 Omniscale GmbH & Co. KG <http://omniscale.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import mmap
+import fcntl
+import tempfile
+import threading
+import multiprocessing
+import multiprocessing.util
+
+import logging
+log = logging.getLogger(__name__)
+
+class RecordLock(object):
+    """
+    Lock for multiple processes that the kernel releases when the
+    holding process dies, e.g. a render process that was terminated
+    while it allocated tiles.
+
+    It is a ``fcntl`` record lock on an unlinked temporary file. Record
+    locks do not exclude the threads of one process, so each process
+    also has its own thread lock.
+    """
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+        self._thread_lock = threading.Lock()
+        multiprocessing.util.register_after_fork(self, RecordLock._after_fork)
+
+    def _after_fork(self):
+        # another thread could hold the lock of the parent process
+        self._thread_lock = threading.Lock()
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        try:
+            fcntl.lockf(self._file.fileno(), fcntl.LOCK_EX)
+        except:
+            self._thread_lock.release()
+            raise
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.lockf(self._file.fileno(), fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+class TileBuffer(object):
+    """
+    Shared memory for the encoded tiles that render processes return.
+    The render processes write the tiles into the buffer and the
+    results only contain the offsets. The HTTP threads send the tiles
+    directly from the buffer.
+
+    The buffer needs to be created before the render processes are
+    started, they inherit the shared mapping.
+
+    The buffer is split into blocks of `block_size` bytes. Each write
+    allocates a range of blocks, starting behind the last allocation.
+    An allocation belongs to the render process that wrote it until
+    the broker claims it for the result (`claim`). A render process
+    can be terminated at any point of an allocation, the lock is
+    released by the kernel and the broker releases the partial
+    allocation with `release_orphans`.
+
+    :param size: size of the buffer in bytes
+    :param block_size: allocation unit in bytes
+    """
+    def __init__(self, size, block_size=64*1024):
+        self.block_size = block_size
+        self.num_blocks = max(1, size // block_size)
+        self.size = self.num_blocks * block_size
+        self._mmap = mmap.mmap(-1, self.size)
+        self._lock = RecordLock()
+        # number of blocks of the allocation at its first block,
+        # -1 for the following blocks and 0 for free blocks
+        self._blocks = multiprocessing.RawArray('i', self.num_blocks)
+        # pid of the render process that owns the allocation at its
+        # first block, 0 after the allocation was claimed
+        self._owners = multiprocessing.RawArray('i', self.num_blocks)
+        self._next = multiprocessing.RawValue('i', 0)
+
+    def write(self, data):
+        """
+        Copy `data` into the buffer. Returns the offset or ``None`` if
+        the buffer is full.
+        """
+        offset = self._alloc(len(data))
+        if offset is None:
+            return None
+        self._mmap[offset:offset + len(data)] = data
+        return offset
+
+    def _alloc(self, length):
+        num = max(1, -(-length // self.block_size))
+        with self._lock:
+            start = self._next.value
+            first = self._find_free(start, self.num_blocks, num)
+            if first is None:
+                first = self._find_free(0, start + num - 1, num)
+            if first is None:
+                return None
+            # owner first, a partial allocation is still an orphan
+            self._owners[first] = os.getpid()
+            self._blocks[first] = num
+            for i in xrange(first + 1, first + num):
+                self._blocks[i] = -1
+            self._next.value = (first + num) % self.num_blocks
+            return first * self.block_size
+
+    def _find_free(self, start, end, num):
+        end = min(end, self.num_blocks)
+        free = 0
+        for i in xrange(start, end):
+            if self._blocks[i] == 0:
+                free += 1
+                if free == num:
+                    return i - num + 1
+            else:
+                free = 0
+        return None
+
+    def view(self, offset, length):
+        """
+        Return the data at `offset` without copying it.
+        """
+        return buffer(self._mmap, offset, length)
+
+    def claim(self, offset, pid):
+        """
+        Take over the allocation at `offset` from the render process
+        `pid`. Returns ``False`` if the allocation was already released,
+        e.g. after the render process was terminated.
+        """
+        block = offset // self.block_size
+        with self._lock:
+            if self._blocks[block] <= 0 or self._owners[block] != pid:
+                return False
+            self._owners[block] = 0
+            return True
+
+    def release(self, offset):
+        block = offset // self.block_size
+        with self._lock:
+            self._free(block)
+
+    def _free(self, block):
+        num = self._blocks[block]
+        self._blocks[block] = 0
+        self._owners[block] = 0
+        # only the following blocks that were already marked, the rest
+        # of a partial allocation can belong to another allocation
+        for i in xrange(block + 1, min(block + num, self.num_blocks)):
+            if self._blocks[i] != -1:
+                break
+            self._blocks[i] = 0
+
+    def release_orphans(self, pids):
+        """
+        Release all unclaimed allocations of render processes that are
+        not in `pids`. Returns the number of released allocations.
+        """
+        pids = set(pids)
+        released = 0
+        with self._lock:
+            for block in xrange(self.num_blocks):
+                owner = self._owners[block]
+                if self._blocks[block] > 0 and owner and owner not in pids:
+                    self._free(block)
+                    released += 1
+        return released
+
+    def used(self):
+        """
+        Return the number of used bytes.
+        """
+        return sum(1 for b in self._blocks if b) * self.block_size
+
+class TileData(object):
+    """
+    Tiles of a result in the `tile_buffer`. Releases the tiles when
+    the object is garbage collected, i.e. when the last HTTP thread
+    sent the tiles.
+
+    :param tiles: list of dicts with ``tile``, ``offset`` and ``length``
+    """
+    def __init__(self, tile_buffer, tiles):
+        self.tile_buffer = tile_buffer
+        self.tiles = tiles
+        self.length = sum(t['length'] for t in tiles)
+        self._pid = os.getpid()
+        self._released = False
+
+    def chunks(self):
+        """
+        Yield the data of each tile without copying it.
+        """
+        for t in self.tiles:
+            yield self.tile_buffer.view(t['offset'], t['length'])
+
+    def release(self):
+        # processes that were forked from the broker process get
+        # copies of this object, only the broker process releases
+        if self._released or os.getpid() != self._pid:
+            return
+        self._released = True
+        for t in self.tiles:
+            self.tile_buffer.release(t['offset'])
+
+    def __del__(self):
+        self.release()
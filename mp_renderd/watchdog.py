@@ -0,0 +1,53 @@
+# This file is part of the MapProxy project.
+# Copyright (C) 2013 Omniscale GmbH & Co. KG <http://omniscale.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+class TimeBudgets(object):
+    """
+    Maximum render time of tasks. The broker terminates workers that
+    exceed the time budget of their task.
+
+    :param commands: dict with the time budget in seconds for each
+        command, e.g. ``{'tile': 120}``
+    :param caches: dict with the time budget in seconds for tile tasks
+        of a cache, overrides the budget of the command
+    """
+    def __init__(self, commands=None, caches=None):
+        self.commands = commands or {}
+        self.caches = caches or {}
+
+    def budget(self, task):
+        """
+        Return the time budget for `task` in seconds or ``None``.
+        """
+        doc = task.doc
+        if not isinstance(doc, dict):
+            return None
+        cache_identifier = doc.get('cache_identifier')
+        if cache_identifier in self.caches:
+            return self.caches[cache_identifier]
+        return self.commands.get(doc.get('command'))
+
+    def deadline(self, tasks, start):
+        """
+        Return the time when `tasks` (running in a single worker call)
+        exceed their budget, or ``None`` if they have no budget.
+        """
+        total = 0
+        for task in tasks:
+            budget = self.budget(task)
+            if budget is None:
+                return None
+            total += budget
+        return start + total
@@ -14,20 +14,34 @@
 # limitations under the License.
 
 import os
+import sys
+import resource
 import multiprocessing
+import threading
+import time
 import traceback
 import uuid
 
 from mp_renderd.queue import STOP
+from mp_renderd.connpool import HTTPConnectionPool
+from mp_renderd.freshness import fresh_tiles
 from mapproxy.util.lock import LockTimeout
 
 import logging
 log = logging.getLogger(__name__)
 
 class BaseWorker(multiprocessing.Process):
-    def __init__(self, in_queue, out_queue):
+    """
+    Worker process that handles the tasks from `in_queue` and puts
+    the results into `out_queue`.
+
+    :param threads: number of threads that handle tasks in parallel,
+        all threads share the `in_queue`
+    """
+    def __init__(self, in_queue, out_queue, threads=1):
         self.in_queue = in_queue
         self.out_queue = out_queue
+        self.threads = threads
         self.id = uuid.uuid4().hex
         multiprocessing.Process.__init__(self)
         self.daemon = True
@@ -36,8 +50,28 @@ class BaseWorker(multiprocessing.Process):
         task.worker_id = self.id
         self.in_queue.put(task)
 
+    def dispatch_batch(self, tasks):
+        """
+        Send multiple tasks with the same command as a single message.
+        The results are returned as a list of tasks.
+        """
+        for task in tasks:
+            task.worker_id = self.id
+        self.in_queue.put(tasks)
+
     def run(self):
-        log.debug('proc %d started', os.getpid())
+        log.debug('proc %d started with %d threads', os.getpid(), self.threads)
+        threads = []
+        for _ in xrange(self.threads - 1):
+            t = threading.Thread(target=self.handle_task_messages)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        self.handle_task_messages()
+        for t in threads:
+            t.join()
+
+    def handle_task_messages(self):
         while True:
             try:
                 if not self.handle_task_message():
@@ -46,52 +80,159 @@ class BaseWorker(multiprocessing.Process):
                 return
 
     def handle_task_message(self):
-        task = self.in_queue.get()
-        if task == STOP:
+        message = self.in_queue.get()
+        if message == STOP:
+            if self.threads > 1:
+                # stop the other threads as well
+                self.in_queue.put(STOP)
             return False
 
+        start = time.time()
+        if isinstance(message, list):
+            self.handle_batch(message)
+            end = time.time()
+            message[0].worker_rss = current_rss()
+            for task in message:
+                task.worker_pid = os.getpid()
+                task.stamp('worker_start', start)
+                task.stamp('worker_end', end)
+        else:
+            self.handle_task(message)
+            message.stamp('worker_start', start)
+            message.stamp('worker_end')
+            message.worker_rss = current_rss()
+            message.worker_pid = os.getpid()
+
+        self.out_queue.put(message)
+        return True
+
+    def handle_task(self, task):
         req_doc = task.doc
         command = req_doc.get('command', 'None')
         method = getattr(self, 'do_' + command, None)
         if not method:
-            resp = {
+            task.doc = {
                 'status': 'error',
                 'error_message': 'unknown command: %s' % command
             }
-        else:
-            try:
-                resp = method(req_doc)
-                if resp is None:
-                    resp = {}
-            except LockTimeout, ex:
-                resp = {
-                    'status': 'lock',
-                    'error_message': "lock timeout while processing '%s': %s"
-                        % (command, ex),
-                    'error_detail': traceback.format_exc()
-                }
-            except Exception, ex:
-                resp = {
-                    'status': 'error',
-                    'error_message': "exception while processing '%s': %s"
-                        % (command, ex),
-                    'error_detail': traceback.format_exc()
-                }
-            else:
-                if not resp.get('status'):
-                    resp['status'] = 'ok'
-
-        task.doc = resp
-        self.out_queue.put(task)
-        return True
+            return
+
+        resp = self._call(command, method, req_doc)
+        task.doc = _ok_response(resp)
+
+    def handle_batch(self, tasks):
+        """
+        Process a batch of tasks with the same command. Calls
+        ``do_<command>_batch`` with all task docs if the worker
+        implements it, otherwise each task is processed on its own.
+        """
+        command = tasks[0].doc.get('command', 'None')
+        method = getattr(self, 'do_%s_batch' % command, None)
+        if not method:
+            for task in tasks:
+                self.handle_task(task)
+            return
+
+        resps = self._call(command, method, [task.doc for task in tasks])
+        if isinstance(resps, dict):
+            # error for the whole batch
+            resps = [dict(resps) for _ in tasks]
+        for task, resp in zip(tasks, resps):
+            task.doc = _ok_response(resp)
+
+    def _call(self, command, method, arg):
+        try:
+            return method(arg)
+        except LockTimeout, ex:
+            return {
+                'status': 'lock',
+                'error_message': "lock timeout while processing '%s': %s"
+                    % (command, ex),
+                'error_detail': traceback.format_exc()
+            }
+        except Exception, ex:
+            return {
+                'status': 'error',
+                'error_message': "exception while processing '%s': %s"
+                    % (command, ex),
+                'error_detail': traceback.format_exc()
+            }
+
+def current_rss():
+    """
+    Return the resident memory of this process in bytes.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # no procfs, use the peak resident memory instead
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            return rss
+        return rss * 1024
+
+def _ok_response(resp):
+    if resp is None:
+        resp = {}
+    if not resp.get('status'):
+        resp['status'] = 'ok'
+    return resp
 
 
 class SeedWorker(BaseWorker):
-    def __init__(self, caches, base_config, **kw):
+    """
+    Worker that creates tiles for the `caches`.
+
+    :param http_max_idle: number of idle keep-alive connections per
+        upstream host that are kept open for the next requests,
+        0 disables connection reuse
+    :param tile_buffer: `TileBuffer` for the ``render_tiles`` command
+    """
+    def __init__(self, caches, base_config, http_max_idle=0, tile_buffer=None, **kw):
         self.caches = caches
         self.base_config = base_config
+        self.http_max_idle = http_max_idle
+        self.tile_buffer = tile_buffer
+        self.http_pool = None
         BaseWorker.__init__(self, **kw)
 
+    def run(self):
+        if self.http_max_idle:
+            self.http_pool = self.install_http_pool()
+        try:
+            BaseWorker.run(self)
+        finally:
+            if self.http_pool:
+                log.info('proc %d upstream connections: %d requests, '
+                    '%d reused (%.0f%%), %d opened', os.getpid(),
+                    self.http_pool.requests, self.http_pool.reused,
+                    self.http_pool.reuse_rate() * 100, self.http_pool.connections)
+                self.http_pool.close()
+
+    def install_http_pool(self):
+        """
+        Let all HTTP clients of this process use a shared pool of
+        keep-alive connections. Needs to be called in the worker process.
+        """
+        try:
+            from mapproxy.client import http
+        except ImportError:
+            return None
+
+        pool = HTTPConnectionPool(max_idle=self.http_max_idle)
+        for opener, _passman in http.create_url_opener._opener.values():
+            pool.install(opener)
+
+        # for clients that are created later
+        create_url_opener = http.create_url_opener
+        def pooled_url_opener(*args, **kw):
+            opener = create_url_opener(*args, **kw)
+            pool.install(opener)
+            return opener
+        http.create_url_opener = pooled_url_opener
+        return pool
+
     def do_tile(self, doc):
         from mapproxy.config.config import local_base_config
 
@@ -102,6 +243,104 @@ class SeedWorker(BaseWorker):
                 'error_message': "unknown cache '%s'" % doc['cache_identifier']
             }
 
-        tiles = [tuple(coord) for coord in doc['tiles'] if coord]
+        tiles = self.outdated_tiles(cache, doc)
+        if not tiles:
+            return
         with local_base_config(self.base_config):
-            cache.load_tile_coords(tiles)
\ No newline at end of file
+            cache.load_tile_coords(tiles)
+
+    def do_tile_batch(self, docs):
+        """
+        Create the tiles of multiple tile tasks for the same cache
+        with a single ``load_tile_coords`` call.
+        """
+        from mapproxy.config.config import local_base_config
+
+        cache_identifier = docs[0]['cache_identifier']
+        assert all(doc['cache_identifier'] == cache_identifier for doc in docs)
+        cache = self.caches.get(cache_identifier)
+        if not cache:
+            return {
+                'status': 'error',
+                'error_message': "unknown cache '%s'" % cache_identifier
+            }
+
+        tiles = []
+        for doc in docs:
+            tiles.extend(self.outdated_tiles(cache, doc))
+        if tiles:
+            with local_base_config(self.base_config):
+                cache.load_tile_coords(tiles)
+        return [{} for _ in docs]
+
+    def do_render_tiles(self, doc):
+        """
+        Create the tiles like ``tile`` and return the encoded tiles.
+        The tiles are written into the `tile_buffer`, the result only
+        contains their offsets.
+        """
+        from mapproxy.config.config import local_base_config
+        from mapproxy.cache.tile import Tile
+
+        if self.tile_buffer is None:
+            return {
+                'status': 'error',
+                'error_message': 'render_tiles is disabled, no tile buffer'
+            }
+        cache = self.caches.get(doc['cache_identifier'])
+        if not cache:
+            return {
+                'status': 'error',
+                'error_message': "unknown cache '%s'" % doc['cache_identifier']
+            }
+
+        tiles = {}
+        outdated = self.outdated_tiles(cache, doc)
+        if outdated:
+            with local_base_config(self.base_config):
+                for tile in cache.load_tile_coords(outdated):
+                    if tile.coord is not None:
+                        tiles[tile.coord] = tile
+
+        tile_data = []
+        try:
+            for coord in doc['tiles']:
+                if not coord:
+                    continue
+                coord = tuple(coord)
+                tile = tiles.get(coord)
+                if tile is None:
+                    # fresh tile, created by a previous task
+                    tile = Tile(coord)
+                    cache.cache.load_tile(tile)
+                buf = tile.source_buffer(getattr(cache, 'image_opts', None))
+                data = buf.read() if buf is not None else ''
+                offset = self.tile_buffer.write(data)
+                if offset is None:
+                    raise ValueError('tile buffer full')
+                tile_data.append({'tile': list(coord), 'offset': offset,
+                    'length': len(data)})
+        except Exception:
+            for t in tile_data:
+                self.tile_buffer.release(t['offset'])
+            raise
+        return {'tile_data': tile_data, 'format': getattr(cache, 'format', None)}
+
+    def outdated_tiles(self, tile_manager, doc):
+        """
+        Return the tile coords of `doc` that need to be created.
+        Tiles that were stored after ``refresh_before`` of the `doc`
+        (e.g. by a duplicate task) are skipped.
+        """
+        tiles = [tuple(coord) for coord in doc['tiles'] if coord]
+        refresh_before = doc.get('refresh_before')
+        cache = getattr(tile_manager, 'cache', None)
+        if refresh_before is None or cache is None:
+            return tiles
+
+        fresh = fresh_tiles(cache, tiles, refresh_before)
+        if fresh:
+            log.debug('skipping %d fresh tiles of %s', len(fresh),
+                doc['cache_identifier'])
+            tiles = [t for t in tiles if t not in fresh]
+        return tiles
@@ -13,17 +13,26 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import time
 import uuid
 import json
+import Queue
+import select
+import socket
 import textwrap
 
-from mp_renderd.task import Task
+from mp_renderd.task import Task, request_trace, trace_durations
+from mp_renderd.broker import expired_result
+from mp_renderd.jobs import JobStore
 from mapproxy.request.base import Request as _Request
 from mapproxy.response import Response
 from mapproxy.util.lock import LockTimeout
 
 import logging
 log = logging.getLogger(__name__)
+# one JSON line with the stage times of each answered task
+trace_log = logging.getLogger('mp_renderd.trace')
 
 
 try:
@@ -31,7 +40,31 @@ try:
 except ImportError:
     from mp_renderd.ext.wsgiserver import CherryPyWSGIServer
 
-__all__ = ['CherryPyWSGIServer', 'RenderdApp']
+__all__ = ['CherryPyWSGIServer', 'RenderdWSGIServer', 'RenderdApp']
+
+class RenderdWSGIServer(CherryPyWSGIServer):
+    """
+    `CherryPyWSGIServer` that sets the permissions of Unix sockets.
+    `bind_addr` is a path for Unix sockets.
+
+    :param socket_mode: permissions of the Unix socket, e.g. ``0660``
+    """
+    def __init__(self, bind_addr, app, socket_mode=None, **kw):
+        CherryPyWSGIServer.__init__(self, bind_addr, app, **kw)
+        self.socket_mode = socket_mode
+
+    def bind(self, family, type, proto=0):
+        CherryPyWSGIServer.bind(self, family, type, proto)
+        if family == socket.AF_UNIX and self.socket_mode is not None:
+            os.chmod(self.bind_addr, self.socket_mode)
+
+    def stop(self):
+        CherryPyWSGIServer.stop(self)
+        if isinstance(self.bind_addr, basestring):
+            try:
+                os.unlink(self.bind_addr)
+            except OSError:
+                pass
 
 class Request(_Request):
     _body = None
@@ -42,50 +75,413 @@ class Request(_Request):
             self._body = self.environ['wsgi.input'].read(body_length)
         return self._body
 
+def _client_socket(environ):
+    # CherryPy wraps the socket file object of the connection
+    # (wsgi.input.rfile[.rfile]._sock), there is no official way to get it
+    rfile = environ.get('wsgi.input')
+    for _ in range(4):
+        if rfile is None or hasattr(rfile, '_sock'):
+            break
+        rfile = getattr(rfile, 'rfile', None)
+    return getattr(rfile, '_sock', None)
+
+def client_connected(environ):
+    """
+    Return ``False`` if the client of this request closed the connection.
+    Returns ``True`` if the socket of the connection is not available.
+    """
+    sock = _client_socket(environ)
+    if sock is None:
+        return True
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return True
+        # readable but no data: connection was closed
+        return bool(sock.recv(1, socket.MSG_PEEK))
+    except (socket.error, select.error, ValueError):
+        return False
+
+def tile_data_response(result):
+    """
+    Return a response with the tiles of a ``render_tiles`` result.
+    The body contains the tiles in the order of the ``X-Renderd-Tiles``
+    header (list of ``[x, y, z, length]``). The tiles are sent directly
+    from the tile buffer.
+    """
+    tile_data = result.tile_data
+    content_type = result.doc.get('format') or 'application/octet-stream'
+    if '/' not in content_type:
+        content_type = 'image/' + content_type
+    resp = Response(tile_data.chunks(), content_type=content_type)
+    resp.headers['Content-length'] = str(tile_data.length)
+    resp.headers['X-Renderd-Tiles'] = json.dumps(
+        [t['tile'] + [t['length']] for t in tile_data.tiles])
+    return resp
+
+class BadRequest(ValueError):
+    """
+    Malformed request, answered with 400.
+    """
+    pass
+
+def exception_response(ex):
+    if isinstance(ex, BadRequest):
+        return Response(json.dumps({'status': 'error', 'error_message': 'bad request: %s' % ex.args[0]}),
+            content_type='application/json', status=400)
+    if isinstance(ex, LockTimeout):
+        return Response(json.dumps({'status': 'lock', 'error_message': 'lock timeout error: %s' % ex.args[0]}),
+            content_type='application/json', status=503)
+    return Response(json.dumps({'status': 'error', 'error_message': 'internal error: %s' % ex.args[0]}),
+        content_type='application/json', status=500)
+
+def overload_doc(reason):
+    return {'status': 'overload', 'error_message': reason}
+
+def parse_task_doc(body, what='request'):
+    """
+    Return the JSON object of a task request `body`.
+    Raises `BadRequest` for invalid JSON or other JSON values.
+    """
+    try:
+        doc = json.loads(body)
+    except ValueError, ex:
+        raise BadRequest('invalid JSON: %s' % ex)
+    if not isinstance(doc, dict):
+        raise BadRequest('%s needs to be a JSON object' % what)
+    return doc
+
+def parse_batch(body):
+    """
+    Return the task docs of a batch request. The `body` is a JSON
+    array or contains one JSON doc per line (NDJSON).
+    Raises `BadRequest` for invalid JSON or docs that are no objects.
+    """
+    body = body.strip()
+    try:
+        if body.startswith('['):
+            docs = json.loads(body)
+        else:
+            docs = [json.loads(line) for line in body.splitlines() if line.strip()]
+    except ValueError, ex:
+        raise BadRequest('invalid JSON: %s' % ex)
+    if not all(isinstance(doc, dict) for doc in docs):
+        raise BadRequest('batch needs to contain JSON objects')
+    return docs
+
+def batch_line(index, task_id, doc):
+    """
+    Return the NDJSON line with the result `doc` of the task at
+    `index` of a batch request.
+    """
+    doc = dict(doc)
+    # offsets in the tile buffer are meaningless for the client
+    doc.pop('tile_data', None)
+    doc['index'] = index
+    doc['id'] = task_id
+    return json.dumps(doc) + '\n'
+
+def job_doc(job):
+    """
+    Return the state of `job` and its result doc, once it is done.
+    """
+    doc = {
+        'job_id': job.id,
+        'id': job.task.id,
+        'state': job.state,
+    }
+    if job.doc is not None:
+        result = dict(job.doc)
+        # jobs do not keep the tile data
+        result.pop('tile_data', None)
+        doc['result'] = result
+    return doc
+
+class BatchQueue(object):
+    """
+    Response queue for a task of a batch request. Puts the results
+    with the `index` of the task into the shared `queue`.
+    """
+    def __init__(self, queue, index):
+        self.queue = queue
+        self.index = index
+
+    def put(self, result):
+        self.queue.put((self.index, result))
+
+class BatchStream(object):
+    """
+    Response body of a batch request. The WSGI server calls `close`
+    when it is done, the tasks that are still pending are cancelled
+    (e.g. when the client disconnected).
+    """
+    def __init__(self, lines, pending, results):
+        self.lines = lines
+        self.pending = pending
+        self.results = results
+
+    def __iter__(self):
+        for line in self.lines:
+            yield line
+        for line in self.results:
+            yield line
+
+    def close(self):
+        self.results.close()
+        for task in self.pending.itervalues():
+            task.cancelled = True
+
 class RenderdApp(object):
-    def __init__(self, broker):
+    # how often (in seconds) a batch request checks if the client is
+    # still connected
+    client_check_interval = 1
+    # maximum time (in seconds) a job request waits for the result
+    max_job_wait = 60
+
+    def __init__(self, broker, jobs=None):
         self.broker = broker
+        if jobs is None:
+            jobs = JobStore()
+        self.jobs = jobs
 
     def __call__(self, environ, start_response):
         req = Request(environ)
         try:
             if req.path == '/':
                 resp = self.do_request(req)
+            elif req.path == '/batch':
+                resp = self.do_batch(req)
+            elif req.path == '/jobs':
+                resp = self.do_submit_job(req)
+            elif req.path.startswith('/jobs/'):
+                resp = self.do_job(req)
             elif req.path == '/_status':
                 resp = self.do_status(req)
+            elif req.path == '/metrics':
+                resp = self.do_metrics(req)
             else:
                 resp = Response(json.dumps({'status': 'error', 'error_message': 'endpoint not found'}),
                     content_type='application/json', status=404)
-        except LockTimeout, ex:
-            resp = Response(json.dumps({'status': 'lock', 'error_message': 'lock timeout error: %s' % ex.args[0]}),
-                content_type='application/json', status=503)
         except Exception, ex:
-            resp = Response(json.dumps({'status': 'error', 'error_message': 'internal error: %s' % ex.args[0]}),
-                content_type='application/json', status=500)
+            resp = exception_response(ex)
 
         return resp(environ, start_response)
 
     def do_request(self, req):
-        req = json.loads(req.body())
+        environ = req.environ
+        task, rejected = self.new_task(parse_task_doc(req.body()), environ)
+        if rejected:
+            return Response(json.dumps(overload_doc(rejected)),
+                content_type='application/json', status=503)
+
+        resp = self.broker.dispatch(task,
+            client_connected=lambda: client_connected(environ))
+        return self.result_response(resp, task)
+
+    def new_task(self, req, environ):
+        """
+        Create the task for the request doc `req`. Returns the task and
+        the reason if it is rejected. Raises `BadRequest` for an invalid
+        timeout.
+        """
         log.info('got request: %s', req)
 
         req_id = req.get('id')
         if not req_id:
             req_id = uuid.uuid4().hex
-        resp = self.broker.dispatch(Task(req_id, req, priority=req.get('priority', 10)))
+
+        refresh_before = req.get('refresh_before')
+        # tiles that are created after this request are not created again
+        req.setdefault('refresh_before', time.time())
+
+        if environ.get('HTTP_X_RENDERD_TRACE'):
+            req['trace'] = True
+
+        deadline = None
+        timeout = req.get('timeout', environ.get('HTTP_X_RENDERD_TIMEOUT'))
+        if timeout not in (None, ''):
+            try:
+                timeout = float(timeout)
+            except (TypeError, ValueError):
+                raise BadRequest('invalid timeout %r' % timeout)
+            if not 0 < timeout < float('inf'):
+                raise BadRequest('invalid timeout %r' % timeout)
+            deadline = time.time() + timeout
+
+        task = Task(req_id, req, priority=req.get('priority', 10), deadline=deadline)
+        task.refresh_before = refresh_before
+        task.stamp('accepted')
+        rejected = self.broker.admit(task)
+        if rejected:
+            log.info('rejected request: %s', rejected)
+        return task, rejected
+
+    def result_response(self, resp, task=None):
+        """
+        Return the response for the result of a task.
+
+        :param task: the requested task, see `result_doc`
+        """
         log.info('got resp: %s', resp)
-        return Response(json.dumps(resp.doc), content_type='application/json')
+        doc = resp.doc
+        if task is not None:
+            doc = self.result_doc(task, resp)
+        if resp.tile_data is not None and resp.doc.get('status') == 'ok':
+            tile_resp = tile_data_response(resp)
+            if 'trace' in doc:
+                tile_resp.headers['X-Renderd-Trace'] = json.dumps(doc['trace'])
+            return tile_resp
+        status = 200
+        if resp.doc.get('status') in ('expired', 'timeout'):
+            status = 504
+        return Response(json.dumps(doc), content_type='application/json', status=status)
+
+    def result_doc(self, task, result):
+        """
+        Return the response doc for the `result` of the requested
+        `task`. Stamps the ``responded`` time and logs the trace of the
+        task. The doc contains the trace if the request asked for it.
+        """
+        task.stamp('responded')
+        trace = request_trace(task, result)
+        if trace_log.isEnabledFor(logging.INFO):
+            cache = None
+            if isinstance(task.doc, dict):
+                cache = task.doc.get('cache_identifier')
+            trace_log.info(json.dumps({
+                'id': task.id,
+                'request_id': task.request_id,
+                'cache_identifier': cache,
+                'priority': task.priority,
+                'status': result.doc.get('status'),
+                'trace': trace,
+                'durations': trace_durations(trace),
+            }))
+        if not (isinstance(task.doc, dict) and task.doc.get('trace')):
+            return result.doc
+        doc = dict(result.doc)
+        doc['trace'] = trace
+        return doc
+
+    def do_batch(self, req):
+        """
+        Dispatch all tasks of a batch request at once and stream the
+        result of each task as NDJSON line when it is done.
+        """
+        environ = req.environ
+        docs = parse_batch(req.body())
+        results = Queue.Queue()
+        lines = []
+        pending = {}
+        for index, doc in enumerate(docs):
+            task, rejected = self.new_task(doc, environ)
+            if rejected:
+                lines.append(batch_line(index, task.id, overload_doc(rejected)))
+                continue
+            pending[index] = task
+            self.broker.dispatch(task, BatchQueue(results, index))
+
+        return Response(BatchStream(lines, pending,
+            self._batch_results(results, pending, environ)),
+            content_type='application/x-ndjson')
+
+    def _batch_results(self, results, pending, environ):
+        # deadlines and the client connection are also checked while
+        # results arrive continuously
+        next_client_check = time.time() + self.client_check_interval
+        while pending:
+            timeout = max(0, next_client_check - time.time())
+            deadlines = [t.deadline for t in pending.itervalues() if t.deadline is not None]
+            if deadlines:
+                timeout = max(0, min(timeout, min(deadlines) - time.time()))
+            try:
+                index, result = results.get(timeout=timeout)
+            except Queue.Empty:
+                pass
+            else:
+                task = pending.pop(index, None)
+                if task is not None:
+                    yield batch_line(index, task.id, self.result_doc(task, result))
+
+            now = time.time()
+            for index, task in pending.items():
+                if task.deadline is not None and now >= task.deadline:
+                    del pending[index]
+                    task.cancelled = True
+                    yield batch_line(index, task.id, self.result_doc(task,
+                        expired_result(task, 'deadline exceeded')))
+            if pending and now >= next_client_check:
+                if not client_connected(environ):
+                    return
+                next_client_check = now + self.client_check_interval
+
+    def do_submit_job(self, req):
+        """
+        Dispatch the task of the request and return the id of its job
+        immediately.
+        """
+        doc = parse_task_doc(req.body(), 'job')
+        task, rejected = self.new_task(doc, req.environ)
+        if not rejected:
+            job = self.jobs.submit(task)
+            if job is None:
+                rejected = 'too many jobs (%d)' % len(self.jobs)
+        if rejected:
+            return Response(json.dumps(overload_doc(rejected)),
+                content_type='application/json', status=503)
+
+        self.broker.dispatch(task, job)
+        resp = Response(json.dumps(job_doc(job)), content_type='application/json',
+            status=202)
+        resp.headers['Location'] = '/jobs/' + job.id
+        return resp
+
+    def do_job(self, req):
+        """
+        Return the state of a job. Waits up to ``wait`` seconds for the
+        result of a pending job, unless the request is handled in the
+        event loop of the `EventServer`, which waits for the job itself.
+        """
+        job = self.jobs.get(req.path[len('/jobs/'):])
+        if job is None:
+            return Response(json.dumps({'status': 'error', 'error_message': 'job not found'}),
+                content_type='application/json', status=404)
+        wait = self.job_wait(req)
+        if wait and not req.environ.get('mp_renderd.event_loop'):
+            job.wait(wait)
+        return self.job_response(job)
+
+    def job_wait(self, req):
+        """
+        Return how long the job request `req` waits for the result.
+        Raises `BadRequest` for an invalid ``wait`` parameter.
+        """
+        try:
+            wait = float(req.args.get('wait', 0))
+        except ValueError:
+            raise BadRequest('invalid wait %r' % req.args.get('wait'))
+        if wait != wait:
+            raise BadRequest('invalid wait %r' % req.args.get('wait'))
+        return max(0, min(wait, self.max_job_wait))
+
+    def job_response(self, job):
+        return Response(json.dumps(job_doc(job)), content_type='application/json')
 
     def do_status(self, req):
+        status = self.broker.status()
         body = """\
         running: %d
         waiting: %d
         worker: %d
         """ % (
-            self.broker.render_queue.running,
-            self.broker.render_queue.waiting,
-            self.broker.worker.pool_size,
+            status['running'],
+            status['waiting'],
+            status['worker'],
         )
         body = textwrap.dedent(body)
 
         return Response(body, content_type='text/plain')
+
+    def do_metrics(self, req):
+        return Response(self.broker.metrics_text(),
+            content_type='text/plain; version=0.0.4')